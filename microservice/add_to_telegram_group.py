@@ -1,13 +1,29 @@
 from telethon.sync import TelegramClient
-from telethon.tl.functions.channels import InviteToChannelRequest, EditBannedRequest
+from telethon.tl.functions.channels import InviteToChannelRequest, EditBannedRequest, GetParticipantRequest, GetParticipantsRequest
 from telethon.tl.functions.messages import GetDialogsRequest
-from telethon.tl.types import InputPeerEmpty, InputPeerUser, InputPeerChannel, ChatBannedRights, Channel
-from telethon.errors.rpcerrorlist import PeerFloodError, UserPrivacyRestrictedError, ChannelInvalidError, UserNotMutualContactError
-from telethon.errors import SessionPasswordNeededError, PhoneCodeInvalidError
+from telethon.tl.types import InputPeerEmpty, InputPeerUser, InputPeerChannel, ChatBannedRights, Channel, ChannelParticipantsRecent
+from telethon.tl.types.channels import ChannelParticipantsNotModified
+from telethon.errors.rpcerrorlist import (
+    PeerFloodError, UserPrivacyRestrictedError, ChannelInvalidError, UserNotMutualContactError, UserNotParticipantError, ChatAdminRequiredError, PeerIdInvalidError, UserIdInvalidError,
+    AuthKeyUnregisteredError, AuthKeyDuplicatedError, SessionRevokedError, UserDeactivatedError, UserDeactivatedBanError, UserBannedInChannelError
+)
+from telethon.errors import SessionPasswordNeededError, PhoneCodeInvalidError, FloodWaitError, RPCError
 import requests
+from requests.adapters import HTTPAdapter
+from urllib3.util import make_headers
 import json
 import time
 import threading
+import sqlite3
+import hashlib
+import socket
+import random
+import asyncio
+import functools
+import contextlib
+import collections
+from concurrent.futures import ThreadPoolExecutor
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
 from dotenv import load_dotenv
 import os
 import sys
@@ -15,13 +31,121 @@ import traceback
 import re
 import logging
 import logging.handlers
-from datetime import datetime
+import queue
+import atexit
+from datetime import datetime, timedelta, timezone
+
+try:
+    # Optional: decodes large Teable pages several times faster than the json module
+    import orjson
+except ImportError:
+    orjson = None
+
+class LazyJson:
+    """Defer json.dumps of a log argument until the record is actually emitted"""
+
+    __slots__ = ("value",)
+
+    def __init__(self, value):
+        self.value = value
+
+    def __str__(self):
+        try:
+            return json.dumps(self.value, default=str)
+        except (TypeError, ValueError):
+            return repr(self.value)
+
+
+class LazyText:
+    """Defer reading a response body until the record is actually emitted"""
+
+    __slots__ = ("response",)
+
+    def __init__(self, response):
+        self.response = response
+
+    def __str__(self):
+        return self.response.text
+
+
+# Pass as extra= on high-volume debug events so LOG_DEBUG_SAMPLE_EVERY can thin them out
+SAMPLED = {"sampled": True}
+
+# Teable field ID of the record status
+STATUS_FIELD_ID = "fldE151819s5A2x1fnH"
+
+
+class DebugSampler(logging.Filter):
+    """Let through the first and then every Nth occurrence of each sampled debug message"""
+
+    def __init__(self, every):
+        super().__init__()
+        self.every = max(1, every)
+        self._counts = collections.Counter()
+        self._lock = threading.Lock()
+
+    def filter(self, record):
+        if self.every == 1 or record.levelno > logging.DEBUG or not getattr(record, "sampled", False):
+            return True
+        with self._lock:
+            count = self._counts[record.msg]
+            self._counts[record.msg] = count + 1
+        return count % self.every == 0
+
+
+class JsonLinesFormatter(logging.Formatter):
+    """Format records as one JSON object per line, including any extra= fields"""
+
+    STANDARD_ATTRS = frozenset(vars(logging.LogRecord("", 0, "", 0, "", (), None))) | {"message", "asctime", "sampled"}
+
+    def format(self, record):
+        entry = {
+            "ts": datetime.fromtimestamp(record.created, timezone.utc).isoformat(timespec="milliseconds"),
+            "level": record.levelname,
+            "logger": record.name,
+            "thread": record.threadName,
+            "message": record.getMessage(),
+        }
+        for key, value in record.__dict__.items():
+            if key not in self.STANDARD_ATTRS and not key.startswith("_"):
+                entry[key] = value
+        if record.exc_info:
+            entry["exc_info"] = self.formatException(record.exc_info)
+        elif record.exc_text:
+            entry["exc_info"] = record.exc_text
+        return json.dumps(entry, default=str)
+
+
+class QueuedRecordHandler(logging.handlers.QueueHandler):
+    """QueueHandler that leaves formatting to the listener's handlers
+
+    The stock handler renders the whole line, traceback included, on the calling
+    thread with its own formatter, which would bypass the JSON formatter.
+    """
+
+    def prepare(self, record):
+        # Resolve the lazy arguments now (they may reference objects that change later)
+        # and keep the traceback as text for the listener-side formatter
+        record = logging.makeLogRecord(record.__dict__)
+        record.msg = record.getMessage()
+        record.args = None
+        if record.exc_info and not record.exc_text:
+            record.exc_text = logging.Formatter().formatException(record.exc_info)
+        record.exc_info = None
+        return record
+
 
 def setup_logging():
     """Configure logging with file rotation and console output"""
     # Get log level from environment variable, default to INFO
     log_level = os.getenv('LOG_LEVEL', 'INFO').upper()
     numeric_level = getattr(logging, log_level, logging.INFO)
+    log_format = os.getenv('LOG_FORMAT', 'text').strip().lower()
+    use_queue = os.getenv('LOG_QUEUE', 'true').strip().lower() in ('true', '1', 'yes', 'y', 'on')
+    try:
+        sample_every = int(os.getenv('LOG_DEBUG_SAMPLE_EVERY', '1'))
+    except ValueError:
+        sample_every = 1
     
     # Create logs directory if it doesn't exist
     log_dir = os.path.join(os.path.dirname(__file__), 'logs')
@@ -32,11 +156,14 @@ def setup_logging():
     logger.setLevel(numeric_level)
     
     # Create formatters
-    file_formatter = logging.Formatter(
-        '%(asctime)s - %(levelname)s - [%(name)s] - %(message)s',
-        datefmt='%Y-%m-%d %H:%M:%S'
-    )
-    console_formatter = logging.Formatter('%(levelname)s: %(message)s')
+    if log_format == 'json':
+        file_formatter = console_formatter = JsonLinesFormatter()
+    else:
+        file_formatter = logging.Formatter(
+            '%(asctime)s - %(levelname)s - [%(name)s] - %(message)s',
+            datefmt='%Y-%m-%d %H:%M:%S'
+        )
+        console_formatter = logging.Formatter('%(levelname)s: %(message)s')
     
     # File handler with rotation
     log_file = os.path.join(log_dir, 'telegram_manager.log')
@@ -53,12 +180,26 @@ def setup_logging():
     console_handler.setFormatter(console_formatter)
     console_handler.setLevel(numeric_level)
     
-    # Add handlers to logger
-    logger.addHandler(file_handler)
-    logger.addHandler(console_handler)
+    # Sampling runs on the calling side so dropped events are never queued or formatted
+    if sample_every > 1:
+        logger.addFilter(DebugSampler(sample_every))
+    
+    if use_queue:
+        # Callers only enqueue records; a listener thread does the formatting and the
+        # file/console writes so a slow disk never stalls the event loop
+        log_queue = queue.SimpleQueue()
+        listener = logging.handlers.QueueListener(log_queue, file_handler, console_handler, respect_handler_level=True)
+        listener.start()
+        atexit.register(listener.stop)
+        logger.addHandler(QueuedRecordHandler(log_queue))
+    else:
+        # Add handlers to logger
+        logger.addHandler(file_handler)
+        logger.addHandler(console_handler)
     
     return logger
 
+
 # Ensure environment variables are loaded
 load_dotenv()
 
@@ -101,280 +242,2158 @@ def get_required_env_var(var_name, default=None, required=True, convert_func=Non
     
     return value
 
+def get_bool_env_var(var_name, default=False):
+    """
+    Retrieve a boolean flag from the environment ("1", "true", "yes", "on" are truthy).
+    """
+    value = os.getenv(var_name)
+    if value is None or value.strip() == "":
+        return default
+    return value.strip().lower() in ("1", "true", "yes", "on")
+
+def decode_json(data):
+    """
+    Decode a JSON response body (bytes or str), with orjson when it is installed.
+
+    A malformed body raises requests' InvalidJSONError, a RequestException like
+    the one response.json() raises, so callers handle it as a failed request.
+    """
+    try:
+        if orjson is not None:
+            return orjson.loads(data)
+        return json.loads(data)
+    except ValueError as e:
+        raise requests.exceptions.InvalidJSONError(f"Malformed JSON response: {e}") from e
+
+def batched(iterable, size):
+    """Yield lists of up to `size` items from an iterable"""
+    batch = []
+    for item in iterable:
+        batch.append(item)
+        if len(batch) >= size:
+            yield batch
+            batch = []
+    if batch:
+        yield batch
+
+class TimeoutHTTPAdapter(HTTPAdapter):
+    """HTTPAdapter that applies a default (connect, read) timeout to every request"""
+    def __init__(self, *args, timeout=None, **kwargs):
+        self.timeout = timeout
+        super().__init__(*args, **kwargs)
+
+    def send(self, request, **kwargs):
+        if kwargs.get("timeout") is None:
+            kwargs["timeout"] = self.timeout
+        return super().send(request, **kwargs)
+
+def create_http_session():
+    """
+    Create the pooled HTTP session shared by all Teable and webhook calls.
+
+    Connections are kept alive and reused across a cycle; HTTP_POOL_MAXSIZE
+    limits the connections kept per host and the timeouts stop one slow
+    endpoint from stalling the loop.
+    """
+    connect_timeout = get_required_env_var("HTTP_CONNECT_TIMEOUT_SECONDS", default=5.0, required=False, convert_func=float)
+    read_timeout = get_required_env_var("HTTP_READ_TIMEOUT_SECONDS", default=30.0, required=False, convert_func=float)
+    pool_connections = get_required_env_var("HTTP_POOL_CONNECTIONS", default=10, required=False, convert_func=int)
+    pool_maxsize = get_required_env_var("HTTP_POOL_MAXSIZE", default=10, required=False, convert_func=int)
+
+    adapter = TimeoutHTTPAdapter(
+        timeout=(connect_timeout, read_timeout),
+        pool_connections=pool_connections,
+        pool_maxsize=pool_maxsize
+    )
+    session = requests.Session()
+    session.mount("https://", adapter)
+    session.mount("http://", adapter)
+    # Offer every encoding urllib3 can decode: gzip and deflate, plus br and zstd
+    # when the optional brotli / zstandard packages are installed
+    session.headers["Accept-Encoding"] = make_headers(accept_encoding=True)["accept-encoding"]
+    logger.debug("HTTP session created (timeouts: connect=%ss, read=%ss, pool size per host: %s)", connect_timeout, read_timeout, pool_maxsize)
+    return session
+
+class MetricsRegistry:
+    """
+    Minimal thread-safe metrics registry rendered in the Prometheus text format.
+
+    Counters, gauges and histograms are declared once with their label names
+    and updated with keyword labels, e.g. counter.inc(stage="submitted").
+    Gauges can also be computed at scrape time through add_collector().
+    """
+    DEFAULT_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60, 120, 300)
+
+    class Metric:
+        def __init__(self, registry, kind, name, help_text, label_names, buckets=None):
+            self.registry = registry
+            self.kind = kind
+            self.name = name
+            self.help_text = help_text
+            self.label_names = tuple(label_names)
+            self.buckets = tuple(buckets or ())
+            self.values = {}
+
+        def _key(self, labels):
+            return tuple(str(labels.get(name, "")) for name in self.label_names)
+
+        def inc(self, amount=1, **labels):
+            with self.registry._lock:
+                key = self._key(labels)
+                self.values[key] = self.values.get(key, 0) + amount
+
+        def set(self, value, **labels):
+            with self.registry._lock:
+                self.values[self._key(labels)] = value
+
+        def observe(self, value, **labels):
+            with self.registry._lock:
+                key = self._key(labels)
+                state = self.values.get(key)
+                if state is None:
+                    state = self.values[key] = {"buckets": [0] * len(self.buckets), "sum": 0.0, "count": 0}
+                for index, bound in enumerate(self.buckets):
+                    if value <= bound:
+                        state["buckets"][index] += 1
+                state["sum"] += value
+                state["count"] += 1
+
+        @contextlib.contextmanager
+        def timer(self, **labels):
+            """Observe the duration of the with-block"""
+            started_at = time.perf_counter()
+            try:
+                yield
+            finally:
+                self.observe(time.perf_counter() - started_at, **labels)
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._metrics = []
+        self._collectors = []
+
+    def _add(self, kind, name, help_text, label_names=(), buckets=None):
+        metric = self.Metric(self, kind, name, help_text, label_names, buckets)
+        self._metrics.append(metric)
+        return metric
+
+    def counter(self, name, help_text, label_names=()):
+        return self._add("counter", name, help_text, label_names)
+
+    def gauge(self, name, help_text, label_names=()):
+        return self._add("gauge", name, help_text, label_names)
+
+    def histogram(self, name, help_text, label_names=(), buckets=DEFAULT_BUCKETS):
+        return self._add("histogram", name, help_text, label_names, buckets)
+
+    def add_collector(self, func):
+        """Register a callable run before every scrape, e.g. to refresh gauges"""
+        self._collectors.append(func)
+
+    @staticmethod
+    def _format_labels(names, values, extra=None):
+        pairs = list(zip(names, values)) + ([extra] if extra else [])
+        if not pairs:
+            return ""
+        escaped = []
+        for name, value in pairs:
+            value = str(value).replace("\\", "\\\\").replace("\n", "\\n").replace('"', '\\"')
+            escaped.append(f'{name}="{value}"')
+        return "{" + ",".join(escaped) + "}"
+
+    def render(self):
+        """Render every metric in the Prometheus text exposition format"""
+        for collector in self._collectors:
+            try:
+                collector()
+            except Exception as e:
+                logger.debug("Metrics collector failed: %s", e)
+
+        lines = []
+        with self._lock:
+            for metric in self._metrics:
+                lines.append(f"# HELP {metric.name} {metric.help_text}")
+                lines.append(f"# TYPE {metric.name} {metric.kind}")
+                for key, value in sorted(metric.values.items()):
+                    if metric.kind != "histogram":
+                        lines.append(f"{metric.name}{self._format_labels(metric.label_names, key)} {value}")
+                        continue
+                    for bound, count in zip(metric.buckets, value["buckets"]):
+                        labels = self._format_labels(metric.label_names, key, ("le", bound))
+                        lines.append(f"{metric.name}_bucket{labels} {count}")
+                    labels = self._format_labels(metric.label_names, key, ("le", "+Inf"))
+                    lines.append(f"{metric.name}_bucket{labels} {value['count']}")
+                    lines.append(f"{metric.name}_sum{self._format_labels(metric.label_names, key)} {value['sum']}")
+                    lines.append(f"{metric.name}_count{self._format_labels(metric.label_names, key)} {value['count']}")
+        return "\n".join(lines) + "\n"
+
+class PipelineMetrics(MetricsRegistry):
+    """The metrics exported by the service"""
+    def __init__(self):
+        super().__init__()
+        self.teable_request_seconds = self.histogram(
+            "teable_request_duration_seconds", "Teable API request latency", ("method", "status_filter")
+        )
+        self.teable_request_errors = self.counter(
+            "teable_request_errors_total", "Failed Teable API requests", ("method", "status_filter")
+        )
+        self.teable_records_fetched = self.counter(
+            "teable_records_fetched_total", "Records returned by Teable record walks, by record status", ("status",)
+        )
+        self.stage_records = self.counter(
+            "pipeline_records_total", "Records handed to a pipeline stage", ("stage",)
+        )
+        self.stage_item_seconds = self.histogram(
+            "pipeline_stage_item_duration_seconds",
+            "Time to process one stage work item (a record for submitted, a batch otherwise)", ("stage",)
+        )
+        self.stage_queue_depth = self.gauge(
+            "pipeline_stage_queue_depth", "Work items waiting for a stage executor slot", ("stage",)
+        )
+        self.cycle_seconds = self.histogram(
+            "pipeline_cycle_duration_seconds", "Duration of a poll cycle (submitted and refused stages)"
+        )
+        self.poll_interval_seconds = self.gauge(
+            "pipeline_poll_interval_seconds", "Current interval between poll cycles"
+        )
+        self.webhook_requests = self.counter(
+            "webhook_requests_total", "n8n webhook calls by URL and outcome", ("url", "outcome")
+        )
+        self.outbox_pending = self.gauge(
+            "webhook_outbox_pending", "Webhooks waiting in the outbox"
+        )
+        self.invites_attempted = self.counter(
+            "telegram_invites_attempted_total", "InviteToChannel requests sent", ("group",)
+        )
+        self.invites_succeeded = self.counter(
+            "telegram_invites_succeeded_total", "Users added to a group", ("group",)
+        )
+        self.removals = self.counter(
+            "telegram_removals_total", "Users removed from a group by outcome", ("outcome",)
+        )
+        self.flood_errors = self.counter(
+            "telegram_flood_errors_total", "FloodWait and PeerFlood errors", ("account", "kind", "error")
+        )
+        self.flood_wait_seconds = self.counter(
+            "telegram_flood_wait_seconds_total", "Seconds Telegram asked us to wait", ("account", "kind")
+        )
+        self.transitions = self.counter(
+            "record_transitions_total", "Record status transitions by outcome", ("from_status", "to_status", "outcome")
+        )
+        self.transition_seconds = self.histogram(
+            "record_transition_duration_seconds", "Time from starting a status transition to storing it in Teable",
+            ("from_status", "to_status")
+        )
+        self.transitions_in_flight = self.gauge(
+            "record_transitions_in_flight", "Status transitions started but not yet stored in Teable"
+        )
+        self.partitions_owned = self.gauge(
+            "replica_partitions_owned", "Record partitions this replica holds a lease on"
+        )
+
+metrics = PipelineMetrics()
+
+class MetricsServer:
+    """Serves metrics.render() at /metrics from a background HTTP server thread"""
+    def __init__(self, registry, host="127.0.0.1", port=9108):
+        registry_ref = registry
+
+        class Handler(BaseHTTPRequestHandler):
+            def do_GET(self):
+                if self.path.split("?")[0] != "/metrics":
+                    self.send_error(404)
+                    return
+                body = registry_ref.render().encode()
+                self.send_response(200)
+                self.send_header("Content-Type", "text/plain; version=0.0.4; charset=utf-8")
+                self.send_header("Content-Length", str(len(body)))
+                self.end_headers()
+                self.wfile.write(body)
+
+            def log_message(self, format, *args):
+                pass
+
+        self.httpd = ThreadingHTTPServer((host, port), Handler)
+        self.httpd.daemon_threads = True
+        self._thread = threading.Thread(target=self.httpd.serve_forever, name="metrics-server", daemon=True)
+
+    def start(self):
+        self._thread.start()
+        host, port = self.httpd.server_address[:2]
+        logger.info(f"Metrics available at http://{host}:{port}/metrics")
+
+    def stop(self):
+        self.httpd.shutdown()
+        self.httpd.server_close()
+
 class ConfigurationError(Exception):
     """Custom exception for configuration-related errors"""
     pass
 
+class InvalidTransitionError(Exception):
+    """Raised when a record is moved between statuses the state machine does not allow"""
+    pass
+
 class ProcessedIdsStorage:
-    def __init__(self, filename="processed_ids.json"):
+    """
+    Tracks which Telegram IDs have been processed for each action type.
+
+    Membership lives in in-memory sets. Each new mark is appended and fsynced to
+    a JSON-lines log next to the snapshot file, and the log is folded into the
+    snapshot once it holds compact_after entries. The snapshot is replaced
+    atomically and a torn last log line is ignored on load, so a crash at any
+    point recovers to a consistent state.
+    """
+    ACTION_TYPES = ("added", "removed", "webhook_received", "webhook_accepted")
+
+    def __init__(self, filename="processed_ids.json", compact_after=1000):
         self.filename = filename
+        self.compact_after = compact_after
+        self._lock = threading.Lock()
+        self._log = JsonLinesLog(f"{os.path.splitext(filename)[0]}.log")
         self.processed_ids = self._load_processed_ids()
+        if not self._log.is_empty():
+            self._compact()
 
     def _load_processed_ids(self):
-        """Load processed IDs from storage file"""
+        """Load processed IDs from the snapshot file and replay the append-only log"""
+        processed_ids = {action_type: set() for action_type in self.ACTION_TYPES}
         try:
             if os.path.exists(self.filename):
                 with open(self.filename, 'r') as f:
-                    return json.load(f)
-            return {"added": [], "removed": [], "webhook_received": [], "webhook_accepted": []}
+                    for action_type, ids in json.load(f).items():
+                        processed_ids.setdefault(action_type, set()).update(ids)
         except Exception as e:
             logger.error(f"Error loading processed IDs: {str(e)}")
-            return {"added": [], "removed": [], "webhook_received": [], "webhook_accepted": []}
 
-    def _save_processed_ids(self):
-        """Save processed IDs to storage file"""
+        for entry in self._log.replay():
+            if "action" in entry and "id" in entry:
+                processed_ids.setdefault(entry["action"], set()).add(entry["id"])
+        return processed_ids
+
+    def _compact(self):
+        """Fold the log into an atomically written snapshot and empty the log"""
         try:
-            with open(self.filename, 'w') as f:
-                json.dump(self.processed_ids, f)
+            write_json_atomic(self.filename, {action_type: sorted(ids, key=str) for action_type, ids in self.processed_ids.items()})
+            # Emptying the log after the snapshot is in place is safe: replaying the old log is idempotent
+            self._log.rewrite()
+            logger.debug("Compacted processed IDs into %s", self.filename)
         except Exception as e:
             logger.error(f"Error saving processed IDs: {str(e)}")
 
+    def close(self):
+        """Compact the log and release the file handle"""
+        with self._lock:
+            if self._log.entries:
+                self._compact()
+            self._log.close()
+
     def is_processed(self, telegram_id: int, action_type: str) -> bool:
         """Check if a Telegram ID has been processed for a specific action"""
-        return telegram_id in self.processed_ids.get(action_type, [])
+        return telegram_id in self.processed_ids.get(action_type, ())
 
     def mark_as_processed(self, telegram_id: int, action_type: str):
         """Mark a Telegram ID as processed for a specific action"""
-        if action_type not in self.processed_ids:
-            self.processed_ids[action_type] = []
-        if telegram_id not in self.processed_ids[action_type]:
-            self.processed_ids[action_type].append(telegram_id)
-            self._save_processed_ids()
-            logger.debug(f"Marked Telegram ID {telegram_id} as processed for {action_type}")
+        with self._lock:
+            ids = self.processed_ids.setdefault(action_type, set())
+            if telegram_id in ids:
+                return
+            ids.add(telegram_id)
+            try:
+                self._log.append({"action": action_type, "id": telegram_id})
+            except Exception as e:
+                logger.error(f"Error saving processed IDs: {str(e)}")
+            if self._log.entries >= self.compact_after:
+                self._compact()
+        logger.debug("Marked Telegram ID %s as processed for %s", telegram_id, action_type, extra=SAMPLED)
+
+def normalize_telegram_id(value):
+    """Normalize a Telegram ID from Teable into a canonical string key"""
+    if value is None:
+        return None
+    text = str(value).strip()
+    if not text:
+        return None
+    try:
+        return str(int(text))
+    except ValueError:
+        pass
+    # Number fields can come back as floats, e.g. 812970760.0
+    try:
+        number = float(text)
+        if number.is_integer():
+            return str(int(number))
+    except (ValueError, OverflowError):
+        pass
+    return text
+
+class TelegramIdIndex:
+    """
+    In-memory index of Telegram IDs to the record that owns them, for O(1) duplicate checks.
+
+    Entries added from "telegram" records persist until the index is rebuilt.
+    Claims made by submitted records only last for the current cycle, see
+    reset_claims(). With `group_of` (e.g. GroupRouter.route) IDs are indexed
+    per target group, so the same user may apply to several groups.
+    """
+    def __init__(self, group_of=None):
+        self.group_of = group_of
+        self._record_ids = {}
+        self._claims = {}
+
+    @classmethod
+    def from_records(cls, records, group_of=None):
+        """Build an index from an iterable of Teable records"""
+        index = cls(group_of)
+        index.update(records)
+        logger.debug("Built Telegram ID index with %d entries", len(index))
+        return index
+
+    def __len__(self):
+        return len(self._record_ids)
+
+    def update(self, records):
+        """Add "telegram" records (e.g. the ones changed since the last cycle) to the index"""
+        for record in records:
+            key = normalize_telegram_id(record.get("fields", {}).get("fldtDljIL5MBhcwoms4"))
+            if key is not None and record.get("id"):
+                group_id = self.group_of(record) if self.group_of else None
+                self._record_ids.setdefault((group_id, key), record.get("id"))
+
+    def add(self, telegram_id, record_id, group_id=None):
+        """Claim a Telegram ID for a submitted record for the rest of this cycle (the first owner wins)"""
+        key = normalize_telegram_id(telegram_id)
+        if key is not None and record_id:
+            self._claims.setdefault((group_id, key), record_id)
+
+    def reset_claims(self):
+        """Forget the claims made by submitted records during the previous cycle"""
+        self._claims.clear()
+
+    def find_duplicate(self, telegram_id, record_id, group_id=None):
+        """Return the ID of another record already holding this Telegram ID in the group, or None"""
+        key = (group_id, normalize_telegram_id(telegram_id))
+        existing_record_id = self._record_ids.get(key) or self._claims.get(key)
+        if existing_record_id and existing_record_id != record_id:
+            return existing_record_id
+        return None
+
+class GroupRouter:
+    """
+    Maps Teable records to the Telegram group they belong to.
+
+    Groups are read from TELEGRAM_GROUPS_FILE, a JSON file like:
+
+        {"groups": {"main": {"id": 123, "hash": 456}, "vip": {"id": 789}},
+         "default": "main",
+         "field": "fldGroupField",
+         "rules": [{"field": "fldPlan", "equals": "VIP", "group": "vip"}]}
+
+    Rules are checked in order, then the value of `field` (a group name or
+    group ID), then the default group. Without the file the single group from
+    TELGRAM_GROUP_ID / TELEGRAM_GROUP_HASH is the default and TELEGRAM_GROUP_FIELD_ID
+    can still route records to it by ID. `hash` is the access hash of the primary
+    account and is only used when the group can't be resolved.
+    """
+    def __init__(self, groups, default_group_id, field_id=None, rules=None, groups_file=None):
+        self.groups = groups
+        self.default_group_id = default_group_id
+        self.field_id = field_id
+        self.rules = rules or []
+        self.groups_file = groups_file
+        self._ids_by_name = {group["name"].lower(): group_id for group_id, group in groups.items()}
+
+    @classmethod
+    def from_env(cls):
+        """Build the router from TELEGRAM_GROUPS_FILE or the single-group settings"""
+        groups_file = get_required_env_var("TELEGRAM_GROUPS_FILE", required=False)
+        field_id = get_required_env_var("TELEGRAM_GROUP_FIELD_ID", required=False)
+        if not groups_file:
+            group_id = get_required_env_var("TELGRAM_GROUP_ID", convert_func=int)
+            group_hash = os.getenv("TELEGRAM_GROUP_HASH")
+            groups = {group_id: {"name": str(group_id), "id": group_id, "hash": int(group_hash) if group_hash else None}}
+            return cls(groups, group_id, field_id=field_id)
 
-class TeablePoller:
-    def __init__(self):
         try:
-            self.base_url = get_required_env_var("BASE_URL")
-            self.api_token = get_required_env_var("TEABLE_API_TOKEN")
-            self.table_id = get_required_env_var("TEABLE_TABLE_ID")
-            self.telegram_group_id = get_required_env_var("TELGRAM_GROUP_ID")
-            
-            self.n8n_webhook_received_url = get_required_env_var("N8N_WEBHOOK_RECEIVED_URL", required=False)
-            self.n8n_webhook_accepted_url = get_required_env_var("N8N_WEBHOOK_ACCEPTED_URL", required=False)
-            self.n8n_webhook_test_received_url = get_required_env_var("N8N_WEBHOOK_TEST_RECEIVED_URL", required=False)
-            self.n8n_webhook_test_accepted_url = get_required_env_var("N8N_WEBHOOK_TEST_ACCEPTED_URL", required=False)
-        except ValueError as e:
-            logger.error(f"Configuration Error: {e}")
-            sys.exit(1)
-        
-        self.headers = {
-            "Authorization": f"Bearer {self.api_token}",
-            "Accept": "application/json"
-        }
-        
-        # Log configuration
-        logger.info(f"TeablePoller initialized with group ID: {self.telegram_group_id}")
-        logger.debug("Webhook URLs configured:")
-        logger.debug(f"- Received: {self.n8n_webhook_received_url}")
-        logger.debug(f"- Accepted: {self.n8n_webhook_accepted_url}")
-        logger.debug(f"- Test Received: {self.n8n_webhook_test_received_url}")
-        logger.debug(f"- Test Accepted: {self.n8n_webhook_test_accepted_url}")
+            with open(groups_file, 'r') as f:
+                config = json.load(f)
+            groups = {}
+            for name, group in config["groups"].items():
+                group_id = int(group["id"])
+                groups[group_id] = {"name": name, "id": group_id, "hash": int(group["hash"]) if group.get("hash") else None}
+            default_name = config.get("default") or next(iter(config["groups"]))
+            default_group_id = int(config["groups"][default_name]["id"])
+        except (OSError, ValueError, KeyError, TypeError, StopIteration) as e:
+            raise ConfigurationError(f"Invalid TELEGRAM_GROUPS_FILE {groups_file}: {str(e)}")
 
-    def is_valid_telegram_id(self, telegram_id):
-        """Validate Telegram ID"""
+        router = cls(groups, default_group_id, field_id=config.get("field") or field_id, groups_file=groups_file)
+        for rule in config.get("rules", []):
+            group_id = router.lookup(rule.get("group"))
+            if group_id is None or not rule.get("field"):
+                raise ConfigurationError(f"Invalid routing rule in {groups_file}: {rule}")
+            router.rules.append({"field": rule["field"], "equals": rule.get("equals"), "group_id": group_id})
+        return router
+
+    def __len__(self):
+        return len(self.groups)
+
+    def lookup(self, value):
+        """Return the group ID for a group name or ID, or None if it is not configured"""
+        if value is None or value == "":
+            return None
+        if isinstance(value, list):
+            value = value[0] if value else None
+            return self.lookup(value)
+        if isinstance(value, dict):
+            return self.lookup(value.get("title") or value.get("name") or value.get("id"))
+        group_id = self._ids_by_name.get(str(value).strip().lower())
+        if group_id is not None:
+            return group_id
         try:
-            id_int = int(telegram_id)
-            return id_int > 0
-        except (ValueError, TypeError):
-            logger.warning(f"Invalid Telegram ID format: {telegram_id}")
-            return False
+            group_id = int(str(value).strip())
+        except ValueError:
+            return None
+        return group_id if group_id in self.groups else None
 
-    def get_records_with_filter(self, status):
-        """Fetch records with specific status"""
-        url = f"{self.base_url}/table/{self.table_id}/record"
-        filter_params = {
-            "fieldKeyType": "id",
-            "filter": json.dumps({"conjunction":"and","filterSet":[{"fieldId":"fldE151819s5A2x1fnH","operator":"is","value":status}]})
-        }
+    def route(self, record):
+        """Return the ID of the group a Teable record belongs to, or None if it can't be routed"""
+        fields = record.get("fields", {})
+        for rule in self.rules:
+            value = fields.get(rule["field"])
+            if rule["equals"] is None or str(value) == str(rule["equals"]):
+                if value is not None:
+                    return rule["group_id"]
+        if self.field_id and fields.get(self.field_id) not in (None, ""):
+            group_id = self.lookup(fields.get(self.field_id))
+            if group_id is None:
+                logger.warning(f"Record {record.get('id')} names unknown group {fields.get(self.field_id)!r}")
+            return group_id
+        return self.default_group_id
+
+    @property
+    def field_ids(self):
+        """The Teable fields routing reads, so record fetches can include them"""
+        field_ids = [rule["field"] for rule in self.rules]
+        if self.field_id:
+            field_ids.append(self.field_id)
+        return list(dict.fromkeys(field_ids))
+
+    def processed_key(self, telegram_id, group_id):
+        """Key for ProcessedIdsStorage; the default group keeps plain Telegram IDs"""
+        if group_id is None or group_id == self.default_group_id:
+            return telegram_id
+        return f"{telegram_id}@{group_id}"
+
+def parse_timestamp(value):
+    """Parse an ISO-8601 timestamp from Teable into an aware datetime, or None"""
+    if not value:
+        return None
+    try:
+        parsed = datetime.fromisoformat(str(value).replace("Z", "+00:00"))
+    except ValueError:
+        return None
+    if parsed.tzinfo is None:
+        parsed = parsed.replace(tzinfo=timezone.utc)
+    return parsed
+
+def write_atomic(filename, write):
+    """Write a file with write(f) into a temporary file and atomically move it into place"""
+    tmp_filename = f"{filename}.tmp"
+    with open(tmp_filename, 'w') as f:
+        write(f)
+        f.flush()
+        os.fsync(f.fileno())
+    os.replace(tmp_filename, filename)
+
+def write_json_atomic(filename, data):
+    """Write JSON to a temporary file and atomically move it into place"""
+    write_atomic(filename, functools.partial(json.dump, data))
+
+class JsonLinesLog:
+    """
+    Append-only JSON-lines file whose entries are fsynced one at a time.
+
+    A crash can only tear the last line, so replay() stops there. Owners rewrite()
+    the file on startup, so new entries never follow a torn line, and whenever
+    they fold it into a snapshot.
+    """
+    def __init__(self, filename):
+        self.filename = filename
+        self.entries = 0
+        self._file = None
+
+    def is_empty(self):
+        return not os.path.exists(self.filename) or os.path.getsize(self.filename) == 0
+
+    def replay(self):
+        """Yield the logged entries (dicts) in order"""
+        if not os.path.exists(self.filename):
+            return
+        with open(self.filename, 'r') as f:
+            for line in f:
+                try:
+                    entry = json.loads(line)
+                except ValueError:
+                    entry = None
+                if not isinstance(entry, dict):
+                    logger.warning(f"Ignoring corrupt entry in {self.filename}")
+                    return
+                self.entries += 1
+                yield entry
+
+    def append(self, entry):
+        """Durably append one entry"""
+        if self._file is None:
+            self._file = open(self.filename, 'a')
+        self._file.write(json.dumps(entry) + "\n")
+        self._file.flush()
+        os.fsync(self._file.fileno())
+        self.entries += 1
+
+    def rewrite(self, entries=()):
+        """Atomically replace the file with the given entries"""
+        def write(f):
+            for entry in entries:
+                f.write(json.dumps(entry) + "\n")
+        self.close()
+        write_atomic(self.filename, write)
+        self.entries = len(entries)
+
+    def close(self):
+        if self._file is not None:
+            self._file.close()
+            self._file = None
+
+class SyncStateStorage:
+    """Persists the incremental sync high-water mark across restarts"""
+    def __init__(self, filename="sync_state.json"):
+        self.filename = filename
+        self.state = self._load_state()
+
+    def _load_state(self):
+        """Load sync state from storage file"""
         try:
-            logger.debug(f"Fetching {status} records from: {url}")
-            logger.debug(f"Filter params: {json.dumps(filter_params)}")
-            response = requests.get(url, headers=self.headers, params=filter_params)
-            response.raise_for_status()
-            response_data = response.json()
-            logger.debug(f"API Response: {json.dumps(response_data)}")
-            records = response_data.get("records", [])
-            
-            # Log the actual status values we're getting back
-            if records:
-                statuses = [r.get("fields", {}).get("fldE151819s5A2x1fnH") for r in records]
-                logger.debug(f"Status values in response: {statuses}")
-            
-            total_records = len(records)
-            logger.info(f"Fetched {total_records} {status} records")
-            
-            if len(records) > 0:
-                logger.debug(f"Sample record fields: {records[0].get('fields', {})}")
-            return records
-        except requests.exceptions.RequestException as e:
-            logger.error(f"Error fetching {status} records: {str(e)}")
-            return []
+            if os.path.exists(self.filename):
+                with open(self.filename, 'r') as f:
+                    return json.load(f)
+            return {}
+        except Exception as e:
+            logger.error(f"Error loading sync state: {str(e)}")
+            return {}
 
-    def update_double_status(self, record_id: str, telegram_id: str):
-        """Update a record to double status"""
-        url = f"{self.base_url}/table/{self.table_id}/record"
-        payload = {
-            "fieldKeyType": "id",
-            "typecast": True,
-            "records": [{
-                "id": record_id,
-                "fields": {
-                    "fldE151819s5A2x1fnH": "double",
-                    "fldtDljIL5MBhcwoms4": f"double_{telegram_id}"
-                }
-            }]
-        }
-        
+    def get(self, key, default=None):
+        return self.state.get(key, default)
+
+    def update(self, **values):
+        """Update and persist sync state values"""
+        self.state.update(values)
         try:
-            logger.debug(f"Updating record {record_id} to double status")
-            response = requests.patch(url, headers=self.headers, json=payload)
-            response.raise_for_status()
-            logger.info(f"Successfully updated record {record_id} to double status")
-            return True
-        except requests.exceptions.RequestException as e:
-            logger.error(f"Failed to update record to double status: {str(e)}")
-            if hasattr(e, 'response') and e.response is not None:
-                logger.error(f"Error response body: {e.response.text}")
-            return False
+            write_json_atomic(self.filename, self.state)
+        except Exception as e:
+            logger.error(f"Error saving sync state: {str(e)}")
 
-    def update_status(self, record_ids: list, new_status: str):
-        """Update the status of multiple records"""
-        url = f"{self.base_url}/table/{self.table_id}/record"
-        records = [{"id": record_id, "fields": {"fldE151819s5A2x1fnH": new_status}} for record_id in record_ids]
-        
-        payload = {
-            "fieldKeyType": "id",
-            "typecast": True,
-            "records": records
-        }
-        
+class TransitionJournal:
+    """
+    Write-ahead journal of the record transitions that are still in flight.
+
+    Each begin, applied (the Telegram call went through), commit and abort is
+    appended and fsynced as a JSON line before the caller moves on, so replaying
+    the file yields the transitions that were open when the process stopped.
+    Once compact_after transitions have closed, the file is rewritten atomically
+    with only the open ones.
+    """
+    def __init__(self, filename="transition_journal.log", compact_after=1000):
+        self.filename = filename
+        self.compact_after = compact_after
+        self._log = JsonLinesLog(filename)
+        self._closed_count = 0
+        self.open_transitions = self._load()
+        if not self._log.is_empty():
+            self._compact()
+
+    def _load(self):
+        """Replay the journal into a dict of open transitions keyed by record ID"""
+        open_transitions = {}
+        for entry in self._log.replay():
+            op, record_id = entry.pop("op", None), entry.get("record_id")
+            if op == "begin":
+                open_transitions[record_id] = entry
+            elif op == "applied":
+                if record_id in open_transitions:
+                    open_transitions[record_id]["applied"] = True
+            else:
+                open_transitions.pop(record_id, None)
+        return open_transitions
+
+    def append(self, op, transition):
+        """Durably record one step of a transition"""
+        if op == "begin":
+            self.open_transitions[transition["record_id"]] = dict(transition)
+        elif op == "applied":
+            self.open_transitions[transition["record_id"]]["applied"] = True
+        else:
+            self.open_transitions.pop(transition["record_id"], None)
+        entry = {"op": op, **transition} if op == "begin" else {"op": op, "record_id": transition["record_id"]}
         try:
-            logger.debug(f"Updating status to '{new_status}' for records: {record_ids}")
-            logger.debug(f"Status update payload: {json.dumps(payload)}")
-            response = requests.patch(url, headers=self.headers, json=payload)
-            response.raise_for_status()
-            logger.info(f"Successfully updated {len(record_ids)} records to status '{new_status}'")
-            logger.debug(f"Status update response: {response.text}")
-            return True
-        except requests.exceptions.RequestException as e:
-            logger.error(f"Failed to update record status: {str(e)}")
-            if hasattr(e, 'response') and e.response is not None:
-                logger.error(f"Error response body: {e.response.text}")
-            return False
+            self._log.append(entry)
+        except Exception as e:
+            logger.error(f"Error writing transition journal: {str(e)}")
+        if op in ("commit", "abort"):
+            self._closed_count += 1
+            if self._closed_count >= self.compact_after:
+                self._compact()
 
-    def call_webhook(self, webhook_url: str, payload: dict, is_test: bool = False):
-        """Call a webhook with the given payload"""
+    def _compact(self):
+        """Rewrite the journal with only the open transitions"""
         try:
-            logger.debug(f"Calling {'test ' if is_test else ''}webhook: {webhook_url}")
-            logger.debug(f"Sending webhook request to {webhook_url} with payload: {json.dumps(payload)}")
-            response = requests.post(
-                webhook_url, 
-                json=payload, 
-                headers={"Content-Type": "application/json"}
-            )
-            response.raise_for_status()
-            logger.info(f"Successfully called {'test ' if is_test else ''}webhook with status code {response.status_code}")
-            logger.debug(f"Webhook response: {response.text}")
-            return True
-        except requests.exceptions.RequestException as e:
-            logger.warning(f"Error calling {'test ' if is_test else ''}webhook: {str(e)}")
-            return False
+            self._log.rewrite([{"op": "begin", **transition} for transition in self.open_transitions.values()])
+            self._closed_count = 0
+        except Exception as e:
+            logger.error(f"Error compacting transition journal: {str(e)}")
 
-    def get_approved_records(self, processed_storage):
-        """Get approved records that need processing"""
-        # Get approved records and check for telegram username
-        records = self.get_records_with_filter("approved")
-        approved_records = []
+    def close(self):
+        """Compact the journal and release the file handle"""
+        if self._closed_count:
+            self._compact()
+        self._log.close()
 
-        logger.debug(f"Processing {len(records)} approved records")
-        for record in records:
-            fields = record.get("fields", {})
-            telegram_id = fields.get("fldtDljIL5MBhcwoms4")  # This is the actual field name from Teable
-            telegram_username = fields.get("fldt5LbTEuUWxq7iboV", "")  # This appears to be the username field
-            record_id = record.get("id")
+class RecordStateMachine:
+    """
+    The record status transitions the service performs, timed from start to commit.
 
-            logger.debug(f"Processing approved record {record_id} with telegram_id: {telegram_id}, username: {telegram_username}")
-            if telegram_id:
-                try:
-                    telegram_id = int(telegram_id)
-                    if telegram_id > 0:
-                        approved_records.append({
-                            "telegram_id": telegram_id,
-                            "telegram_username": telegram_username,  # Keep this for the webhook payload
-                            "record_id": record_id
-                        })
-                        logger.debug(f"Added record {record_id} to approved records with telegram_id: {telegram_id}")
-                    else:
-                        logger.warning(f"Skipping record {record_id} with non-positive Telegram ID: {telegram_id}")
-                except (ValueError, TypeError):
-                    logger.warning(f"Skipping record {record_id} with invalid Telegram ID format: {telegram_id}")
-            else:
-                logger.warning(f"Skipping record {record_id} with missing Telegram ID")
+    begin() opens a transition before any side effect, applied() records that
+    the Telegram call behind it went through, and commit() closes it once the
+    new status is stored in Teable (the StatusWriter calls it after each flush).
+    Transitions with a Telegram side effect are also written to the journal, so
+    after a crash they can be finished or rolled back instead of repeating the
+    RPC (see RecordPipeline.reconcile_in_flight).
+    """
+    TRANSITIONS = {
+        "submitted": ("pending", "double"),
+        "approved": ("telegram", "invited"),
+        "invited": ("blocked", "approved"),
+        "refused": ("removed",),
+        # Members missing from the group are sent back to the invite stage (MembershipReconciler)
+        "telegram": ("approved",)
+    }
+    JOURNALED = {("approved", "telegram"), ("approved", "invited"), ("refused", "removed")}
 
-        logger.info(f"Found {len(approved_records)} approved records to process")
-        return approved_records
+    def __init__(self, journal=None):
+        self.journal = journal
+        self._lock = threading.Lock()
+        # Called with the record ID when a transition is committed or aborted
+        self.on_close = None
+        self._open = {}
+        if journal is not None:
+            self._open = {record_id: dict(transition) for record_id, transition in journal.open_transitions.items()}
+        metrics.transitions_in_flight.set(len(self._open))
 
-    def get_refused_records(self, processed_storage):
-        """Get refused records that need processing"""
-        records = self.get_records_with_filter("refused")  # Get all refused records
-        refused_records = []
+    def _journaled(self, transition):
+        return self.journal is not None and (transition["from"], transition["to"]) in self.JOURNALED
 
-        for record in records:
-            fields = record.get("fields", {})
-            telegram_id = fields.get("fldtDljIL5MBhcwoms4")  # This is the actual field name from Teable
-            telegram_username = fields.get("fldt5LbTEuUWxq7iboV", "")  # This appears to be the username field
-            record_id = record.get("id")
+    def begin(self, record_id, from_status, to_status, **context):
+        """Open a transition for a record, replacing any transition still open for it"""
+        if to_status not in self.TRANSITIONS.get(from_status, ()):
+            raise InvalidTransitionError(f"Record {record_id} cannot move from {from_status} to {to_status}")
+        transition = {
+            "record_id": record_id,
+            "from": from_status,
+            "to": to_status,
+            "started": time.time(),
+            "applied": False,
+            "context": context
+        }
+        with self._lock:
+            previous = self._open.pop(record_id, None)
+            if previous is not None:
+                self._close(previous, "superseded")
+            self._open[record_id] = transition
+            if self._journaled(transition):
+                self.journal.append("begin", transition)
+            metrics.transitions_in_flight.set(len(self._open))
+        return transition
 
-            if telegram_id and self.is_valid_telegram_id(telegram_id):
-                telegram_id = int(telegram_id)
-                refused_records.append({
-                    "telegram_id": telegram_id,
-                    "telegram_username": telegram_username,
-                    "record_id": record_id
-                })
-            else:
-                logger.warning(f"Skipping record {record_id} with invalid Telegram ID: {telegram_id}")
+    def applied(self, record_id):
+        """Record that the side effect of a record's open transition went through"""
+        with self._lock:
+            transition = self._open.get(record_id)
+            if transition is None or transition["applied"]:
+                return
+            transition["applied"] = True
+            if self._journaled(transition):
+                self.journal.append("applied", transition)
 
-        logger.info(f"Found {len(refused_records)} refused records to process")
-        return refused_records
+    def is_applied(self, record_id, to_status):
+        """Whether a record has an open transition to to_status whose side effect already went through"""
+        with self._lock:
+            transition = self._open.get(record_id)
+            return transition is not None and transition["to"] == to_status and transition["applied"]
 
-class TelegramGroupManager:
-    def __init__(self):
-        self.last_user_add_time = 0
-        self.add_user_lock = threading.Lock()
-        self.add_user_event = threading.Event()
+    def transition_key(self, record_id):
+        """
+        A key naming a record's open transition, or None.
+
+        It stays the same while the transition is replayed (after a failed status
+        write or a restart), so the webhooks it sends can be keyed on it.
+        """
+        with self._lock:
+            transition = self._open.get(record_id)
+        if transition is None:
+            return None
+        return f"{record_id}@{int(transition['started'] * 1000)}"
+
+    def commit(self, statuses):
+        """Close the open transitions whose new status (record ID -> status) is now stored in Teable"""
+        with self._lock:
+            for record_id, status in statuses.items():
+                transition = self._open.get(record_id)
+                if transition is not None and transition["to"] == status:
+                    del self._open[record_id]
+                    self._close(transition, "committed")
+            metrics.transitions_in_flight.set(len(self._open))
+
+    def abort(self, record_id, reason):
+        """Close a record's open transition without the new status"""
+        with self._lock:
+            transition = self._open.pop(record_id, None)
+            if transition is not None:
+                logger.debug("Transition of record %s to %s aborted: %s", record_id, transition["to"], reason)
+                self._close(transition, "aborted")
+            metrics.transitions_in_flight.set(len(self._open))
+
+    def write_failed(self, record_ids):
+        """Abort the open transitions of records whose status could not be written
+
+        Applied transitions stay open: the Telegram side is done, so the next
+        attempt only needs to store the status again.
+        """
+        for record_id in record_ids:
+            with self._lock:
+                transition = self._open.get(record_id)
+                applied = transition is not None and transition["applied"]
+            if transition is not None and not applied:
+                self.abort(record_id, "status update failed")
+
+    def in_flight(self):
+        """Copies of the open transitions"""
+        with self._lock:
+            return [dict(transition) for transition in self._open.values()]
+
+    def _close(self, transition, outcome):
+        from_status, to_status = transition["from"], transition["to"]
+        metrics.transitions.inc(from_status=from_status, to_status=to_status, outcome=outcome)
+        if outcome == "committed":
+            duration = time.time() - transition["started"]
+            metrics.transition_seconds.observe(duration, from_status=from_status, to_status=to_status)
+            logger.debug("Record %s moved from %s to %s in %.2f seconds", transition["record_id"], from_status, to_status, duration, extra=SAMPLED)
+        if self._journaled(transition):
+            self.journal.append("commit" if outcome == "committed" else "abort", transition)
+        if self.on_close is not None and outcome != "superseded":
+            self.on_close(transition["record_id"])
+
+    def close(self):
+        if self.journal is not None:
+            self.journal.close()
+
+class StatusWriter:
+    """
+    Buffers record field updates during a cycle and writes them as bulk PATCHes.
+
+    Repeated updates to the same record are merged (later values win), and
+    flush() sends them in chunks of at most max_records_per_request. If a chunk
+    fails, its records are retried one by one so a single bad record does not
+    block the rest. Once max_pending updates are buffered, a flush is started
+    on `executor`, so callers on the event loop never wait for a PATCH.
+    """
+    def __init__(self, poller, max_records_per_request=100, max_pending=5000, max_retries=2, executor=None):
+        self.poller = poller
+        self.max_records_per_request = max(1, max_records_per_request)
+        self.max_pending = max_pending
+        self.max_retries = max_retries
+        self.executor = executor
+        self._pending = {}
+        self._lock = threading.Lock()
+        # One flush at a time, so a later update of a record can't be overtaken by an earlier one
+        self._flush_lock = threading.Lock()
+        self._early_flush = None
+
+    def __len__(self):
+        with self._lock:
+            return len(self._pending)
+
+    def queue(self, record_id, fields):
+        """Buffer field updates for a record"""
+        with self._lock:
+            self._pending.setdefault(record_id, {}).update(fields)
+            should_flush = (self.max_pending and len(self._pending) >= self.max_pending
+                            and (self._early_flush is None or self._early_flush.done()))
+            if should_flush and self.executor is not None:
+                self._early_flush = self.executor.submit(self._flush_early)
+        if should_flush:
+            logger.debug("Status writer reached %d pending updates, flushing early", self.max_pending)
+            if self.executor is None:
+                self.flush()
+
+    def _flush_early(self):
+        try:
+            self.flush()
+        except Exception as e:
+            logger.error(f"Error flushing status updates: {str(e)}")
+            logger.error(traceback.format_exc())
+
+    def set_status(self, record_id, new_status):
+        """Buffer a status change for a record"""
+        self.queue(record_id, {STATUS_FIELD_ID: new_status})
+
+    def set_double_status(self, record_id, telegram_id):
+        """Buffer the updates that mark a record as a duplicate"""
+        self.queue(record_id, TeablePoller.double_status_fields(telegram_id))
+
+    def flush(self):
+        """Write all buffered updates. Returns the set of record IDs that could not be written."""
+        with self._flush_lock:
+            return self._flush()
+
+    def _flush(self):
+        with self._lock:
+            pending, self._pending = self._pending, {}
+        if not pending:
+            return set()
+
+        failed_ids = set()
+        request_count = 0
+        for chunk in batched(pending.items(), self.max_records_per_request):
+            records = [{"id": record_id, "fields": fields} for record_id, fields in chunk]
+            request_count += 1
+            if self.poller.patch_records(records):
+                continue
+
+            # Retry per record so one bad record doesn't fail the whole chunk
+            logger.warning(f"Bulk update of {len(records)} records failed, retrying individually")
+            for record in records:
+                for attempt in range(self.max_retries):
+                    request_count += 1
+                    if self.poller.patch_records([record]):
+                        break
+                    time.sleep(0.5 * (attempt + 1))
+                else:
+                    failed_ids.add(record["id"])
+
+        logger.info(f"Wrote {len(pending) - len(failed_ids)} record updates in {request_count} requests")
+        self.poller.state_machine.commit({
+            record_id: fields.get(STATUS_FIELD_ID)
+            for record_id, fields in pending.items() if record_id not in failed_ids
+        })
+        self.poller.state_machine.write_failed(failed_ids)
+        if failed_ids:
+            logger.error(f"Failed to update {len(failed_ids)} records: {sorted(failed_ids)}")
+        return failed_ids
+
+class WebhookOutbox:
+    """
+    Durable SQLite outbox for n8n webhooks with at-least-once delivery.
+
+    enqueue() stores the payload before anything is sent; a pool of worker
+    threads then delivers due entries, trying each URL in order (test webhook
+    first) and retrying failures with exponential backoff and full jitter.
+    Every request carries an Idempotency-Key header so n8n can drop repeats.
+    Entries that keep failing, or fail with a permanent status, are moved to
+    the dead-letter queue (status 'dead') and can be requeued from the CLI.
+    """
+    def __init__(self, session, db_path="webhook_outbox.db", workers=4, max_attempts=8, base_delay=2.0, max_delay=600.0):
+        self.session = session
+        self.db_path = db_path
+        self.workers = max(1, workers)
+        self.max_attempts = max_attempts
+        self.base_delay = base_delay
+        self.max_delay = max_delay
+        self._handlers = {}
+        self._lock = threading.Lock()
+        self._wakeup = threading.Event()
+        self._stopping = threading.Event()
+        self._threads = []
+        self._conn = sqlite3.connect(db_path, check_same_thread=False, isolation_level=None)
+        self._conn.row_factory = sqlite3.Row
+        self._conn.execute("PRAGMA journal_mode=WAL")
+        self._conn.execute("""
+            CREATE TABLE IF NOT EXISTS outbox (
+                id INTEGER PRIMARY KEY AUTOINCREMENT,
+                idempotency_key TEXT UNIQUE NOT NULL,
+                generation INTEGER NOT NULL DEFAULT 0,
+                kind TEXT NOT NULL,
+                urls TEXT NOT NULL,
+                payload TEXT NOT NULL,
+                record_id TEXT,
+                status TEXT NOT NULL DEFAULT 'pending',
+                attempts INTEGER NOT NULL DEFAULT 0,
+                next_attempt_at REAL NOT NULL,
+                last_error TEXT,
+                last_status_code INTEGER,
+                created_at REAL NOT NULL,
+                updated_at REAL NOT NULL
+            )
+        """)
+        self._conn.execute("CREATE INDEX IF NOT EXISTS outbox_due ON outbox (status, next_attempt_at)")
+
+    def register(self, kind, on_delivered=None, on_dead=None, permanent_statuses=()):
+        """Register callbacks and permanent-failure HTTP statuses for a kind of webhook"""
+        self._handlers[kind] = {
+            "on_delivered": on_delivered,
+            "on_dead": on_dead,
+            "permanent_statuses": set(permanent_statuses)
+        }
+
+    def enqueue(self, kind, urls, payload, idempotency_key, record_id=None, redeliver=True):
+        """
+        Durably queue a webhook. Returns False if an undelivered entry with the same
+        key is already queued; a delivered or dead entry is queued again as a new
+        generation with a fresh Idempotency-Key, unless redeliver is False (the key
+        then names a single notification that was already sent or given up on).
+        """
+        urls = [url for url in urls if url]
+        if not urls:
+            logger.warning(f"No URLs configured for {kind} webhook {idempotency_key}, dropping it")
+            return False
+        now = time.time()
+        with self._lock:
+            existing = self._conn.execute(
+                "SELECT status FROM outbox WHERE idempotency_key = ?", (idempotency_key,)
+            ).fetchone()
+            if existing is None:
+                self._conn.execute(
+                    "INSERT INTO outbox (idempotency_key, kind, urls, payload, record_id, next_attempt_at, created_at, updated_at) "
+                    "VALUES (?, ?, ?, ?, ?, ?, ?, ?)",
+                    (idempotency_key, kind, json.dumps(urls), json.dumps(payload), record_id, now, now, now)
+                )
+            elif existing["status"] in ("delivered", "dead") and redeliver:
+                self._conn.execute(
+                    "UPDATE outbox SET generation = generation + 1, urls = ?, payload = ?, status = 'pending', "
+                    "attempts = 0, next_attempt_at = ?, last_error = NULL, last_status_code = NULL, updated_at = ? "
+                    "WHERE idempotency_key = ?",
+                    (json.dumps(urls), json.dumps(payload), now, now, idempotency_key)
+                )
+            else:
+                logger.debug("Webhook %s is already %s", idempotency_key, existing["status"], extra=SAMPLED)
+                return False
+        logger.debug("Queued %s webhook %s", kind, idempotency_key, extra=SAMPLED)
+        self._wakeup.set()
+        return True
+
+    def start(self):
+        """Start the delivery workers, first releasing entries left in flight by a crash"""
+        with self._lock:
+            self._conn.execute("UPDATE outbox SET status = 'pending' WHERE status = 'in_flight'")
+        self._stopping.clear()
+        for i in range(self.workers):
+            thread = threading.Thread(target=self._worker, name=f"webhook-outbox-{i}", daemon=True)
+            thread.start()
+            self._threads.append(thread)
+        logger.info(f"Webhook outbox started with {self.workers} workers ({self.pending_count()} pending)")
+
+    def stop(self):
+        """Stop the delivery workers; undelivered entries stay queued for the next start"""
+        self._stopping.set()
+        self._wakeup.set()
+        for thread in self._threads:
+            thread.join(timeout=10)
+        self._threads = []
+
+    def has_entry(self, idempotency_key):
+        """Whether a webhook with this key was ever queued"""
+        with self._lock:
+            return self._conn.execute(
+                "SELECT 1 FROM outbox WHERE idempotency_key = ?", (idempotency_key,)
+            ).fetchone() is not None
+
+    def pending_count(self):
+        with self._lock:
+            return self._conn.execute("SELECT COUNT(*) FROM outbox WHERE status IN ('pending', 'in_flight')").fetchone()[0]
+
+    def dead_letters(self, limit=100):
+        """List entries in the dead-letter queue"""
+        with self._lock:
+            rows = self._conn.execute(
+                "SELECT id, idempotency_key, kind, record_id, attempts, last_status_code, last_error, updated_at "
+                "FROM outbox WHERE status = 'dead' ORDER BY updated_at DESC LIMIT ?", (limit,)
+            ).fetchall()
+        return [dict(row) for row in rows]
+
+    def requeue_dead(self, entry_ids=None):
+        """Move dead-lettered entries (all, or the given IDs) back to the queue"""
+        now = time.time()
+        with self._lock:
+            if entry_ids:
+                placeholders = ",".join("?" for _ in entry_ids)
+                cursor = self._conn.execute(
+                    f"UPDATE outbox SET status = 'pending', attempts = 0, next_attempt_at = ?, updated_at = ? "
+                    f"WHERE status = 'dead' AND id IN ({placeholders})", (now, now, *entry_ids)
+                )
+            else:
+                cursor = self._conn.execute(
+                    "UPDATE outbox SET status = 'pending', attempts = 0, next_attempt_at = ?, updated_at = ? "
+                    "WHERE status = 'dead'", (now, now)
+                )
+        self._wakeup.set()
+        return cursor.rowcount
+
+    def _claim_next(self):
+        """Atomically take the next due entry, or return the seconds until one is due"""
+        now = time.time()
+        with self._lock:
+            row = self._conn.execute(
+                "SELECT * FROM outbox WHERE status = 'pending' ORDER BY next_attempt_at LIMIT 1"
+            ).fetchone()
+            if row is None:
+                return None, None
+            if row["next_attempt_at"] > now:
+                return None, row["next_attempt_at"] - now
+            self._conn.execute(
+                "UPDATE outbox SET status = 'in_flight', updated_at = ? WHERE id = ?", (now, row["id"])
+            )
+        return dict(row), None
+
+    def _worker(self):
+        while not self._stopping.is_set():
+            entry, wait_time = self._claim_next()
+            if entry is None:
+                self._wakeup.wait(timeout=min(wait_time or 5.0, 5.0))
+                self._wakeup.clear()
+                continue
+            try:
+                self._deliver(entry)
+            except Exception as e:
+                logger.error(f"Unexpected error delivering webhook {entry['idempotency_key']}: {str(e)}")
+                self._schedule_retry(entry, None, str(e))
+
+    def _deliver(self, entry):
+        payload = json.loads(entry["payload"])
+        key = entry["idempotency_key"]
+        headers = {
+            "Content-Type": "application/json",
+            "Idempotency-Key": key if entry["generation"] == 0 else f"{key}#{entry['generation']}"
+        }
+        status_code, error = None, None
+        for url in json.loads(entry["urls"]):
+            try:
+                response = self.session.post(url, json=payload, headers=headers)
+                response.raise_for_status()
+                metrics.webhook_requests.inc(url=url.split("?")[0], outcome="success")
+                self._mark(entry, "delivered", response.status_code, None)
+                logger.info(f"Delivered {entry['kind']} webhook {key} with status code {response.status_code}")
+                self._notify(entry, "on_delivered", response.status_code)
+                return
+            except requests.exceptions.RequestException as e:
+                response = getattr(e, 'response', None)
+                status_code = response.status_code if response is not None else None
+                error = str(e)
+                metrics.webhook_requests.inc(url=url.split("?")[0], outcome="failure")
+                logger.warning(f"Error calling {entry['kind']} webhook {url}: {error}")
+
+        handler = self._handlers.get(entry["kind"], {})
+        permanent = status_code is not None and (
+            status_code in handler.get("permanent_statuses", ())
+            or (400 <= status_code < 500 and status_code not in (408, 429))
+        )
+        if permanent or entry["attempts"] + 1 >= self.max_attempts:
+            self._mark(entry, "dead", status_code, error)
+            logger.error(f"Webhook {key} moved to the dead-letter queue after {entry['attempts'] + 1} attempts: {error}")
+            self._notify(entry, "on_dead", status_code)
+        else:
+            self._schedule_retry(entry, status_code, error)
+
+    def _schedule_retry(self, entry, status_code, error):
+        # Exponential backoff with full jitter
+        delay = random.uniform(0, min(self.max_delay, self.base_delay * (2 ** entry["attempts"])))
+        now = time.time()
+        with self._lock:
+            self._conn.execute(
+                "UPDATE outbox SET status = 'pending', attempts = attempts + 1, next_attempt_at = ?, "
+                "last_error = ?, last_status_code = ?, updated_at = ? WHERE id = ?",
+                (now + delay, error, status_code, now, entry["id"])
+            )
+        logger.debug("Retrying webhook %s in %.1f seconds", entry['idempotency_key'], delay)
+
+    def _mark(self, entry, status, status_code, error):
+        now = time.time()
+        with self._lock:
+            self._conn.execute(
+                "UPDATE outbox SET status = ?, attempts = attempts + 1, last_error = ?, last_status_code = ?, "
+                "updated_at = ? WHERE id = ?",
+                (status, error, status_code, now, entry["id"])
+            )
+
+    def _notify(self, entry, callback_name, status_code):
+        callback = self._handlers.get(entry["kind"], {}).get(callback_name)
+        if callback is None:
+            return
+        try:
+            callback(entry["record_id"], json.loads(entry["payload"]), status_code)
+        except Exception as e:
+            logger.error(f"Error in {entry['kind']} webhook {callback_name} callback: {str(e)}")
+
+class TeablePoller:
+    def __init__(self):
+        try:
+            self.base_url = get_required_env_var("BASE_URL")
+            self.api_token = get_required_env_var("TEABLE_API_TOKEN")
+            self.table_id = get_required_env_var("TEABLE_TABLE_ID")
+            # TELGRAM_GROUP_ID is only required without a TELEGRAM_GROUPS_FILE
+            self.group_router = GroupRouter.from_env()
+            self.telegram_group_id = self.group_router.default_group_id
+            
+            self.n8n_webhook_received_url = get_required_env_var("N8N_WEBHOOK_RECEIVED_URL", required=False)
+            self.n8n_webhook_accepted_url = get_required_env_var("N8N_WEBHOOK_ACCEPTED_URL", required=False)
+            self.n8n_webhook_test_received_url = get_required_env_var("N8N_WEBHOOK_TEST_RECEIVED_URL", required=False)
+            self.n8n_webhook_test_accepted_url = get_required_env_var("N8N_WEBHOOK_TEST_ACCEPTED_URL", required=False)
+        except (ValueError, ConfigurationError) as e:
+            logger.error(f"Configuration Error: {e}")
+            sys.exit(1)
+        
+        self.headers = {
+            "Authorization": f"Bearer {self.api_token}",
+            "Accept": "application/json"
+        }
+
+        # Only the fields the pipeline reads are requested; application records also
+        # carry photos and questionnaire answers that would dominate every page
+        self.last_modified_field_id = get_required_env_var("TEABLE_LAST_MODIFIED_FIELD_ID", required=False)
+        self.first_name_field_id = get_required_env_var("TEABLE_FIRST_NAME_FIELD_ID", required=False)
+        self.projection = None
+        if get_bool_env_var("TEABLE_FIELD_PROJECTION", default=True):
+            extra_fields = get_required_env_var("TEABLE_EXTRA_FIELDS", default="", required=False)
+            self.projection = list(dict.fromkeys([
+                STATUS_FIELD_ID,
+                "fldtDljIL5MBhcwoms4",  # Telegram ID
+                "fldt5LbTEuUWxq7iboV",  # Telegram username
+                *([self.first_name_field_id] if self.first_name_field_id else []),
+                *([self.last_modified_field_id] if self.last_modified_field_id else []),
+                *self.group_router.field_ids,
+                *(field.strip() for field in extra_fields.split(",") if field.strip())
+            ]))
+
+        # One pooled keep-alive session for every Teable and webhook call. Blocking
+        # calls are offloaded to a thread pool sized like the connection pool so
+        # async callers can overlap them (see run_io).
+        self.session = create_http_session()
+        self._io_executor = ThreadPoolExecutor(
+            max_workers=get_required_env_var("HTTP_POOL_MAXSIZE", default=10, required=False, convert_func=int),
+            thread_name_prefix="teable-io"
+        )
+
+        # Durable outbox for the accepted and invite webhooks
+        self.outbox = WebhookOutbox(
+            self.session,
+            db_path=get_required_env_var("WEBHOOK_OUTBOX_DB", default="webhook_outbox.db", required=False),
+            workers=get_required_env_var("WEBHOOK_OUTBOX_WORKERS", default=4, required=False, convert_func=int),
+            max_attempts=get_required_env_var("WEBHOOK_OUTBOX_MAX_ATTEMPTS", default=8, required=False, convert_func=int),
+            max_delay=get_required_env_var("WEBHOOK_OUTBOX_MAX_DELAY_SECONDS", default=600, required=False, convert_func=float)
+        )
+        self.outbox.register("invite", on_dead=self._on_invite_webhook_dead, permanent_statuses=(500,))
+        self.outbox.register("accepted")
+
+        # Record status transitions; the ones that call Telegram are journaled so a
+        # restart can finish them instead of repeating the RPC
+        self.state_machine = RecordStateMachine(TransitionJournal(
+            get_required_env_var("TRANSITION_JOURNAL_FILE", default="transition_journal.log", required=False)
+        ))
+
+        # Buffered writer that coalesces status updates into bulk PATCHes
+        self.status_writer = StatusWriter(
+            self,
+            max_records_per_request=get_required_env_var("TEABLE_MAX_RECORDS_PER_REQUEST", default=100, required=False, convert_func=int),
+            max_pending=get_required_env_var("STATUS_WRITER_MAX_PENDING", default=5000, required=False, convert_func=int),
+            executor=self._io_executor
+        )
+
+        # Pagination settings for record fetches (Teable caps `take` at 1000)
+        self.page_size = min(max(get_required_env_var("TEABLE_PAGE_SIZE", default=1000, required=False, convert_func=int), 1), 1000)
+        self.prefetch_pages = get_bool_env_var("TEABLE_PREFETCH_PAGES", default=True)
+        self._prefetch_executor = ThreadPoolExecutor(max_workers=1, thread_name_prefix="teable-prefetch")
+        # Walks in progress (see get_record_pages). Page fetches and status writes take
+        # turns, so each page's offset accounts for every write that landed before it.
+        self._walk_lock = threading.Lock()
+        self._walks = []
+
+        # Incremental sync: enabled when a "Last modified time" field is configured
+        # (TEABLE_LAST_MODIFIED_FIELD_ID, read above). Between full resyncs only
+        # records changed since the high-water mark are fetched.
+        self.full_resync_interval = get_required_env_var("FULL_RESYNC_INTERVAL_SECONDS", default=600, required=False, convert_func=int)
+        self.sync_overlap_seconds = get_required_env_var("TEABLE_SYNC_OVERLAP_SECONDS", default=30, required=False, convert_func=int)
+        self.sync_state = SyncStateStorage(get_required_env_var("TEABLE_SYNC_STATE_FILE", default="sync_state.json", required=False))
+        self._cycle_since = None
+        self._cycle_started_at = None
+        self._cycle_max_seen = None
+        self._cycle_walk_failed = False
+
+        # Set when replicas split the records between them (see PartitionCoordinator)
+        self.coordinator = None
+        
+        # Log configuration
+        logger.info(f"TeablePoller initialized with group ID: {self.telegram_group_id} ({len(self.group_router)} target group(s))")
+        logger.debug("Webhook URLs configured:")
+        logger.debug("- Received: %s", self.n8n_webhook_received_url)
+        logger.debug("- Accepted: %s", self.n8n_webhook_accepted_url)
+        logger.debug("- Test Received: %s", self.n8n_webhook_test_received_url)
+        logger.debug("- Test Accepted: %s", self.n8n_webhook_test_accepted_url)
+        if self.last_modified_field_id:
+            logger.info(f"Incremental sync enabled (full resync every {self.full_resync_interval} seconds)")
+
+    @property
+    def incremental_sync_enabled(self):
+        return bool(self.last_modified_field_id)
+
+    def begin_cycle(self):
+        """
+        Start a poll cycle and decide between a full and an incremental sync.
+
+        Returns True when this cycle is a full sync. During an incremental cycle
+        get_records_with_filter only returns records changed since the persisted
+        high-water mark (minus TEABLE_SYNC_OVERLAP_SECONDS to absorb records that
+        were modified while the previous cycle was running).
+        """
+        self._cycle_started_at = time.time()
+        self._cycle_max_seen = None
+        self._cycle_since = None
+        self._cycle_walk_failed = False
+
+        high_water_mark = parse_timestamp(self.sync_state.get("high_water_mark"))
+        last_full_sync = self.sync_state.get("last_full_sync_at", 0)
+        if (not self.incremental_sync_enabled or high_water_mark is None
+                or self._cycle_started_at - last_full_sync >= self.full_resync_interval):
+            logger.debug("Starting full sync cycle")
+            return True
+
+        self._cycle_since = high_water_mark - timedelta(seconds=self.sync_overlap_seconds)
+        logger.debug("Starting incremental sync cycle for changes since %s", self._cycle_since)
+        return False
+
+    def end_cycle(self):
+        """
+        Finish a poll cycle and persist the new high-water mark.
+
+        Every status the stages work on is walked in every cycle, so the mark
+        covers them all. It never passes the start of the cycle minus
+        TEABLE_SYNC_OVERLAP_SECONDS: a record changed behind a walk that is still
+        running is then fetched again next cycle. A walk cut short by a Teable
+        error leaves the mark (and the time of the last full sync) where it was.
+        """
+        if not self.incremental_sync_enabled:
+            return
+        if self._cycle_walk_failed:
+            logger.warning("Not moving the sync high-water mark after an incomplete walk")
+            return
+        updates = {}
+        high_water_mark = parse_timestamp(self.sync_state.get("high_water_mark"))
+        cutoff = datetime.fromtimestamp(self._cycle_started_at, tz=timezone.utc) - timedelta(seconds=self.sync_overlap_seconds)
+        if self._cycle_since is None:
+            # A full walk isn't ordered by modified time, but it saw every record changed before the cycle started
+            new_mark = cutoff
+        else:
+            new_mark = min(self._cycle_max_seen, cutoff) if self._cycle_max_seen else None
+        if new_mark and (high_water_mark is None or new_mark > high_water_mark):
+            updates["high_water_mark"] = new_mark.isoformat()
+        if self._cycle_since is None:
+            updates["last_full_sync_at"] = self._cycle_started_at
+        if updates:
+            self.sync_state.update(**updates)
+
+    async def run_io(self, func, *args, **kwargs):
+        """Run a blocking Teable/webhook call on the I/O thread pool and await its result"""
+        loop = asyncio.get_running_loop()
+        return await loop.run_in_executor(self._io_executor, functools.partial(func, *args, **kwargs))
+
+    def _record_modified_time(self, record):
+        """Get the last modified time of a record, if available"""
+        return parse_timestamp(
+            record.get("lastModifiedTime") or record.get("fields", {}).get(self.last_modified_field_id)
+        )
+
+    def may_work_on(self, record_id, telegram_id, claim=True):
+        """
+        Check, right before a Telegram call or webhook, that no other replica has taken a record over.
+
+        With claim, the record's partition stays with this replica until the
+        transition started next is stored or abandoned (see PartitionCoordinator.claim).
+        """
+        coordinator = self.coordinator
+        if coordinator is None:
+            return True
+        if coordinator.claim(telegram_id, record_id) if claim else coordinator.owns_user(telegram_id, record_id):
+            return True
+        logger.info(f"Record {record_id} was handed to another replica, leaving it alone")
+        return False
+
+    def is_valid_telegram_id(self, telegram_id):
+        """Validate Telegram ID"""
+        try:
+            id_int = int(telegram_id)
+            return id_int > 0
+        except (ValueError, TypeError):
+            logger.warning(f"Invalid Telegram ID format: {telegram_id}")
+            return False
+
+    def _fetch_records_page(self, url, filter_params, walk, status=""):
+        """
+        Fetch the next page of a walk.
+
+        The offset skips the records already fetched, minus the ones this service
+        has since moved out of the walk's statuses (see patch_records): those no
+        longer take up a place in the view, so skipping them would skip records
+        that were never seen.
+        """
+        with self._walk_lock:
+            skip = walk["fetched"] - walk["left"]
+            page_params = dict(filter_params, skip=skip, take=self.page_size)
+            logger.debug("Fetching page skip=%d take=%d from: %s", skip, self.page_size, url, extra=SAMPLED)
+            try:
+                with metrics.teable_request_seconds.timer(method="GET", status_filter=status):
+                    response = self.session.get(url, headers=self.headers, params=page_params)
+                    response.raise_for_status()
+            except requests.exceptions.RequestException:
+                metrics.teable_request_errors.inc(method="GET", status_filter=status)
+                raise
+            records = decode_json(response.content).get("records", [])
+            walk["fetched"] += len(records)
+            walk["seen"].update(record.get("id") for record in records)
+        logger.debug("API Response: %s", LazyJson(records), extra=SAMPLED)
+        return records
+
+    def get_records_with_filter(self, status, incremental=True):
+        """Fetch records with a specific status (or any of a list of statuses), one record at a time (see get_record_pages)"""
+        for records in self.get_record_pages(status, incremental):
+            yield from records
+
+    def get_record_pages(self, status, incremental=True):
+        """
+        Fetch records with a specific status (or any of a list of statuses), one page at a time.
+
+        This is a generator: each page is yielded as it arrives, so memory stays
+        bounded by the page size rather than the table size. While the caller
+        works on the current page, the next one is requested in the background
+        (unless TEABLE_PREFETCH_PAGES is disabled).
+
+        During an incremental cycle (see begin_cycle) records are walked newest
+        first and the walk stops at the high-water mark, so only changed records
+        are fetched. Pass incremental=False to always walk the full view.
+
+        Status writes made while the walk is in progress are accounted for, so
+        records this service moves out of the view don't make the walk skip
+        others. Records whose status is changed elsewhere may still shift between
+        pages; they are picked up again on the next poll cycle.
+        """
+        url = f"{self.base_url}/table/{self.table_id}/record"
+        statuses = [status] if isinstance(status, str) else list(status)
+        status = "|".join(statuses)
+        # A page of a walk over several statuses mixes them, so its request latency can't
+        # be told apart by status; teable_records_fetched_total has the per-status counts
+        status_filter = statuses[0] if len(statuses) == 1 else "combined"
+        filter_params = {
+            "fieldKeyType": "id",
+            "filter": json.dumps({
+                "conjunction": "and" if len(statuses) == 1 else "or",
+                "filterSet": [{"fieldId": STATUS_FIELD_ID, "operator": "is", "value": value} for value in statuses]
+            })
+        }
+        if self.projection:
+            filter_params["projection"] = self.projection
+        since = self._cycle_since if incremental else None
+        if since is not None:
+            filter_params["orderBy"] = json.dumps([{"fieldId": self.last_modified_field_id, "order": "desc"}])
+        logger.debug("Fetching %s records from: %s", status, url)
+        logger.debug("Filter params: %s", LazyJson(filter_params))
+
+        # The records fetched so far, and how many of them were written out of the view since
+        walk = {"statuses": set(statuses), "seen": set(), "fetched": 0, "left": 0}
+        with self._walk_lock:
+            self._walks.append(walk)
+        total_records = 0
+        next_page = None
+        try:
+            while True:
+                if next_page is not None:
+                    records = next_page.result()
+                else:
+                    records = self._fetch_records_page(url, filter_params, walk, status_filter)
+                next_page = None
+
+                # A short page means we have reached the end of the view
+                has_more = len(records) >= self.page_size
+                if has_more and self.prefetch_pages:
+                    next_page = self._prefetch_executor.submit(self._fetch_records_page, url, filter_params, walk, status_filter)
+
+                if records and logger.isEnabledFor(logging.DEBUG):
+                    # Log the actual status values we're getting back
+                    page_statuses = [r.get("fields", {}).get(STATUS_FIELD_ID) for r in records]
+                    logger.debug("Status values in response: %s", page_statuses, extra=SAMPLED)
+                    if total_records == 0:
+                        logger.debug("Sample record fields: %s", LazyJson(records[0].get('fields', {})))
+
+                reached_high_water_mark = False
+                for index, record in enumerate(records):
+                    modified_time = self._record_modified_time(record) if self.incremental_sync_enabled else None
+                    if since is not None and modified_time is not None and modified_time < since:
+                        reached_high_water_mark = True
+                        records = records[:index]
+                        break
+                    # Only the cycle's own newest-first walk may move the high-water mark (see end_cycle)
+                    if since is not None and modified_time is not None and (self._cycle_max_seen is None or modified_time > self._cycle_max_seen):
+                        self._cycle_max_seen = modified_time
+                total_records += len(records)
+                fetched_by_status = collections.Counter(record.get("fields", {}).get(STATUS_FIELD_ID) for record in records)
+                for record_status, count in fetched_by_status.items():
+                    metrics.teable_records_fetched.inc(count, status=record_status or "")
+                if records:
+                    yield records
+
+                if not has_more or reached_high_water_mark:
+                    break
+        except requests.exceptions.RequestException as e:
+            logger.error(f"Error fetching {status} records after {total_records} records: {str(e)}")
+            if incremental:
+                self._cycle_walk_failed = True
+            return
+        finally:
+            with self._walk_lock:
+                self._walks.remove(walk)
+
+        logger.info(f"Fetched {total_records} {'changed ' if since is not None else ''}{status} records")
+
+    def fetch_by_status(self, statuses, incremental=True):
+        """
+        Fetch the records of several statuses in one walk and partition each page locally.
+
+        The statuses are combined into a single OR filter, so a poll cycle costs
+        one paginated query instead of one per status. This is a generator that
+        yields one dict per page, mapping each status to that page's records.
+        """
+        for records in self.get_record_pages(statuses, incremental):
+            views = {status: [] for status in statuses}
+            for record in records:
+                view = views.get(record.get("fields", {}).get(STATUS_FIELD_ID))
+                if view is not None:
+                    view.append(record)
+            yield views
+
+    async def fetch_pages(self, statuses, incremental=True):
+        """Iterate over fetch_by_status from the event loop, fetching each page on the I/O threads"""
+        pages = self.fetch_by_status(statuses, incremental)
+        while True:
+            views = await self.run_io(next, pages, None)
+            if views is None:
+                return
+            yield views
+
+    def patch_records(self, records: list):
+        """Send one bulk PATCH for a list of {"id": ..., "fields": {...}} updates"""
+        url = f"{self.base_url}/table/{self.table_id}/record"
+        payload = {
+            "fieldKeyType": "id",
+            "typecast": True,
+            "records": records
+        }
+
+        try:
+            logger.debug("Patching %d records", len(records))
+            logger.debug("Status update payload: %s", LazyJson(payload), extra=SAMPLED)
+            with self._walk_lock:
+                with metrics.teable_request_seconds.timer(method="PATCH", status_filter=""):
+                    response = self.session.patch(url, headers=self.headers, json=payload)
+                    response.raise_for_status()
+                self._records_left_walks(records)
+            logger.debug("Status update response: %s", LazyText(response), extra=SAMPLED)
+            return True
+        except requests.exceptions.RequestException as e:
+            metrics.teable_request_errors.inc(method="PATCH", status_filter="")
+            logger.error(f"Failed to update records: {str(e)}")
+            if hasattr(e, 'response') and e.response is not None:
+                logger.error(f"Error response body: {e.response.text}")
+            return False
+
+    def _records_left_walks(self, records):
+        """Count the walked records a PATCH moved out of each walk in progress (call with _walk_lock held)"""
+        for walk in self._walks:
+            for record in records:
+                new_status = record.get("fields", {}).get(STATUS_FIELD_ID)
+                if new_status is not None and new_status not in walk["statuses"] and record.get("id") in walk["seen"]:
+                    walk["seen"].discard(record.get("id"))
+                    walk["left"] += 1
+
+    @staticmethod
+    def double_status_fields(telegram_id):
+        """Field updates that mark a record as a duplicate of an existing member"""
+        return {
+            STATUS_FIELD_ID: "double",
+            "fldtDljIL5MBhcwoms4": f"double_{telegram_id}"
+        }
+
+    def call_webhook(self, webhook_url: str, payload: dict, is_test: bool = False):
+        """Call a webhook with the given payload"""
+        try:
+            logger.debug("Calling %swebhook: %s", 'test ' if is_test else '', webhook_url, extra=SAMPLED)
+            logger.debug("Sending webhook request to %s with payload: %s", webhook_url, LazyJson(payload), extra=SAMPLED)
+            response = self.session.post(
+                webhook_url, 
+                json=payload, 
+                headers={"Content-Type": "application/json"}
+            )
+            response.raise_for_status()
+            metrics.webhook_requests.inc(url=webhook_url.split("?")[0], outcome="success")
+            logger.info(f"Successfully called {'test ' if is_test else ''}webhook with status code {response.status_code}")
+            logger.debug("Webhook response: %s", LazyText(response), extra=SAMPLED)
+            return True
+        except requests.exceptions.RequestException as e:
+            metrics.webhook_requests.inc(url=webhook_url.split("?")[0], outcome="failure")
+            logger.warning(f"Error calling {'test ' if is_test else ''}webhook: {str(e)}")
+            return False
+
+    def call_invite_webhook(self, user):
+        """
+        Queue an n8n invite for a user we could not add directly.
+
+        Each delivery attempt tries the test webhook before the production one.
+        The record moves to 'invited' as soon as the invite is durably queued. If
+        the webhook is dead-lettered it moves on to 'blocked' when n8n answered
+        500, and back to 'approved' for any other failure.
+
+        Returns the status the record was moved to, or None.
+        """
+        webhook_payload = {
+            "telegramID": user['telegram_id'],
+            "telegramUsername": user.get('telegram_username') or '',
+            "telegramGroupId": user.get('group_id')
+        }
+        urls = [os.getenv("N8N_WEBHOOK_INVITE_TEST_URL"), os.getenv("N8N_WEBHOOK_INVITE_URL")]
+        if not any(urls):
+            logger.warning(f"No invite webhook configured, user {user['telegram_id']} stays approved")
+            return None
+
+        # After a failed status write only the status is stored again; the webhook is
+        # keyed on the journaled transition, so it is never queued twice for one invite
+        record_id = user['record_id']
+        if not self.state_machine.is_applied(record_id, "invited"):
+            if not self.may_work_on(record_id, user['telegram_id']):
+                return None
+            logger.info(f"Queueing invite webhook for user {user['telegram_id']}")
+            self.state_machine.begin(
+                record_id, "approved", "invited",
+                telegram_id=user['telegram_id'], telegram_username=user.get('telegram_username') or '', group_id=user.get('group_id')
+            )
+            self.outbox.enqueue(
+                "invite", urls, webhook_payload, f"invite:{self.state_machine.transition_key(record_id)}",
+                record_id=record_id, redeliver=False
+            )
+            self.state_machine.applied(record_id)
+        self.status_writer.set_status(record_id, 'invited')
+        return 'invited'
+
+    def _on_invite_webhook_dead(self, record_id, payload, status_code):
+        # n8n answers 500 when it can't reach the user either
+        if status_code == 500:
+            logger.info(f"Server returned 500 error, updating status to blocked for user {payload.get('telegramID')}")
+            self.state_machine.begin(record_id, "invited", "blocked")
+            self.status_writer.set_status(record_id, 'blocked')
+        else:
+            # No invite went out (a rejected request, or the retries ran out), so the invite stage tries again
+            logger.warning(f"Invite webhook for user {payload.get('telegramID')} was not delivered (status {status_code}), moving the record back to approved")
+            self.state_machine.begin(record_id, "invited", "approved")
+            self.status_writer.set_status(record_id, 'approved')
+
+    def get_records_by_ids(self, record_ids):
+        """Fetch individual records by ID (yields the records that could be fetched)"""
+        for record_id in record_ids:
+            url = f"{self.base_url}/table/{self.table_id}/record/{record_id}"
+            try:
+                with metrics.teable_request_seconds.timer(method="GET", status_filter="by_id"):
+                    params = {"fieldKeyType": "id"}
+                    if self.projection:
+                        params["projection"] = self.projection
+                    response = self.session.get(url, headers=self.headers, params=params)
+                    response.raise_for_status()
+                yield decode_json(response.content)
+            except requests.exceptions.RequestException as e:
+                metrics.teable_request_errors.inc(method="GET", status_filter="by_id")
+                logger.error(f"Error fetching record {record_id}: {str(e)}")
+
+    def to_approved_user(self, record):
+        """Convert an approved record into a compact user dict, or None if it can't be processed"""
+        fields = record.get("fields", {})
+        telegram_id = fields.get("fldtDljIL5MBhcwoms4")  # This is the actual field name from Teable
+        telegram_username = fields.get("fldt5LbTEuUWxq7iboV", "")  # This appears to be the username field
+        record_id = record.get("id")
+        group_id = self.group_router.route(record)
+
+        logger.debug("Processing approved record %s with telegram_id: %s, username: %s", record_id, telegram_id, telegram_username, extra=SAMPLED)
+        if group_id is None:
+            logger.warning(f"Skipping record {record_id} without a target group")
+        elif telegram_id:
+            try:
+                telegram_id = int(telegram_id)
+                if telegram_id > 0:
+                    logger.debug("Added record %s to approved records with telegram_id: %s", record_id, telegram_id, extra=SAMPLED)
+                    return {
+                        "telegram_id": telegram_id,
+                        "telegram_username": telegram_username,  # Keep this for the webhook payload
+                        "record_id": record_id,
+                        "group_id": group_id
+                    }
+                else:
+                    logger.warning(f"Skipping record {record_id} with non-positive Telegram ID: {telegram_id}")
+            except (ValueError, TypeError):
+                logger.warning(f"Skipping record {record_id} with invalid Telegram ID format: {telegram_id}")
+        else:
+            logger.warning(f"Skipping record {record_id} with missing Telegram ID")
+        return None
+
+    def to_refused_user(self, record):
+        """Convert a refused record into a compact user dict, or None if it can't be processed"""
+        fields = record.get("fields", {})
+        telegram_id = fields.get("fldtDljIL5MBhcwoms4")  # This is the actual field name from Teable
+        telegram_username = fields.get("fldt5LbTEuUWxq7iboV", "")  # This appears to be the username field
+        record_id = record.get("id")
+        group_id = self.group_router.route(record)
+
+        if group_id is None:
+            logger.warning(f"Skipping record {record_id} without a target group")
+            return None
+        if telegram_id and self.is_valid_telegram_id(telegram_id):
+            return {
+                "telegram_id": int(telegram_id),
+                "telegram_username": telegram_username,
+                "record_id": record_id,
+                "group_id": group_id
+            }
+        logger.warning(f"Skipping record {record_id} with invalid Telegram ID: {telegram_id}")
+        return None
+
+    def to_approved_users(self, records):
+        """Convert approved records into compact user dicts, skipping the ones that can't be processed"""
+        users = [user for user in map(self.to_approved_user, records) if user]
+        logger.info(f"Found {len(users)} approved records to process")
+        return users
+
+    def to_refused_users(self, records):
+        """Convert refused records into compact user dicts, skipping the ones that can't be processed"""
+        users = [user for user in map(self.to_refused_user, records) if user]
+        logger.info(f"Found {len(users)} refused records to process")
+        return users
+
+class EntityCache:
+    """
+    Persistent cache of resolved Telegram entities and their access hashes.
+
+    Access hashes are only valid for the account that resolved them, so entries
+    are namespaced per account and keyed by Telegram ID and lower-cased
+    username. Positive entries expire after `ttl` seconds. Usernames that did
+    not resolve are negatively cached for `negative_ttl` seconds so they are not
+    looked up again every cycle. The cache lives in its own JSON file, separate
+    from Telethon's .session files.
+    """
+    MISSING = object()
+
+    def __init__(self, filename="entity_cache.json", ttl=7 * 24 * 3600, negative_ttl=6 * 3600):
+        self.filename = filename
+        self.ttl = ttl
+        self.negative_ttl = negative_ttl
+        self._lock = threading.Lock()
+        self._dirty = False
+        # Username -> Telegram ID as recorded in Teable, used to find ID entries by username
+        self._known_usernames = {}
+        self.entries = self._load_entries()
+
+    def _load_entries(self):
+        """Load cache entries, dropping the ones that have expired"""
+        try:
+            if os.path.exists(self.filename):
+                with open(self.filename, 'r') as f:
+                    now = time.time()
+                    return {key: entry for key, entry in json.load(f).items() if entry.get("expires", 0) > now}
+        except Exception as e:
+            logger.error(f"Error loading entity cache: {str(e)}")
+        return {}
+
+    def save(self):
+        """Persist the cache if it changed"""
+        with self._lock:
+            if not self._dirty:
+                return
+            entries = dict(self.entries)
+            self._dirty = False
+        try:
+            write_json_atomic(self.filename, entries)
+        except Exception as e:
+            logger.error(f"Error saving entity cache: {str(e)}")
+
+    @staticmethod
+    def _key(account, kind, value):
+        if kind == "username":
+            value = str(value).lstrip('@').lower()
+        return f"{account}|{kind}:{value}"
+
+    def _get(self, key):
+        entry = self.entries.get(key)
+        if entry is None:
+            return None
+        if entry.get("expires", 0) <= time.time():
+            with self._lock:
+                self.entries.pop(key, None)
+                self._dirty = True
+            return None
+        return entry
+
+    def _put(self, key, entry, ttl):
+        entry["expires"] = time.time() + ttl
+        with self._lock:
+            self.entries[key] = entry
+            self._dirty = True
+
+    def warm_from_records(self, users):
+        """Remember the username -> Telegram ID mapping from Teable user records"""
+        for user in users:
+            if user.get('telegram_username') and user.get('telegram_id'):
+                self._known_usernames[str(user['telegram_username']).lstrip('@').lower()] = int(user['telegram_id'])
+
+    def get_user(self, account, telegram_id=None, username=None):
+        """
+        Look up a user. Returns an InputPeerUser, EntityCache.MISSING for a
+        username known not to resolve, or None when the cache can't tell.
+        """
+        if username:
+            entry = self._get(self._key(account, "username", username))
+            if entry is not None:
+                if entry.get("missing"):
+                    return self.MISSING
+                telegram_id = entry.get("id") or telegram_id
+            elif not telegram_id:
+                telegram_id = self._known_usernames.get(str(username).lstrip('@').lower())
+        if telegram_id:
+            entry = self._get(self._key(account, "id", telegram_id))
+            if entry is not None:
+                return InputPeerUser(entry["id"], entry["access_hash"])
+        return None
+
+    def put_user(self, account, entity, username=None):
+        """Cache a resolved user"""
+        self._put(self._key(account, "id", entity.user_id), {"id": entity.user_id, "access_hash": entity.access_hash}, self.ttl)
+        if username:
+            self._put(self._key(account, "username", username), {"id": entity.user_id}, self.ttl)
+
+    def put_missing(self, account, username):
+        """Negatively cache a username that did not resolve"""
+        self._put(self._key(account, "username", username), {"missing": True}, self.negative_ttl)
+
+    def invalidate_user(self, account, telegram_id=None, username=None):
+        """Drop cached entries for a user, e.g. after Telegram rejected the access hash"""
+        with self._lock:
+            if telegram_id:
+                self.entries.pop(self._key(account, "id", telegram_id), None)
+            if username:
+                self.entries.pop(self._key(account, "username", username), None)
+            self._dirty = True
+
+    def get_channel(self, account, channel_id):
+        entry = self._get(self._key(account, "channel", channel_id))
+        if entry is None:
+            return None
+        return InputPeerChannel(entry["id"], entry["access_hash"])
+
+    def put_channel(self, account, entity):
+        self._put(self._key(account, "channel", entity.channel_id), {"id": entity.channel_id, "access_hash": entity.access_hash}, self.ttl)
+
+class InviteScheduler:
+    """
+    Adaptive token-bucket scheduler for flood-limited Telegram RPCs.
+
+    Tokens refill at `rate` per second. Every `increase_after` successful calls
+    the rate grows by 10% (up to max_rate); a FloodWaitError halves it (down to
+    min_rate) and pauses the bucket for the seconds Telegram asked for. The rate
+    and any active cooldown are persisted to `state_file`, so a restart does not
+    walk straight back into the same flood wait.
+    """
+    def __init__(self, name="invite", state_file=None, rate=1 / 60, min_rate=1 / 600, max_rate=1 / 10,
+                 burst=1, increase_after=5, peer_flood_cooldown=3600):
+        self.name = name
+        self.state_file = state_file
+        self.min_rate = min_rate
+        self.max_rate = max(max_rate, min_rate)
+        self.burst = max(1, burst)
+        self.increase_after = increase_after
+        self.peer_flood_cooldown = peer_flood_cooldown
+        self.rate = min(max(rate, self.min_rate), self.max_rate)
+        self.cooldown_until = 0
+        self.tokens = 1
+        self.updated_at = time.time()
+        self._successes = 0
+        self._lock = asyncio.Lock()
+        self._load_state()
+
+    def _load_state(self):
+        """Restore the learned rate and any active cooldown"""
+        if not self.state_file or not os.path.exists(self.state_file):
+            return
+        try:
+            with open(self.state_file, 'r') as f:
+                state = json.load(f)
+            self.rate = min(max(float(state.get("rate", self.rate)), self.min_rate), self.max_rate)
+            self.cooldown_until = float(state.get("cooldown_until", 0))
+            if self.cooldown_until > time.time():
+                logger.info(f"{self.name} scheduler cooling down for another {self.cooldown_until - time.time():.0f} seconds")
+        except Exception as e:
+            logger.error(f"Error loading {self.name} scheduler state: {str(e)}")
+
+    def _save_state(self):
+        if not self.state_file:
+            return
+        try:
+            write_json_atomic(self.state_file, {"rate": self.rate, "cooldown_until": self.cooldown_until})
+        except Exception as e:
+            logger.error(f"Error saving {self.name} scheduler state: {str(e)}")
+
+    def _refill(self, now):
+        self.tokens = min(self.burst, self.tokens + (now - self.updated_at) * self.rate)
+        self.updated_at = now
+
+    def next_available_in(self):
+        """Seconds until the next call may be made"""
+        now = time.time()
+        if self.cooldown_until > now:
+            return self.cooldown_until - now
+        self._refill(now)
+        return 0 if self.tokens >= 1 else (1 - self.tokens) / self.rate
+
+    async def acquire(self):
+        """Wait until a call may be made and take a token"""
+        async with self._lock:
+            while True:
+                wait_time = self.next_available_in()
+                if wait_time <= 0:
+                    self.tokens -= 1
+                    return
+                logger.debug("%s scheduler: waiting %.2f seconds", self.name, wait_time, extra=SAMPLED)
+                await asyncio.sleep(wait_time)
+
+    def record_success(self):
+        """Additively probe for a higher rate after a run of successful calls"""
+        self._successes += 1
+        if self._successes >= self.increase_after and self.rate < self.max_rate:
+            self._successes = 0
+            self.rate = min(self.max_rate, self.rate * 1.1)
+            logger.debug("%s scheduler rate raised to %.2f/min", self.name, self.rate * 60)
+            self._save_state()
+
+    def record_flood_wait(self, seconds):
+        """Back off after Telegram reported a flood wait"""
+        self._successes = 0
+        self.tokens = 0
+        self.cooldown_until = max(self.cooldown_until, time.time() + seconds)
+        self.rate = max(self.min_rate, self.rate / 2)
+        logger.warning(f"{self.name} scheduler: flood wait of {seconds} seconds, rate lowered to {self.rate * 60:.2f}/min")
+        self._save_state()
+
+    def record_peer_flood(self):
+        """Back off after a PeerFloodError, which carries no explicit wait time"""
+        self.record_flood_wait(self.peer_flood_cooldown)
+
+    def pause(self, seconds):
+        """Hand out no calls for a while, without lowering the learned rate"""
+        self.tokens = 0
+        self.cooldown_until = max(self.cooldown_until, time.time() + seconds)
+
+class TelegramAccount:
+    """
+    One Telegram user session in the pool, with its own flood-limit schedulers.
+
+    Invites are paced per target group (one scheduler per group, created on
+    first use by `invite_scheduler_factory`); kicks share one scheduler. A
+    PeerFloodError restricts the whole account, so it also pauses the account.
+    """
+    def __init__(self, phone, client, invite_scheduler_factory, kick_scheduler):
+        self.phone = phone
+        self.client = client
+        self.invite_schedulers = {}
+        self._invite_scheduler_factory = invite_scheduler_factory
+        self.kick_scheduler = kick_scheduler
+        self.cooldown_until = 0
+        self.disabled_reason = None
+
+    @property
+    def healthy(self):
+        return self.disabled_reason is None
+
+    def disable(self, reason):
+        """Take the account out of rotation, e.g. after it was banned or logged out"""
+        if self.healthy:
+            logger.error(f"Disabling Telegram account {self.phone}: {reason}")
+        self.disabled_reason = reason
+
+    def invite_scheduler(self, group_id=None):
+        if group_id not in self.invite_schedulers:
+            self.invite_schedulers[group_id] = self._invite_scheduler_factory(group_id)
+        return self.invite_schedulers[group_id]
+
+    def scheduler(self, kind, group_id=None):
+        return self.invite_scheduler(group_id) if kind == "invite" else self.kick_scheduler
+
+    def record_peer_flood(self, kind, group_id=None):
+        """Back off after a PeerFloodError and pause the account for every group"""
+        scheduler = self.scheduler(kind, group_id)
+        scheduler.record_peer_flood()
+        self.cooldown_until = max(self.cooldown_until, scheduler.cooldown_until)
+
+class SessionPool:
+    """
+    Shards flood-limited Telegram calls across several accounts.
+
+    Each account keeps its own invite and kick schedulers, so flood waits only
+    slow down the account that hit them. acquire() hands out whichever healthy
+    account can act soonest; accounts in a flood cooldown are skipped while any
+    other account is still usable.
+    """
+    def __init__(self, accounts):
+        if not accounts:
+            raise ConfigurationError("At least one Telegram account is required")
+        self.accounts = accounts
+
+    @property
+    def primary(self):
+        return self.accounts[0]
+
+    def healthy_accounts(self):
+        return [account for account in self.accounts if account.healthy]
+
+    def pick(self, kind, group_id=None):
+        """Return the healthy account that can act soonest, or None if all are cooling down or disabled"""
+        now = time.time()
+        candidates = [
+            account for account in self.healthy_accounts()
+            if max(account.cooldown_until, account.scheduler(kind, group_id).cooldown_until) <= now
+        ]
+        if not candidates:
+            return None
+        return min(candidates, key=lambda account: account.scheduler(kind, group_id).next_available_in())
+
+    async def acquire(self, kind, group_id=None):
+        """Wait for a token on the soonest available account and return that account"""
+        account = self.pick(kind, group_id)
+        if account is None:
+            return None
+        await account.scheduler(kind, group_id).acquire()
+        return account
+
+class TelegramGroupManager:
+    # Errors after which an account can no longer be used to invite or remove users
+    ACCOUNT_ERRORS = (
+        AuthKeyUnregisteredError, AuthKeyDuplicatedError, SessionRevokedError,
+        UserDeactivatedError, UserDeactivatedBanError, UserBannedInChannelError
+    )
+    # How long an account that can't resolve a target group stops inviting to it
+    UNREACHABLE_GROUP_PAUSE_SECONDS = 600
+
+    def __init__(self, group_router=None):
+        self.entity_cache = EntityCache(
+            filename=get_required_env_var("ENTITY_CACHE_FILE", default="entity_cache.json", required=False),
+            ttl=get_required_env_var("ENTITY_CACHE_TTL_SECONDS", default=7 * 24 * 3600, required=False, convert_func=int),
+            negative_ttl=get_required_env_var("ENTITY_CACHE_NEGATIVE_TTL_SECONDS", default=6 * 3600, required=False, convert_func=int)
+        )
+        self.remove_concurrency = max(1, get_required_env_var("REMOVE_CONCURRENCY", default=4, required=False, convert_func=int))
         try:
             self.api_id = get_required_env_var(
                 "TELEGRAM_API_ID", 
                 convert_func=int
             )
             self.api_hash = get_required_env_var("TELEGRAM_API_HASH")
-            self.phone = get_required_env_var("TELEGRAM_PHONE")
-            self.group_id = get_required_env_var(
-                "TELGRAM_GROUP_ID", 
-                convert_func=int
-            )
-        except ValueError as e:
+            phone = get_required_env_var("TELEGRAM_PHONE")
+            self.group_router = group_router or GroupRouter.from_env()
+            # The default group; records are routed to the other groups by group_router
+            self.group_id = self.group_router.default_group_id
+        except (ValueError, ConfigurationError) as e:
             logger.error(f"Telegram Configuration Error: {e}")
             sys.exit(1)
-        
-        self.client = TelegramClient(self.phone, self.api_id, self.api_hash)
-        logger.info("TelegramGroupManager initialized")
-        
+
+        # Additional accounts share the API credentials; each one uses its own <phone>.session file
+        phones = [phone]
+        for extra_phone in get_required_env_var("TELEGRAM_SESSIONS", default="", required=False).split(','):
+            extra_phone = extra_phone.strip()
+            if extra_phone and extra_phone not in phones:
+                phones.append(extra_phone)
+        # The primary account keeps the unsuffixed state files, so adding accounts
+        # doesn't throw away its learned rates and flood cooldowns
+        self.pool = SessionPool([self._create_account(p, per_account_state=p != phone) for p in phones])
+        logger.info(f"TelegramGroupManager initialized with {len(phones)} account(s) and {len(self.group_router)} group(s)")
+
+    def _create_account(self, phone, per_account_state):
+        """Create the client and schedulers for one account"""
+        def state_file(var_name, default, group_id=None):
+            filename = get_required_env_var(var_name, default=default, required=False)
+            suffixes = []
+            if per_account_state:
+                suffixes.append(phone.lstrip('+'))
+            if group_id not in (None, self.group_id):
+                suffixes.append(str(group_id))
+            if not suffixes:
+                return filename
+            root, ext = os.path.splitext(filename)
+            return f"{root}_{'_'.join(suffixes)}{ext}"
+
+        def invite_scheduler_factory(group_id):
+            group_name = self.group_router.groups.get(group_id, {}).get("name", group_id)
+            return InviteScheduler(
+                name=f"invite[{phone}/{group_name}]",
+                state_file=state_file("INVITE_SCHEDULER_STATE_FILE", "invite_scheduler_state.json", group_id),
+                rate=get_required_env_var("INVITE_RATE_PER_MINUTE", default=1.0, required=False, convert_func=float) / 60,
+                min_rate=get_required_env_var("INVITE_MIN_RATE_PER_MINUTE", default=0.1, required=False, convert_func=float) / 60,
+                max_rate=get_required_env_var("INVITE_MAX_RATE_PER_MINUTE", default=6.0, required=False, convert_func=float) / 60,
+                peer_flood_cooldown=get_required_env_var("INVITE_PEER_FLOOD_COOLDOWN_SECONDS", default=3600, required=False, convert_func=int)
+            )
+
+        kick_scheduler = InviteScheduler(
+            name=f"kick[{phone}]",
+            state_file=state_file("KICK_SCHEDULER_STATE_FILE", "kick_scheduler_state.json"),
+            rate=get_required_env_var("REMOVE_RATE_PER_MINUTE", default=30.0, required=False, convert_func=float) / 60,
+            min_rate=1 / 600,
+            max_rate=get_required_env_var("REMOVE_MAX_RATE_PER_MINUTE", default=60.0, required=False, convert_func=float) / 60,
+            peer_flood_cooldown=get_required_env_var("INVITE_PEER_FLOOD_COOLDOWN_SECONDS", default=3600, required=False, convert_func=int)
+        )
+        # Flood waits are surfaced as FloodWaitError so the schedulers can adapt to them
+        client = TelegramClient(
+            phone, self.api_id, self.api_hash,
+            flood_sleep_threshold=get_required_env_var("TELEGRAM_FLOOD_SLEEP_THRESHOLD", default=0, required=False, convert_func=int)
+        )
+        return TelegramAccount(phone, client, invite_scheduler_factory, kick_scheduler)
+
+    @property
+    def client(self):
+        """Client of the primary account (TELEGRAM_PHONE)"""
+        return self.pool.primary.client
+
+    @property
+    def phone(self):
+        return self.pool.primary.phone
+
     def connect(self):
-        """Connect to Telegram and ensure authorization"""
-        logger.info("Connecting to Telegram...")
-        self.client.connect()
+        """Connect all accounts to Telegram and ensure authorization"""
+        if not self._connect_account(self.pool.primary):
+            return False
+        for account in self.pool.accounts[1:]:
+            try:
+                if not self._connect_account(account):
+                    account.disable("authorization failed")
+            except Exception as e:
+                account.disable(f"could not connect: {str(e)}")
+        return True
+
+    def _connect_account(self, account):
+        """Connect one account and ensure authorization"""
+        logger.info(f"Connecting to Telegram as {account.phone}...")
+        account.client.connect()
         
-        if not self.client.is_user_authorized():
-            logger.info("Authorization required")
-            phone_code_hash = self.client.send_code_request(self.phone).phone_code_hash
+        if not account.client.is_user_authorized():
+            logger.info(f"Authorization required for {account.phone}")
+            phone_code_hash = account.client.send_code_request(account.phone).phone_code_hash
             
             try:
-                code = input('Enter the code you received: ')
-                self.client.sign_in(
-                    phone=self.phone,
+                code = input(f'Enter the code you received for {account.phone}: ')
+                account.client.sign_in(
+                    phone=account.phone,
                     code=code,
                     phone_code_hash=phone_code_hash
                 )
@@ -383,277 +2402,1473 @@ class TelegramGroupManager:
                 return False
             except SessionPasswordNeededError:
                 logger.info("2FA is enabled, requesting password")
-                password = input('Enter your 2FA password: ')
-                self.client.sign_in(password=password)
+                password = input(f'Enter your 2FA password for {account.phone}: ')
+                account.client.sign_in(password=password)
         
-        logger.info("Successfully connected to Telegram")
+        logger.info(f"Successfully connected to Telegram as {account.phone}")
         return True
 
-    def get_groups(self):
-        """Get all groups and their details"""
-        logger.info("Fetching all groups...")
-        chats = []
-        last_date = None
-        chunk_size = 200
-        groups = []
-        
-        result = self.client(GetDialogsRequest(
-            offset_date=last_date,
-            offset_id=0,
-            offset_peer=InputPeerEmpty(),
-            limit=chunk_size,
-            hash=0
-        ))
-        chats.extend(result.chats)
-        
-        for chat in chats:
+    def get_groups(self):
+        """Get all groups and their details"""
+        logger.info("Fetching all groups...")
+        chats = []
+        last_date = None
+        chunk_size = 200
+        groups = []
+        
+        result = self.client(GetDialogsRequest(
+            offset_date=last_date,
+            offset_id=0,
+            offset_peer=InputPeerEmpty(),
+            limit=chunk_size,
+            hash=0
+        ))
+        chats.extend(result.chats)
+        
+        for chat in chats:
+            try:
+                if hasattr(chat, 'megagroup') and chat.megagroup:
+                    title = str(chat.title)
+                    if len(title) > 30:
+                        title = title[:27] + "..."
+                    
+                    groups.append({
+                        'title': title,
+                        'id': str(chat.id),
+                        'access_hash': str(chat.access_hash),
+                        'members_count': str(getattr(chat, 'participants_count', 'N/A'))
+                    })
+            except Exception as e:
+                logger.error(f"Error processing chat: {str(e)}")
+                continue
+        
+        if not groups:
+            logger.warning("No groups found!")
+            return []
+        
+        logger.info(f"Found {len(groups)} groups")
+        for g in groups:
+            logger.debug("Group: %s (ID: %s, Members: %s)", g['title'], g['id'], g['members_count'])
+        
+        for group_id in self.group_router.groups:
+            target_id = str(group_id)
+            target_group = next((g for g in groups if g['id'] == target_id), None)
+            
+            if target_group:
+                logger.info(f"Target group found: {target_group['title']}")
+                logger.debug("Access Hash: %s", target_group['access_hash'])
+            else:
+                logger.warning(f"Target group with ID {target_id} not found!")
+        
+        return groups
+
+    async def _get_target_group_entity(self, account, group_id, refresh=False):
+        """Resolve a target group for an account (cached), falling back to the configured access hash"""
+        if not refresh:
+            cached = self.entity_cache.get_channel(account.phone, group_id)
+            if cached is not None:
+                return cached
+        try:
+            target_group = await account.client.get_entity(group_id)
+            if not isinstance(target_group, Channel):
+                raise ValueError("Target is not a channel/group")
+            
+            logger.info(f"Using group: {target_group.title}")
+            target_group_entity = InputPeerChannel(target_group.id, target_group.access_hash)
+            self.entity_cache.put_channel(account.phone, target_group_entity)
+            return target_group_entity
+        except Exception as e:
+            logger.error(f"Error getting group entity: {str(e)}")
+            # The configured hash is an access hash of the primary account and is useless to the others
+            if account is not self.pool.primary:
+                raise
+            group_hash = self.group_router.groups.get(group_id, {}).get("hash")
+            if not group_hash:
+                logger.error("Could not find group and no access hash provided")
+                raise ValueError("Could not find group and no access hash provided")
+            return InputPeerChannel(group_id, group_hash)
+
+    async def add_users(self, users, processed_storage, poller):
+        """
+        Add multiple users to their target groups.
+
+        Groups are filled concurrently, each paced by its own invite schedulers.
+        Within a group each invite goes to whichever pool account can act soonest,
+        so k accounts invite about k times as fast. A user whose invite hit a flood
+        limit, a disabled account or an account that can't resolve the group is
+        handed back to the queue for another account; users left when every
+        account is cooling down stay approved for a later cycle.
+
+        Users without a username can only be invited by n8n, so they skip the
+        invite schedulers entirely: their webhooks are queued in a separate lane
+        that runs alongside the Telegram invites.
+        """
+        users_by_group = {}
+        webhook_users = []
+        for user in users:
+            if user.get('telegram_username'):
+                users_by_group.setdefault(user.get('group_id') or self.group_id, []).append(user)
+            else:
+                webhook_users.append(user)
+        results = await asyncio.gather(
+            self.queue_invite_webhooks(webhook_users, poller),
+            *(
+                self._add_users_to_group(group_id, group_users, poller)
+                for group_id, group_users in users_by_group.items()
+            )
+        )
+        self.entity_cache.save()
+        return [record_id for successful_records in results[1:] for record_id in successful_records]
+
+    async def queue_invite_webhooks(self, users, poller):
+        """Hand users without a username to the n8n invite webhook, without waiting for a Telegram account"""
+        if not users:
+            return
+        logger.info(f"Sending {len(users)} users without a username to the invite webhook")
+        await asyncio.gather(*(poller.run_io(poller.call_invite_webhook, user) for user in users))
+
+    async def _add_users_to_group(self, group_id, users, poller):
+        """Add users to one group, returning the record IDs of the users that were added"""
+        logger.info(f"Adding {len(users)} users to group {group_id} using {len(self.pool.healthy_accounts())} account(s)")
+        # Users whose invite already went through (only their status write failed) need no RPC
+        successful_records = [user['record_id'] for user in users if poller.state_machine.is_applied(user['record_id'], "telegram")]
+        already_added = set(successful_records)
+        # Likewise for users already handed to the n8n invite webhook
+        for user in users:
+            if poller.state_machine.is_applied(user['record_id'], "invited"):
+                await poller.run_io(poller.call_invite_webhook, user)
+                already_added.add(user['record_id'])
+        pending_users = collections.deque(user for user in users if user['record_id'] not in already_added)
+        in_flight = set()
+
+        while pending_users or in_flight:
+            if not pending_users:
+                # Wait for running invites; failed ones may hand their user back
+                await asyncio.wait(in_flight, return_when=asyncio.FIRST_COMPLETED)
+                continue
+
+            account = await self.pool.acquire("invite", group_id)
+            if account is None:
+                logger.error(f"All Telegram accounts are cooling down or disabled for group {group_id}. Stopping user addition.")
+                break
+
+            user = pending_users.popleft()
+            task = asyncio.ensure_future(self._invite_user(account, group_id, user, poller, pending_users, successful_records))
+            in_flight.add(task)
+            task.add_done_callback(in_flight.discard)
+            # Let the invite start so its outcome is reflected before the next account is picked
+            await asyncio.sleep(0)
+
+        if in_flight:
+            await asyncio.gather(*in_flight)
+        return successful_records
+
+    async def _invite_user(self, account, group_id, user, poller, pending_users, successful_records):
+        """Invite one user with the given account; hands the user back to pending_users on account-level failures"""
+        try:
+            if not poller.may_work_on(user['record_id'], user['telegram_id'], claim=False):
+                return
+            logger.debug("Trying to add user by username: %s", user['telegram_username'], extra=SAMPLED)
+            user_entity = await self._resolve_user_entity(account, user)
+            if user_entity is None:
+                return
+
+            if not isinstance(user_entity, InputPeerUser):
+                logger.warning(f"Skipping user {user['telegram_id']}: Not a user entity")
+                return
+
+            try:
+                target_group_entity = await self._get_target_group_entity(account, group_id)
+            except (FloodWaitError, PeerFloodError, *self.ACCOUNT_ERRORS):
+                raise
+            except Exception as e:
+                # Only this account may be unable to reach the group; another one can invite the user
+                logger.error(f"{account.phone} cannot resolve group {group_id}: {str(e)}. Handing user {user['telegram_id']} to another account.")
+                account.invite_scheduler(group_id).pause(self.UNREACHABLE_GROUP_PAUSE_SECONDS)
+                pending_users.appendleft(user)
+                return
+            logger.info(f"Adding user {user['telegram_id']} to group {group_id} via {account.phone}")
+            
+            if not poller.may_work_on(user['record_id'], user['telegram_id']):
+                return
+            metrics.invites_attempted.inc(group=group_id)
+            poller.state_machine.begin(
+                user['record_id'], "approved", "telegram",
+                telegram_id=user['telegram_id'], telegram_username=user.get('telegram_username') or '', group_id=group_id
+            )
+            try:
+                await account.client(InviteToChannelRequest(
+                    channel=target_group_entity,
+                    users=[user_entity]
+                ))
+            except RPCError as e:
+                # Telegram answered, so the invite definitely did not happen. Anything
+                # else (a dropped connection) leaves the transition open to be verified.
+                poller.state_machine.abort(user['record_id'], type(e).__name__)
+                raise
+            poller.state_machine.applied(user['record_id'])
+            
+            successful_records.append(user['record_id'])
+            metrics.invites_succeeded.inc(group=group_id)
+            account.invite_scheduler(group_id).record_success()
+            logger.info(f"Successfully added user {user['telegram_id']}")
+            
+        except FloodWaitError as e:
+            metrics.flood_errors.inc(account=account.phone, kind="invite", error="FloodWait")
+            metrics.flood_wait_seconds.inc(e.seconds, account=account.phone, kind="invite")
+            account.invite_scheduler(group_id).record_flood_wait(e.seconds)
+            logger.error(f"Telegram asked {account.phone} to wait {e.seconds} seconds. Handing user {user['telegram_id']} to another account.")
+            pending_users.appendleft(user)
+        except PeerFloodError:
+            metrics.flood_errors.inc(account=account.phone, kind="invite", error="PeerFlood")
+            account.record_peer_flood("invite", group_id)
+            logger.error(f"Telegram flood error detected for {account.phone}. Handing user {user['telegram_id']} to another account.")
+            pending_users.appendleft(user)
+        except self.ACCOUNT_ERRORS as e:
+            account.disable(type(e).__name__)
+            pending_users.appendleft(user)
+        except UserPrivacyRestrictedError:
+            logger.warning(f"User {user['telegram_id']} has privacy restrictions")
+            # Call webhook for users with privacy restrictions
+            await poller.run_io(poller.call_invite_webhook, user)
+        except ChannelInvalidError:
+            logger.error("Invalid channel error. Attempting to refresh group entity...")
+            try:
+                await self._get_target_group_entity(account, group_id, refresh=True)
+                logger.info("Successfully refreshed group entity")
+            except Exception as refresh_error:
+                logger.error(f"Failed to refresh group entity: {str(refresh_error)}")
+        except UserNotMutualContactError:
+            logger.warning(f"User {user['telegram_id']} is not a mutual contact")
+            # Call webhook for users who are not mutual contacts
+            await poller.run_io(poller.call_invite_webhook, user)
+        except (PeerIdInvalidError, UserIdInvalidError):
+            # A stale access hash; resolve the user again next time
+            logger.warning(f"Telegram rejected the cached entity for user {user['telegram_id']}")
+            self.entity_cache.invalidate_user(account.phone, user['telegram_id'], user.get('telegram_username'))
+        except Exception as e:
+            logger.error(f"Unexpected error while adding user {user['telegram_id']}: {str(e)}")
+            logger.error(traceback.format_exc())
+
+    def warm_entity_cache(self, users):
+        """
+        Seed the entity cache from Teable user records: remember their usernames and
+        copy access hashes each account already holds in its session (no RPCs).
+        Returns the number of access hashes copied; the cache is not saved.
+        """
+        self.entity_cache.warm_from_records(users)
+        warmed = 0
+        for account in self.pool.healthy_accounts():
+            for user in users:
+                if self.entity_cache.get_user(account.phone, user['telegram_id']) is not None:
+                    continue
+                try:
+                    entity = account.client.session.get_input_entity(user['telegram_id'])
+                except (ValueError, KeyError, TypeError):
+                    continue
+                if isinstance(entity, InputPeerUser):
+                    self.entity_cache.put_user(account.phone, entity, user.get('telegram_username'))
+                    warmed += 1
+        return warmed
+
+    async def _resolve_user_entity(self, account, user):
+        """
+        Resolve a user for an account, preferring the entity cache, then Telethon's
+        session cache by Telegram ID, and only then a username lookup RPC.
+        """
+        username = user.get('telegram_username')
+        cached = self.entity_cache.get_user(account.phone, user['telegram_id'], username)
+        if cached is EntityCache.MISSING:
+            logger.debug("Username %s is negatively cached, skipping lookup", username, extra=SAMPLED)
+            return None
+        if cached is not None:
+            return cached
+
+        entity = None
+        try:
+            entity = await account.client.get_input_entity(user['telegram_id'])
+        except ValueError:
+            pass
+        if entity is None and username:
+            try:
+                entity = await account.client.get_input_entity(username)
+            except ValueError as e:
+                logger.warning(f"Could not find user by username: {str(e)}")
+                self.entity_cache.put_missing(account.phone, username)
+                return None
+        if isinstance(entity, InputPeerUser):
+            self.entity_cache.put_user(account.phone, entity, username)
+        return entity
+
+    async def is_participant(self, user):
+        """Ask Telegram whether a user is in their target group; None if that can't be told"""
+        accounts = self.pool.healthy_accounts()
+        if not accounts:
+            return None
+        account = accounts[0]
+        try:
+            user_entity = await self._resolve_user_entity(account, user)
+            if not isinstance(user_entity, InputPeerUser):
+                return None
+            target_group_entity = await self._get_target_group_entity(account, user.get('group_id') or self.group_id)
+            await account.client(GetParticipantRequest(target_group_entity, user_entity))
+            return True
+        except UserNotParticipantError:
+            return False
+        except Exception as e:
+            logger.warning(f"Could not check whether user {user['telegram_id']} is in the group: {str(e)}")
+            return None
+
+    async def remove_users(self, users, processed_storage, poller, skip_processed=True, partitioned=True):
+        """
+        Remove refused users from the group.
+
+        Users already marked 'removed' in processed_storage are not kicked again,
+        unless skip_processed is False (the membership reconciler found them back
+        in the group). With partitioned=False (the reconciler, which runs on one
+        replica) users are removed whichever replica owns their records.
+        Up to remove_concurrency kicks are in flight at once, and each one takes a
+        token from the kick scheduler of the pool account that can act soonest, so
+        the pace adapts to flood waits. Returns the record IDs whose users are no
+        longer in the group.
+        """
+        logger.info(f"Removing {len(users)} users from group")
+        removed_records = []
+        pending_users = []
+        for user in users:
+            if skip_processed and processed_storage.is_processed(self.group_router.processed_key(user['telegram_id'], user.get('group_id')), 'removed'):
+                logger.debug("User %s was already removed", user['telegram_id'], extra=SAMPLED)
+                removed_records.append(user['record_id'])
+            else:
+                pending_users.append(user)
+        if not pending_users:
+            return removed_records
+
+        rights = ChatBannedRights(
+            until_date=None,
+            view_messages=True,
+            send_messages=True,
+            send_media=True,
+            send_stickers=True,
+            send_gifs=True,
+            send_games=True,
+            send_inline=True,
+            embed_links=True
+        )
+        semaphore = asyncio.Semaphore(self.remove_concurrency)
+
+        async def remove_user(user):
+            if partitioned and not poller.may_work_on(user['record_id'], user['telegram_id'], claim=False):
+                return
+            async with semaphore:
+                # Users left over once every account is cooling down stay refused and are retried next cycle
+                account = await self.pool.acquire("kick")
+                if account is None:
+                    logger.debug("No Telegram account available to remove user %s", user['telegram_id'])
+                    return
+                try:
+                    user_entity = await self._resolve_user_entity(account, user)
+                    if not isinstance(user_entity, InputPeerUser):
+                        logger.warning(f"Skipping user {user['telegram_id']}: could not resolve user entity")
+                        return
+                    target_group_entity = await self._get_target_group_entity(account, user.get('group_id') or self.group_id)
+                    if partitioned and not poller.may_work_on(user['record_id'], user['telegram_id']):
+                        return
+                    poller.state_machine.begin(
+                        user['record_id'], "refused", "removed",
+                        telegram_id=user['telegram_id'], telegram_username=user.get('telegram_username') or '', group_id=user.get('group_id')
+                    )
+                    await account.client(EditBannedRequest(target_group_entity, user_entity, rights))
+                    poller.state_machine.applied(user['record_id'])
+                    account.kick_scheduler.record_success()
+                    metrics.removals.inc(outcome="removed")
+                    logger.info(f"Successfully removed user {user['telegram_id']}")
+                except UserNotParticipantError:
+                    poller.state_machine.applied(user['record_id'])
+                    metrics.removals.inc(outcome="not_participant")
+                    logger.info(f"User {user['telegram_id']} is not in the group")
+                except FloodWaitError as e:
+                    metrics.removals.inc(outcome="flood")
+                    metrics.flood_errors.inc(account=account.phone, kind="kick", error="FloodWait")
+                    metrics.flood_wait_seconds.inc(e.seconds, account=account.phone, kind="kick")
+                    account.kick_scheduler.record_flood_wait(e.seconds)
+                    logger.error(f"Telegram asked {account.phone} to wait {e.seconds} seconds before removing more users.")
+                    return
+                except PeerFloodError:
+                    metrics.removals.inc(outcome="flood")
+                    metrics.flood_errors.inc(account=account.phone, kind="kick", error="PeerFlood")
+                    account.record_peer_flood("kick")
+                    logger.error(f"Telegram flood error detected for {account.phone} while removing users.")
+                    return
+                except self.ACCOUNT_ERRORS as e:
+                    account.disable(type(e).__name__)
+                    return
+                except ChatAdminRequiredError:
+                    logger.error(f"Admin privileges are required for {account.phone} to remove users from this group")
+                    return
+                except Exception as e:
+                    logger.error(f"Unexpected error while removing user {user['telegram_id']}: {str(e)}")
+                    logger.error(traceback.format_exc())
+                    return
+                finally:
+                    if not poller.state_machine.is_applied(user['record_id'], "removed"):
+                        poller.state_machine.abort(user['record_id'], "user was not removed")
+
+                processed_storage.mark_as_processed(self.group_router.processed_key(user['telegram_id'], user.get('group_id')), 'removed')
+                removed_records.append(user['record_id'])
+
+        await asyncio.gather(*(remove_user(user) for user in pending_users))
+        self.entity_cache.save()
+        return removed_records
+    
+    def close(self):
+        """Close the Telegram client connections"""
+        self.entity_cache.save()
+        logger.info("Closing Telegram client connections")
+        for account in self.pool.accounts:
+            account.client.disconnect()
+
+class StageExecutor:
+    """
+    Runs the per-record work of a pipeline stage with bounded concurrency.
+
+    run() starts at most `concurrency` handlers at a time; each handler still
+    does its own steps in order. The executor keeps the number of items
+    waiting for a slot (queue depth), the number in flight and a window of
+    recent latencies, which log_stats() reports once per cycle.
+    """
+    def __init__(self, name, concurrency=8, latency_window=1000):
+        self.name = name
+        self.concurrency = max(1, concurrency)
+        self.queue_depth = 0
+        self.in_flight = 0
+        self.max_queue_depth = 0
+        self.processed = 0
+        self.errors = 0
+        self._latencies = collections.deque(maxlen=latency_window)
+        self._logged_processed = 0
+        self._semaphore = asyncio.Semaphore(self.concurrency)
+
+    async def run(self, handler, items):
+        """Run handler(item) for every item, at most `concurrency` at a time"""
+        items = list(items)
+        self.queue_depth += len(items)
+        self.max_queue_depth = max(self.max_queue_depth, self.queue_depth)
+        metrics.stage_queue_depth.set(self.queue_depth, stage=self.name)
+        await asyncio.gather(*(self._run_one(handler, item) for item in items))
+
+    async def _run_one(self, handler, item):
+        async with self._semaphore:
+            self.queue_depth -= 1
+            metrics.stage_queue_depth.set(self.queue_depth, stage=self.name)
+            self.in_flight += 1
+            started_at = time.monotonic()
+            try:
+                await handler(item)
+            except Exception as e:
+                self.errors += 1
+                logger.error(f"Error in {self.name} stage: {str(e)}")
+                logger.error(traceback.format_exc())
+            finally:
+                self.in_flight -= 1
+                self.processed += 1
+                self._latencies.append(time.monotonic() - started_at)
+                metrics.stage_item_seconds.observe(self._latencies[-1], stage=self.name)
+
+    def stats(self):
+        """Counters and latency percentiles (seconds) over the recent window"""
+        latencies = sorted(self._latencies)
+        def percentile(p):
+            return latencies[min(len(latencies) - 1, int(p * len(latencies)))] if latencies else 0.0
+        return {
+            "processed": self.processed,
+            "errors": self.errors,
+            "queue_depth": self.queue_depth,
+            "max_queue_depth": self.max_queue_depth,
+            "in_flight": self.in_flight,
+            "p50": percentile(0.5),
+            "p95": percentile(0.95),
+            "max": latencies[-1] if latencies else 0.0
+        }
+
+    def log_stats(self):
+        """Log the stage's stats if it did any work since the last report"""
+        if self.processed == self._logged_processed:
+            return
+        stats = self.stats()
+        logger.info(
+            f"Stage {self.name}: {self.processed - self._logged_processed} processed "
+            f"({stats['errors']} errors total), queue depth {stats['queue_depth']} "
+            f"(max {stats['max_queue_depth']}), latency p50 {stats['p50']:.3f}s "
+            f"p95 {stats['p95']:.3f}s max {stats['max']:.3f}s"
+        )
+        self._logged_processed = self.processed
+        self.max_queue_depth = self.queue_depth
+
+class PartitionCoordinator:
+    """Splits records between replicas by Telegram ID, through partition leases in a shared SQLite file"""
+    def __init__(self, db_path, replica_id=None, partitions=64, lease_ttl=30.0, heartbeat_interval=5.0):
+        self.db_path = db_path
+        self.replica_id = replica_id or f"{socket.gethostname()}-{os.getpid()}"
+        self.partitions = max(1, partitions)
+        self.lease_ttl = lease_ttl
+        self.heartbeat_interval = heartbeat_interval
+        # Partitions leased to this replica and open for new work; replaced as a whole
+        # on every heartbeat
+        self.owned = frozenset()
+        # Claimed record ID -> partition (see claim), and the partitions waiting for
+        # their claims to be released before they are handed over
+        self._claims = {}
+        self._claims_lock = threading.Lock()
+        self.draining = frozenset()
+        self._last_heartbeat = 0.0
+        self._lock = threading.Lock()
+        self._stopping = threading.Event()
+        self._thread = None
+        self._conn = sqlite3.connect(db_path, timeout=lease_ttl, check_same_thread=False, isolation_level=None)
+        self._conn.execute("PRAGMA journal_mode=WAL")
+        self._conn.execute("""
+            CREATE TABLE IF NOT EXISTS replicas (
+                replica_id TEXT PRIMARY KEY,
+                heartbeat_at REAL NOT NULL
+            )
+        """)
+        self._conn.execute("""
+            CREATE TABLE IF NOT EXISTS leases (
+                partition INTEGER PRIMARY KEY,
+                owner TEXT NOT NULL,
+                expires_at REAL NOT NULL
+            )
+        """)
+
+    @staticmethod
+    def _hash(value):
+        return int.from_bytes(hashlib.sha1(str(value).encode()).digest()[:8], "big")
+
+    @staticmethod
+    def record_key(record):
+        """Partition key of a Teable record: its Telegram ID, or the record ID without one"""
+        return PartitionCoordinator.user_key(record.get("fields", {}).get("fldtDljIL5MBhcwoms4"), record.get("id"))
+
+    @staticmethod
+    def user_key(telegram_id, record_id):
+        """Partition key from a record's Telegram ID and record ID (see record_key)"""
+        return normalize_telegram_id(telegram_id) or record_id
+
+    def partition_of(self, key):
+        return self._hash(key) % self.partitions
+
+    def owns(self, record):
+        """Whether this replica currently holds the lease for a Teable record's partition"""
+        return self.partition_of(self.record_key(record)) in self.owned
+
+    def owns_user(self, telegram_id, record_id):
+        """Whether a record (by Telegram ID and record ID) is claimed by or may be claimed by this replica"""
+        with self._claims_lock:
+            return record_id in self._claims or self.partition_of(self.user_key(telegram_id, record_id)) in self.owned
+
+    def claim(self, telegram_id, record_id):
+        """
+        Check, right before a Telegram call or webhook for a record, that its partition is still ours.
+
+        Returns True if the record is already claimed or its partition is leased
+        to this replica and not being handed over; the partition then stays leased
+        until release(record_id).
+        """
+        partition = self.partition_of(self.user_key(telegram_id, record_id))
+        with self._claims_lock:
+            if record_id in self._claims:
+                return True
+            if partition not in self.owned:
+                return False
+            self._claims[record_id] = partition
+            return True
+
+    def release(self, record_id):
+        """Let the partition of a claimed record go once nothing else in it is claimed"""
+        with self._claims_lock:
+            self._claims.pop(record_id, None)
+
+    @property
+    def is_leader(self):
+        """The holder of partition 0 also runs the jobs that must only run once"""
+        return 0 in self.owned
+
+    def _desired_partitions(self, live_replicas):
+        return {
+            partition for partition in range(self.partitions)
+            if max(live_replicas, key=lambda replica: self._hash(f"{partition}:{replica}")) == self.replica_id
+        }
+
+    def heartbeat(self):
+        """Announce this replica, then claim, renew and release partition leases"""
+        now = time.time()
+        expires_at = now + self.lease_ttl
+        with self._lock:
+            self._conn.execute("BEGIN IMMEDIATE")
+            try:
+                self._conn.execute(
+                    "INSERT INTO replicas (replica_id, heartbeat_at) VALUES (?, ?) "
+                    "ON CONFLICT(replica_id) DO UPDATE SET heartbeat_at = excluded.heartbeat_at",
+                    (self.replica_id, now)
+                )
+                live_replicas = [row[0] for row in self._conn.execute(
+                    "SELECT replica_id FROM replicas WHERE heartbeat_at >= ?", (now - self.lease_ttl,)
+                )]
+                desired = self._desired_partitions(live_replicas)
+                held = {row[0] for row in self._conn.execute("SELECT partition FROM leases WHERE owner = ?", (self.replica_id,))}
+                # Partitions moving away take no new claims from here on; the ones with
+                # claimed records keep their lease until those are released
+                with self._claims_lock:
+                    self.owned = self.owned & desired
+                    draining = (held - desired) & set(self._claims.values())
+                self._conn.executemany(
+                    "DELETE FROM leases WHERE partition = ? AND owner = ?",
+                    [(partition, self.replica_id) for partition in held - desired - draining]
+                )
+                # Takes free and expired leases, renews our own, leaves live ones alone
+                self._conn.executemany(
+                    "INSERT INTO leases (partition, owner, expires_at) VALUES (?, ?, ?) "
+                    "ON CONFLICT(partition) DO UPDATE SET owner = excluded.owner, expires_at = excluded.expires_at "
+                    "WHERE leases.owner = excluded.owner OR leases.expires_at < ?",
+                    [(partition, self.replica_id, expires_at, now) for partition in desired | draining]
+                )
+                owned = frozenset(row[0] for row in self._conn.execute(
+                    "SELECT partition FROM leases WHERE owner = ? AND expires_at > ?", (self.replica_id, now)
+                )) - draining
+                # Forget replicas that have been gone for a while
+                self._conn.execute("DELETE FROM replicas WHERE heartbeat_at < ?", (now - 10 * self.lease_ttl,))
+                self._conn.execute("COMMIT")
+            except Exception:
+                self._conn.execute("ROLLBACK")
+                raise
+
+        if owned != self.owned or draining != self.draining:
+            logger.info(
+                f"Replica {self.replica_id} owns {len(owned)}/{self.partitions} partitions "
+                f"({len(live_replicas)} live replicas, {len(desired - owned)} waiting for a lease to be released, "
+                f"{len(draining)} kept until their claimed records are done)"
+            )
+        self.owned = owned
+        self.draining = frozenset(draining)
+        self._last_heartbeat = now
+        metrics.partitions_owned.set(len(owned))
+
+    def _run(self):
+        while not self._stopping.wait(self.heartbeat_interval):
+            try:
+                self.heartbeat()
+            except Exception as e:
+                logger.error(f"Partition heartbeat failed: {str(e)}")
+                # Our leases may have expired and moved on; stop working on them
+                if time.time() - self._last_heartbeat >= self.lease_ttl and self.owned:
+                    logger.warning(f"Dropping {len(self.owned)} partitions whose leases could not be renewed")
+                    self.owned = frozenset()
+                    metrics.partitions_owned.set(0)
+
+    def start(self):
+        """Claim the first partitions, then keep heartbeating in a background thread"""
+        self.heartbeat()
+        self._stopping.clear()
+        self._thread = threading.Thread(target=self._run, name="partition-heartbeat", daemon=True)
+        self._thread.start()
+
+    def stop(self):
+        """Release this replica's leases so the others take its partitions over at once"""
+        self._stopping.set()
+        if self._thread is not None:
+            self._thread.join(timeout=self.heartbeat_interval + 1)
+        self.owned = frozenset()
+        with self._lock:
+            self._conn.execute("DELETE FROM leases WHERE owner = ?", (self.replica_id,))
+            self._conn.execute("DELETE FROM replicas WHERE replica_id = ?", (self.replica_id,))
+            self._conn.close()
+
+class PollScheduler:
+    """
+    Adaptive interval between poll cycles.
+
+    Each idle cycle (one that found no records to work on) multiplies the
+    interval by `backoff`, up to max_interval, and a cycle that finds work
+    snaps it back to min_interval. The wait after a cycle is the interval minus
+    the time the cycle took, so cycles keep a steady cadence.
+    """
+    def __init__(self, min_interval=5, max_interval=60, backoff=2.0):
+        self.min_interval = max(0, min_interval)
+        self.max_interval = max(self.min_interval, max_interval)
+        self.backoff = max(1.0, backoff)
+        self.interval = self.min_interval
+        metrics.poll_interval_seconds.set(self.interval)
+
+    def record_cycle(self, found_records):
+        """Adjust the interval after a cycle that found `found_records` records"""
+        previous = self.interval
+        if found_records:
+            self.interval = self.min_interval
+        else:
+            self.interval = min(max(self.interval, 1) * self.backoff, self.max_interval)
+        if self.interval != previous:
+            logger.debug("Poll interval %s to %.1f seconds", "reset" if found_records else "backed off", self.interval)
+        metrics.poll_interval_seconds.set(self.interval)
+
+    def next_delay(self, cycle_duration):
+        """Seconds to wait before the next cycle, given how long the last one took"""
+        return max(0.0, self.interval - cycle_duration)
+
+class RecordPipeline:
+    """Runs polled and pushed records through the submitted, approved and refused stages"""
+    def __init__(self, poller, manager, processed_storage, concurrent_stages=True, submitted_concurrency=8, coordinator=None,
+                 max_approved_backlog=2000):
+        self.poller = poller
+        self.manager = manager
+        self.processed_storage = processed_storage
+        self.concurrent_stages = concurrent_stages
+        self.coordinator = coordinator
+        self.executors = {
+            "submitted": StageExecutor("submitted", submitted_concurrency),
+            "approved": StageExecutor("approved", 1),
+            "refused": StageExecutor("refused", 1)
+        }
+        # The invite lane: users waiting for or going through the approved stage, the
+        # record IDs it holds, and the records it finished with the (monotonic) time
+        # their status was written, since a read that started earlier still shows them
+        # as approved
+        self._approved_queue = collections.deque()
+        self._approved_ids = set()
+        self._approved_done = {}
+        self._approved_task = None
+        # Users waiting beyond this are left for a later cycle (they are still approved
+        # then), so a large backlog is never held in memory while the schedulers pace it
+        self.max_approved_backlog = max_approved_backlog
+        # Pages a stage may have waiting while the walk moves on (see run_cycle)
+        self.stage_queue_pages = 2
+        # Duplicate-detection index over "telegram" records. It is rebuilt lazily after
+        # every full sync and kept up to date from changed records in between.
+        self.telegram_index = None
+        # Count and order-independent digest of the record IDs the previous cycle found to work on (see run_cycle)
+        self._previous_work_digest = (0, 0)
+
+    async def run_cycle(self):
+        """
+        Poll Teable and run every stage once.
+
+        Returns the number of records to work on, or 0 when they are the same
+        records the previous cycle found, so records stuck in a status don't count
+        as activity.
+        """
+        with metrics.cycle_seconds.timer():
+            found_records = await self._run_cycle()
+
+        for executor in self.executors.values():
+            executor.log_stats()
+        return found_records
+
+    async def _run_cycle(self):
+        poller = self.poller
+        full_sync = poller.begin_cycle()
+        if full_sync:
+            # Rebuilt from every "telegram" record the first time a submitted record
+            # needs it (see process_submitted)
+            self.telegram_index = None
+
+        # One walk over every status this cycle needs. Each page is partitioned
+        # locally into the stage views and handed to the stages as it arrives, so
+        # only a few pages are held at a time. Approved records are walked even while
+        # the invite lane is busy, so users without a username and newly approved
+        # users are picked up without waiting for it. Between full syncs the changed
+        # "telegram" records keep the duplicate index current; the (changed)
+        # submitted records then wait for the end of the walk, since a later page
+        # may hold the member they duplicate.
+        statuses = ["submitted", "refused", "approved"]
+        hold_submitted = self.telegram_index is not None
+        if hold_submitted:
+            statuses.append("telegram")
+            self.telegram_index.reset_claims()
+
+        stages = {
+            "submitted": self._run_submitted_stage,
+            "refused": self._run_refused_stage,
+            "webhook": functools.partial(self.manager.queue_invite_webhooks, poller=poller)
+        }
+        queues = {name: asyncio.Queue(maxsize=self.stage_queue_pages) for name in stages} if self.concurrent_stages else {}
+        errors = []
+        consumers = [asyncio.ensure_future(self._consume_pages(queue, stages[name], errors)) for name, queue in queues.items()]
+
+        async def dispatch(name, items):
+            if not items:
+                return
+            if name in queues:
+                await queues[name].put(items)
+            else:
+                await stages[name](items)
+
+        fetched_at = time.monotonic()
+        held_submitted = []
+        work_count = work_digest = 0
+        try:
+            async for views in poller.fetch_pages(statuses):
+                if hold_submitted:
+                    self.telegram_index.update(views.pop("telegram"))
+                views = {status: self._owned(records) for status, records in views.items()}
+                approved_users = poller.to_approved_users(views["approved"])
+                refused_users = poller.to_refused_users(views["refused"])
+                work_ids = [record.get("id") for record in views["submitted"]] + [user['record_id'] for user in approved_users + refused_users]
+                work_count += len(work_ids)
+                work_digest = (work_digest + sum(hash(record_id) for record_id in work_ids)) & 0xFFFFFFFFFFFFFFFF
+
+                if hold_submitted:
+                    held_submitted.extend(views["submitted"])
+                else:
+                    await dispatch("submitted", views["submitted"])
+                await dispatch("refused", refused_users)
+                await dispatch("webhook", self._route_approved(approved_users, fetched_at))
+            await dispatch("submitted", held_submitted)
+        finally:
+            for queue in queues.values():
+                await queue.put(None)
+            await asyncio.gather(*consumers)
+            await poller.run_io(poller.status_writer.flush)
+        if errors:
+            raise errors[0]
+
+        # Approved records are walked even while the invite lane is busy, so the
+        # high-water mark can move every cycle
+        poller.end_cycle()
+
+        # A digest instead of the IDs themselves keeps memory flat however large the table is
+        previous_digest, self._previous_work_digest = self._previous_work_digest, (work_count, work_digest)
+        return work_count if self._previous_work_digest != previous_digest else 0
+
+    @staticmethod
+    async def _consume_pages(queue, stage, errors):
+        """Run a stage on each page put on `queue` until the walk is done (a None page), collecting its errors"""
+        while True:
+            items = await queue.get()
+            if items is None:
+                return
             try:
-                if hasattr(chat, 'megagroup') and chat.megagroup:
-                    title = str(chat.title)
-                    if len(title) > 30:
-                        title = title[:27] + "..."
-                    
-                    groups.append({
-                        'title': title,
-                        'id': str(chat.id),
-                        'access_hash': str(chat.access_hash),
-                        'members_count': str(getattr(chat, 'participants_count', 'N/A'))
-                    })
+                await stage(items)
             except Exception as e:
-                logger.error(f"Error processing chat: {str(e)}")
+                errors.append(e)
+
+    def _owned(self, records):
+        """The records in partitions leased to this replica"""
+        if self.coordinator is None:
+            return records
+        return [record for record in records if self.coordinator.owns(record)]
+
+    @staticmethod
+    def _log_approved_stage_result(task):
+        if not task.cancelled() and task.exception() is not None:
+            error = task.exception()
+            logger.error(f"Error in approved stage: {str(error)}")
+            logger.error("".join(traceback.format_exception(type(error), error, error.__traceback__)))
+
+    async def _run_submitted_stage(self, submitted_records):
+        for batch in batched(submitted_records, self.poller.page_size):
+            await self.process_submitted(batch)
+        await self.poller.run_io(self.poller.status_writer.flush)
+
+    def _route_approved(self, users, fetched_at):
+        """
+        Queue approved users with a username for the invite lane and return the
+        ones without one: only n8n can invite those, so they skip the lane and
+        its schedulers and are handed to the invite webhook right away.
+        """
+        self._queue_approved([user for user in users if user.get('telegram_username')], fetched_at)
+        return [user for user in users if not user.get('telegram_username')]
+
+    def _queue_approved(self, users, fetched_at):
+        """
+        Hand approved users to the invite lane without waiting for it.
+
+        Users the lane already holds, and users it finished after `fetched_at`
+        (when their records were read), are skipped, and so is everyone once
+        max_approved_backlog users are waiting. Returns the number of users that
+        were queued.
+        """
+        # Reads from now on show the records finished before this one with their new status
+        self._approved_done = {record_id: done_at for record_id, done_at in self._approved_done.items() if done_at >= fetched_at}
+        queued = 0
+        for user in users:
+            if user['record_id'] in self._approved_ids or user['record_id'] in self._approved_done:
+                logger.debug("Approved record %s is already in the invite lane", user['record_id'], extra=SAMPLED)
+                continue
+            if len(self._approved_queue) >= self.max_approved_backlog:
+                logger.debug("Invite lane backlog is full, leaving the other approved users for a later cycle")
+                break
+            self._approved_ids.add(user['record_id'])
+            self._approved_queue.append(user)
+            queued += 1
+        if self._approved_queue and (self._approved_task is None or self._approved_task.done()):
+            self._approved_task = asyncio.ensure_future(self._run_approved_stage())
+            self._approved_task.add_done_callback(self._log_approved_stage_result)
+        return queued
+
+    async def _run_approved_stage(self):
+        # Approved users are handled in page-sized batches so status writes and
+        # accepted webhooks go out while later batches wait for the invite schedulers
+        while self._approved_queue:
+            batch = [self._approved_queue.popleft() for _ in range(min(len(self._approved_queue), self.poller.page_size))]
+            try:
+                await self.executors["approved"].run(self.process_approved, [batch])
+            finally:
+                await self.poller.run_io(self.poller.status_writer.flush)
+                done_at = time.monotonic()
+                for user in batch:
+                    self._approved_ids.discard(user['record_id'])
+                    self._approved_done[user['record_id']] = done_at
+
+    async def _run_refused_stage(self, refused_users):
+        for batch in batched(refused_users, self.poller.page_size):
+            await self.executors["refused"].run(self.process_refused, [batch])
+        await self.poller.run_io(self.poller.status_writer.flush)
+
+    async def reconcile_in_flight(self):
+        """Commit, finish or roll back the journaled transitions the last run left open"""
+        poller = self.poller
+        state_machine = poller.state_machine
+        transitions = state_machine.in_flight()
+        if not transitions:
+            return
+        logger.info(f"Reconciling {len(transitions)} in-flight record transitions")
+        records = await poller.run_io(list, poller.get_records_by_ids([t["record_id"] for t in transitions]))
+        statuses = {record.get("id"): record.get("fields", {}).get(STATUS_FIELD_ID) for record in records}
+
+        completed = rolled_back = 0
+        for transition in transitions:
+            record_id = transition["record_id"]
+            if record_id not in statuses:
+                continue
+            status = statuses[record_id]
+            if status == transition["to"]:
+                state_machine.commit({record_id: status})
+                completed += 1
+                continue
+            if status != transition["from"]:
+                state_machine.abort(record_id, f"record is now {status}")
+                rolled_back += 1
+                continue
+
+            user = {"record_id": record_id, **transition["context"]}
+            if not poller.may_work_on(record_id, user.get('telegram_id')):
+                continue
+            applied = transition["applied"]
+            if not applied and transition["to"] == "telegram":
+                applied = await self.manager.is_participant(user) is True
+            elif not applied and transition["to"] == "invited":
+                applied = await poller.run_io(poller.outbox.has_entry, f"invite:{state_machine.transition_key(record_id)}")
+            if applied:
+                state_machine.applied(record_id)
+            if not applied:
+                state_machine.abort(record_id, "the Telegram call did not go through")
+                rolled_back += 1
                 continue
-        
-        if not groups:
-            logger.warning("No groups found!")
-            return []
-        
-        logger.info(f"Found {len(groups)} groups")
-        for g in groups:
-            logger.debug(f"Group: {g['title']} (ID: {g['id']}, Members: {g['members_count']})")
-        
-        target_id = str(self.group_id)
-        target_group = next((g for g in groups if g['id'] == target_id), None)
-        
-        if target_group:
-            logger.info(f"Target group found: {target_group['title']}")
-            logger.debug(f"Access Hash: {target_group['access_hash']}")
-        else:
-            logger.warning(f"Target group with ID {target_id} not found!")
-        
-        return groups
 
-    def add_users(self, users, processed_storage, poller):
-        """Add multiple users to the group"""
-        logger.info(f"Adding {len(users)} users to group")
+            if transition["to"] == "telegram":
+                await poller.run_io(self._queue_accepted_webhook, user)
+            elif transition["to"] == "removed":
+                self.processed_storage.mark_as_processed(
+                    poller.group_router.processed_key(user['telegram_id'], user.get('group_id')), 'removed'
+                )
+            poller.status_writer.set_status(record_id, transition["to"])
+            completed += 1
+
+        await poller.run_io(poller.status_writer.flush)
+        logger.info(f"Reconciled in-flight transitions: {completed} completed without new Telegram calls, {rolled_back} rolled back")
+
+    async def process_record_ids(self, record_ids):
+        """Fetch pushed records by ID and route each one to the stage matching its status"""
+        logger.info(f"Processing {len(record_ids)} pushed record changes")
+        submitted_records, approved_records, refused_records = [], [], []
+        fetched_at = time.monotonic()
+        records = await self.poller.run_io(list, self.poller.get_records_by_ids(record_ids))
+        for record in self._owned(records):
+            status = record.get("fields", {}).get(STATUS_FIELD_ID)
+            if status == "submitted":
+                submitted_records.append(record)
+            elif status == "approved":
+                user = self.poller.to_approved_user(record)
+                if user:
+                    approved_records.append(user)
+            elif status == "refused":
+                user = self.poller.to_refused_user(record)
+                if user:
+                    refused_records.append(user)
+            else:
+                logger.debug("Ignoring pushed record %s with status %s", record.get('id'), status, extra=SAMPLED)
+
+        if self.telegram_index is not None:
+            self.telegram_index.reset_claims()
+        # Invites wait for the schedulers, so they never hold up the poll loop
+        webhook_users = self._route_approved(approved_records, fetched_at)
+        stages = []
+        if webhook_users:
+            stages.append(self.manager.queue_invite_webhooks(webhook_users, self.poller))
+        if submitted_records:
+            stages.append(self.process_submitted(submitted_records))
+        if refused_records:
+            stages.append(self.process_refused(refused_records))
         try:
-            target_group = self.client.get_entity(self.group_id)
-            if not isinstance(target_group, Channel):
-                raise ValueError("Target is not a channel/group")
+            await asyncio.gather(*stages)
+        finally:
+            await self.poller.run_io(self.poller.status_writer.flush)
+
+    async def process_submitted(self, submitted_records):
+        """
+        Check submitted records for duplicates and notify n8n about new applications.
+
+        Duplicate decisions are made one record at a time, in order, so the first
+        submission of a Telegram ID always wins. The received webhooks of the
+        remaining records are then sent concurrently by the submitted executor.
+        """
+        poller = self.poller
+        metrics.stage_records.inc(len(submitted_records), stage="submitted")
+        new_submissions = []
+        for record in submitted_records:
+            fields = record.get("fields", {})
+            telegram_id = fields.get("fldtDljIL5MBhcwoms4")  # This is the actual field name from Teable
+            telegram_username = fields.get("fldt5LbTEuUWxq7iboV", "")  # This appears to be the username field from logs
+            name = fields.get(poller.first_name_field_id or "First name", "")
+            record_id = record.get("id")
             
-            logger.info(f"Using group: {target_group.title}")
-            target_group_entity = InputPeerChannel(target_group.id, target_group.access_hash)
-        except Exception as e:
-            logger.error(f"Error getting group entity: {str(e)}")
-            group_hash = os.getenv("TELEGRAM_GROUP_HASH")
-            if not group_hash:
-                logger.error("Could not find group and no access hash provided")
-                raise ValueError("Could not find group and no access hash provided")
-            target_group_entity = InputPeerChannel(self.group_id, int(group_hash))
+            logger.debug("Record %s fields: %s", record_id, LazyJson(fields), extra=SAMPLED)
+            logger.debug("Telegram ID from record: %s (type: %s)", telegram_id, type(telegram_id).__name__, extra=SAMPLED)
+            
+            if telegram_id:
+                logger.info(f"Processing submitted record {record_id}")
+                
+                # Build the duplicate index once per cycle, only when there is work for it
+                if self.telegram_index is None:
+                    self.telegram_index = await poller.run_io(
+                        TelegramIdIndex.from_records, poller.get_records_with_filter("telegram", incremental=False),
+                        poller.group_router.route
+                    )
 
-        successful_records = []
+                group_id = poller.group_router.route(record)
+                existing_record_id = self.telegram_index.find_duplicate(telegram_id, record_id, group_id)
+                if existing_record_id:
+                    logger.info(f"Found existing record {existing_record_id} with Telegram ID {telegram_id}")
+                    logger.info(f"Updating record {record_id} to double status")
+                    poller.state_machine.begin(record_id, "submitted", "double")
+                    poller.status_writer.set_double_status(record_id, telegram_id)
+                    continue
+
+                # Claim the ID so later submissions in the same batch are detected as duplicates
+                self.telegram_index.add(telegram_id, record_id, group_id)
+
+                # No duplicate found, proceed with normal flow
+                logger.info(f"No duplicate found for Telegram ID {telegram_id}, proceeding with webhook")
+                new_submissions.append((record_id, {
+                    "telegramID": telegram_id,
+                    "telegramUsername": telegram_username,
+                    "name": name
+                }))
+
+        await self.executors["submitted"].run(self._send_received_webhook, new_submissions)
+
+    async def _send_received_webhook(self, submission):
+        """Notify n8n about one new application, trying the test webhook before the main one"""
+        poller = self.poller
+        record_id, webhook_payload = submission
+        if not poller.may_work_on(record_id, webhook_payload["telegramID"]):
+            return
+        poller.state_machine.begin(record_id, "submitted", "pending")
+
+        # Try test webhook first if configured
+        test_webhook_success = False
+        if poller.n8n_webhook_test_received_url:
+            logger.info(f"Attempting test webhook for record {record_id}")
+            test_webhook_success = await poller.run_io(
+                poller.call_webhook,
+                poller.n8n_webhook_test_received_url, 
+                webhook_payload, 
+                True
+            )
+            if test_webhook_success:
+                logger.info(f"Test webhook successful for record {record_id}, updating to pending")
+                poller.status_writer.set_status(record_id, 'pending')
         
-        def wait_if_needed():
-            with self.add_user_lock:
-                current_time = time.time()
-                time_since_last_add = current_time - self.last_user_add_time
-                
-                if time_since_last_add < 60:
-                    wait_time = 60 - time_since_last_add
-                    logger.debug(f"Rate limiting: waiting {wait_time:.2f} seconds")
-                    time.sleep(wait_time)
-                
-                self.last_user_add_time = time.time()
+        # If test webhook not configured or failed, try main webhook
+        if not test_webhook_success:
+            if poller.n8n_webhook_received_url:
+                logger.info(f"Attempting main webhook for record {record_id}")
+                if await poller.run_io(poller.call_webhook, poller.n8n_webhook_received_url, webhook_payload):
+                    logger.info(f"Main webhook successful for record {record_id}, updating to pending")
+                    poller.status_writer.set_status(record_id, 'pending')
+                else:
+                    logger.warning(f"Main webhook failed for record {record_id}, status will remain submitted")
+                    poller.state_machine.abort(record_id, "received webhook failed")
+            else:
+                logger.warning("No webhooks configured, record will remain in submitted status")
+                poller.state_machine.abort(record_id, "no received webhook configured")
+
+    async def process_approved(self, approved_records):
+        """Add approved users to the group and notify n8n"""
+        poller = self.poller
+        logger.info(f"Processing {len(approved_records)} approved records")
+        metrics.stage_records.inc(len(approved_records), stage="approved")
+        successful_records = await self.manager.add_users(approved_records, self.processed_storage, poller)
         
-        for user in users:
-            try:
-                wait_if_needed()
-
-                user_entity = None
-                # Only try to add users who have a username
-                if not user.get('telegram_username'):
-                    logger.info(f"User {user['telegram_id']} has no username, sending to webhook flow")
-                    webhook_payload = {
-                        "telegramID": user['telegram_id'],
-                        "telegramUsername": ""
-                    }
+        if successful_records:
+            approved_by_id = {r['record_id']: r for r in approved_records}
+            for record_id in successful_records:
+                if record_id in approved_by_id:
+                    await poller.run_io(self._queue_accepted_webhook, approved_by_id[record_id])
 
-                    # Try test webhook first
-                    test_webhook_url = os.getenv("N8N_WEBHOOK_INVITE_TEST_URL")
-                    if test_webhook_url:
-                        try:
-                            logger.info(f"Calling test invite webhook for user {user['telegram_id']}")
-                            response = requests.post(test_webhook_url, json=webhook_payload)
-                            response.raise_for_status()
-                            logger.info(f"Successfully called test invite webhook for user {user['telegram_id']}")
-                            # Update status to invited
-                            poller.update_status([user['record_id']], 'invited')
-                            continue
-                        except Exception as webhook_error:
-                            logger.warning(f"Test invite webhook failed: {str(webhook_error)}, falling back to production webhook")
-
-                    # Fall back to production webhook
-                    prod_webhook_url = os.getenv("N8N_WEBHOOK_INVITE_URL")
-                    if prod_webhook_url:
-                        try:
-                            logger.info(f"Calling production invite webhook for user {user['telegram_id']}")
-                            response = requests.post(prod_webhook_url, json=webhook_payload)
-                            response.raise_for_status()
-                            logger.info(f"Successfully called production invite webhook for user {user['telegram_id']}")
-                            # Update status to invited
-                            if poller.update_status([user['record_id']], 'invited'):
-                                logger.info(f"Successfully updated status to 'invited' for user {user['telegram_id']}")
-                            else:
-                                logger.error(f"Failed to update status to 'invited' for user {user['telegram_id']}")
-                        except Exception as webhook_error:
-                            logger.error(f"Production invite webhook failed: {str(webhook_error)}")
-                            # Check if it's a 500 error
-                            if hasattr(webhook_error, 'response') and webhook_error.response.status_code == 500:
-                                logger.info(f"Server returned 500 error, updating status to blocked for user {user['telegram_id']}")
-                                poller.update_status([user['record_id']], 'blocked')
-                    continue
+            for record_id in successful_records:
+                poller.status_writer.set_status(record_id, 'telegram')
+            logger.info(f"Successfully processed {len(successful_records)} approved records")
 
-                try:
-                    logger.debug(f"Trying to add user by username: {user['telegram_username']}")
-                    user_entity = self.client.get_input_entity(user['telegram_username'])
-                except ValueError as e:
-                    logger.warning(f"Could not find user by username: {str(e)}")
-                    continue
+    def _queue_accepted_webhook(self, approved_record):
+        """
+        Durably queue the n8n notification that a user was added (test webhook tried first).
 
-                if not isinstance(user_entity, InputPeerUser):
-                    logger.warning(f"Skipping user {user['telegram_id']}: Not a user entity")
-                    continue
+        The webhook is keyed on the journaled invite, which stays open until the
+        'telegram' status is stored: when a failed status write has the record
+        replayed, the existing entry is found instead of a new one being sent.
+        """
+        poller = self.poller
+        record_id = approved_record['record_id']
+        if not poller.may_work_on(record_id, approved_record['telegram_id']):
+            return
+        transition_key = poller.state_machine.transition_key(record_id)
+        webhook_payload = {
+            "telegramID": approved_record['telegram_id'],
+            "telegramUsername": approved_record['telegram_username'],
+            "recordId": approved_record['record_id'],
+            "telegramGroupId": approved_record.get('group_id')
+        }
+        poller.outbox.enqueue(
+            "accepted",
+            [poller.n8n_webhook_test_accepted_url, poller.n8n_webhook_accepted_url],
+            webhook_payload,
+            f"accepted:{transition_key or record_id}",
+            record_id=record_id,
+            redeliver=False
+        )
+        if transition_key is None and poller.coordinator is not None:
+            # No transition to release the claim when it closes
+            poller.coordinator.release(record_id)
 
-                logger.info(f"Adding user {user['telegram_id']} to group")
-                
-                self.client(InviteToChannelRequest(
-                    channel=target_group_entity,
-                    users=[user_entity]
-                ))
-                
-                successful_records.append(user['record_id'])
-                logger.info(f"Successfully added user {user['telegram_id']}")
-                
-            except PeerFloodError:
-                logger.error("Telegram flood error detected. Stopping user addition.")
+    async def process_refused(self, refused_records):
+        """Remove refused users from the group"""
+        logger.info(f"Processing {len(refused_records)} refused records")
+        metrics.stage_records.inc(len(refused_records), stage="refused")
+        successful_records = await self.manager.remove_users(refused_records, self.processed_storage, self.poller)
+        
+        if successful_records:
+            for record_id in successful_records:
+                self.poller.status_writer.set_status(record_id, 'removed')
+            logger.info(f"Successfully processed {len(successful_records)} refused records")
+
+class MembershipReconciler:
+    """
+    Compares the actual members of each target group with the Teable statuses.
+
+    The participant list is paged with GetParticipantsRequest and stored as a
+    compact snapshot: the user IDs of each page plus the page's Telegram hash.
+    The next run sends those hashes back, so pages that did not change come
+    back as ChannelParticipantsNotModified without their member list.
+
+    The snapshot is diffed against Teable: users of 'telegram' records who are
+    not in the group are missing, and members whose only record is 'removed'
+    are intruders. With apply enabled, missing users are moved back to
+    'approved' so the invite stage adds them again, and intruders are removed
+    again; otherwise the diff is only logged. A group whose diff exceeds
+    max_corrections is only logged as well, since that usually means a bad
+    snapshot or group mapping rather than real drift.
+
+    Telegram lists at most 10000 members through ChannelParticipantsRecent.
+    """
+    PAGE_SIZE = 200
+    PAGE_DELAY = 0.5
+
+    def __init__(self, poller, manager, processed_storage, snapshot_file="membership_snapshot.json", apply=False, max_corrections=100):
+        self.poller = poller
+        self.manager = manager
+        self.processed_storage = processed_storage
+        self.snapshot_file = snapshot_file
+        self.apply = apply
+        self.max_corrections = max_corrections
+        self.snapshots = self._load_snapshots()
+
+    def _load_snapshots(self):
+        try:
+            if os.path.exists(self.snapshot_file):
+                with open(self.snapshot_file, 'r') as f:
+                    return json.load(f)
+        except Exception as e:
+            logger.error(f"Error loading membership snapshot: {str(e)}")
+        return {}
+
+    @staticmethod
+    def participants_hash(user_ids):
+        """Telegram's 64-bit pagination hash over the user IDs of one page"""
+        value = 0
+        for user_id in user_ids:
+            value ^= value >> 21
+            value ^= (value << 35) & 0xFFFFFFFFFFFFFFFF
+            value ^= value >> 4
+            value = (value + user_id) & 0xFFFFFFFFFFFFFFFF
+        return value - (1 << 64) if value >= 1 << 63 else value
+
+    async def fetch_members(self, account, group_id):
+        """Page through a group's participants, reusing unchanged pages of the last snapshot. Returns a set of user IDs."""
+        channel = await self.manager._get_target_group_entity(account, group_id)
+        previous_pages = self.snapshots.get(str(group_id), {}).get("pages", [])
+        pages = []
+        reused = 0
+        offset = 0
+        while True:
+            previous = previous_pages[len(pages)] if len(pages) < len(previous_pages) else None
+            result = await account.client(GetParticipantsRequest(
+                channel, ChannelParticipantsRecent(), offset, self.PAGE_SIZE, previous["hash"] if previous else 0
+            ))
+            if isinstance(result, ChannelParticipantsNotModified):
+                user_ids = previous["ids"]
+                reused += 1
+            else:
+                user_ids = [participant.user_id for participant in result.participants if hasattr(participant, "user_id")]
+            pages.append({"hash": self.participants_hash(user_ids), "ids": user_ids})
+            offset += len(user_ids)
+            if len(user_ids) < self.PAGE_SIZE:
                 break
-            except UserPrivacyRestrictedError:
-                logger.warning(f"User {user['telegram_id']} has privacy restrictions")
-                
-                # Call webhook for users with privacy restrictions
-                webhook_payload = {
-                    "telegramID": user['telegram_id'],
-                    "telegramUsername": user.get('telegram_username', '')
-                }
-
-                # Try test webhook first
-                test_webhook_url = os.getenv("N8N_WEBHOOK_INVITE_TEST_URL")
-                if test_webhook_url:
-                    try:
-                        logger.info(f"Calling test invite webhook for user {user['telegram_id']}")
-                        response = requests.post(test_webhook_url, json=webhook_payload)
-                        response.raise_for_status()
-                        logger.info(f"Successfully called test invite webhook for user {user['telegram_id']}")
-                        # Update status to invited
-                        poller.update_status([user['record_id']], 'invited')
-                        continue
-                    except Exception as webhook_error:
-                        logger.warning(f"Test invite webhook failed: {str(webhook_error)}, falling back to production webhook")
-
-                # Fall back to production webhook if test webhook failed or doesn't exist
-                prod_webhook_url = os.getenv("N8N_WEBHOOK_INVITE_URL")
-                if prod_webhook_url:
-                    try:
-                        logger.info(f"Calling production invite webhook for user {user['telegram_id']}")
-                        response = requests.post(prod_webhook_url, json=webhook_payload)
-                        response.raise_for_status()
-                        logger.info(f"Successfully called production invite webhook for user {user['telegram_id']}")
-                        # Update status to invited
-                        if poller.update_status([user['record_id']], 'invited'):
-                            logger.info(f"Successfully updated status to 'invited' for user {user['telegram_id']}")
-                        else:
-                            logger.error(f"Failed to update status to 'invited' for user {user['telegram_id']}")
-                    except Exception as webhook_error:
-                        logger.error(f"Production invite webhook failed: {str(webhook_error)}")
-                        # Check if it's a 500 error
-                        if hasattr(webhook_error, 'response') and webhook_error.response.status_code == 500:
-                            logger.info(f"Server returned 500 error, updating status to blocked for user {user['telegram_id']}")
-                            poller.update_status([user['record_id']], 'blocked')
-                        
-                continue
-            except ChannelInvalidError:
-                logger.error("Invalid channel error. Attempting to refresh group entity...")
-                try:
-                    target_group = self.client.get_entity(self.group_id)
-                    target_group_entity = InputPeerChannel(target_group.id, target_group.access_hash)
-                    logger.info("Successfully refreshed group entity")
-                    continue
-                except Exception as refresh_error:
-                    logger.error(f"Failed to refresh group entity: {str(refresh_error)}")
-                    break
-            except UserNotMutualContactError:
-                logger.warning(f"User {user['telegram_id']} is not a mutual contact")
-                
-                # Call webhook for users who are not mutual contacts
-                webhook_payload = {
-                    "telegramID": user['telegram_id'],
-                    "telegramUsername": user.get('telegram_username', '')
-                }
-
-                # Try test webhook first
-                test_webhook_url = os.getenv("N8N_WEBHOOK_INVITE_TEST_URL")
-                if test_webhook_url:
-                    try:
-                        logger.info(f"Calling test invite webhook for user {user['telegram_id']}")
-                        response = requests.post(test_webhook_url, json=webhook_payload)
-                        response.raise_for_status()
-                        logger.info(f"Successfully called test invite webhook for user {user['telegram_id']}")
-                        # Update status to invited
-                        poller.update_status([user['record_id']], 'invited')
-                        continue
-                    except Exception as webhook_error:
-                        logger.warning(f"Test invite webhook failed: {str(webhook_error)}, falling back to production webhook")
-
-                # Fall back to production webhook if test webhook failed or doesn't exist
-                prod_webhook_url = os.getenv("N8N_WEBHOOK_INVITE_URL")
-                if prod_webhook_url:
-                    try:
-                        logger.info(f"Calling production invite webhook for user {user['telegram_id']}")
-                        response = requests.post(prod_webhook_url, json=webhook_payload)
-                        response.raise_for_status()
-                        logger.info(f"Successfully called production invite webhook for user {user['telegram_id']}")
-                        # Update status to invited
-                        if poller.update_status([user['record_id']], 'invited'):
-                            logger.info(f"Successfully updated status to 'invited' for user {user['telegram_id']}")
-                        else:
-                            logger.error(f"Failed to update status to 'invited' for user {user['telegram_id']}")
-                    except Exception as webhook_error:
-                        logger.error(f"Production invite webhook failed: {str(webhook_error)}")
-                        # Check if it's a 500 error
-                        if hasattr(webhook_error, 'response') and webhook_error.response.status_code == 500:
-                            logger.info(f"Server returned 500 error, updating status to blocked for user {user['telegram_id']}")
-                            poller.update_status([user['record_id']], 'blocked')
-                        
+            await asyncio.sleep(self.PAGE_DELAY)
+
+        self.snapshots[str(group_id)] = {"taken_at": datetime.now(timezone.utc).isoformat(), "pages": pages}
+        members = {user_id for page in pages for user_id in page["ids"]}
+        logger.info(f"Group {group_id} has {len(members)} listed members ({reused} of {len(pages)} pages unchanged)")
+        return members
+
+    def _teable_members(self):
+        """Map group -> Telegram ID -> record ID for the 'telegram' and the 'removed' records"""
+        router = self.poller.group_router
+        statuses = {"telegram": {}, "removed": {}}
+        for views in self.poller.fetch_by_status(tuple(statuses), incremental=False):
+            for status, records in views.items():
+                by_group = statuses[status]
+                for record in records:
+                    telegram_id = normalize_telegram_id(record.get("fields", {}).get("fldtDljIL5MBhcwoms4"))
+                    group_id = router.route(record)
+                    if telegram_id and telegram_id.isdigit() and group_id is not None:
+                        by_group.setdefault(group_id, {})[int(telegram_id)] = {
+                            "telegram_id": int(telegram_id),
+                            "telegram_username": record.get("fields", {}).get("fldt5LbTEuUWxq7iboV", ""),
+                            "record_id": record.get("id"),
+                            "group_id": group_id
+                        }
+        return statuses["telegram"], statuses["removed"]
+
+    async def run(self):
+        """Snapshot every target group, diff it against Teable and apply (or log) the corrections"""
+        accounts = self.manager.pool.healthy_accounts()
+        if not accounts:
+            logger.warning("No Telegram account available for membership reconciliation")
+            return {}
+        expected_by_group, removed_by_group = await self.poller.run_io(self._teable_members)
+
+        report = {}
+        for group_id in self.poller.group_router.groups:
+            try:
+                members = await self.fetch_members(accounts[0], group_id)
+            except FloodWaitError as e:
+                logger.warning(f"Telegram asked to wait {e.seconds} seconds while listing group {group_id}, reconciling it next time")
                 continue
             except Exception as e:
-                logger.error(f"Unexpected error while adding user {user['telegram_id']}: {str(e)}")
-                logger.error(traceback.format_exc())
+                logger.error(f"Could not list the members of group {group_id}: {str(e)}")
+                continue
+            expected = expected_by_group.get(group_id, {})
+            removed = removed_by_group.get(group_id, {})
+            missing = [user for telegram_id, user in expected.items() if telegram_id not in members]
+            intruders = [user for telegram_id, user in removed.items() if telegram_id in members and telegram_id not in expected]
+            untracked = len(members - expected.keys() - removed.keys())
+            report[group_id] = {"members": len(members), "missing": len(missing), "intruders": len(intruders), "untracked": untracked}
+            logger.info(f"Membership of group {group_id}: {len(missing)} 'telegram' users missing, "
+                        f"{len(intruders)} 'removed' users present, {untracked} members without a telegram/removed record")
 
-        return successful_records
-    
-    def close(self):
-        """Close the Telegram client connection"""
-        logger.info("Closing Telegram client connection")
-        self.client.disconnect()
+            if not self.apply or not (missing or intruders):
+                continue
+            if len(missing) + len(intruders) > self.max_corrections:
+                logger.error(f"Not correcting group {group_id}: {len(missing) + len(intruders)} differences exceed "
+                             f"MEMBERSHIP_MAX_CORRECTIONS ({self.max_corrections})")
+                continue
+            await self._correct(missing, intruders)
+
+        await self.poller.run_io(write_json_atomic, self.snapshot_file, self.snapshots)
+        return report
+
+    async def _correct(self, missing, intruders):
+        poller = self.poller
+        for user in missing:
+            logger.info(f"User {user['telegram_id']} is not in group {user['group_id']}, sending record {user['record_id']} back to approved")
+            poller.state_machine.begin(user['record_id'], "telegram", "approved")
+            poller.status_writer.set_status(user['record_id'], 'approved')
+        if intruders:
+            removed_records = await self.manager.remove_users(intruders, self.processed_storage, poller, skip_processed=False, partitioned=False)
+            for record_id in removed_records:
+                poller.status_writer.set_status(record_id, 'removed')
+        await poller.run_io(poller.status_writer.flush)
+
+class RecordChangeReceiver:
+    """
+    Embedded asyncio HTTP endpoint for record-change notifications.
+
+    Teable (or an n8n relay) POSTs JSON containing record IDs, e.g.
+    {"recordIds": ["rec..."]} or {"record": {"id": "rec..."}}. The server runs
+    on its own thread and event loop and only collects IDs; the main loop
+    drains them with wait_for_record_ids() and processes them itself.
+    """
+    MAX_BODY_BYTES = 1024 * 1024
+
+    def __init__(self, host="127.0.0.1", port=8787, path="/teable/record-change", secret=None, table_id=None):
+        self.host = host
+        self.port = port
+        self.path = path
+        self.secret = secret
+        self.table_id = table_id
+        self._pending_ids = set()
+        self._lock = threading.Lock()
+        self._event = threading.Event()
+        self._loop = None
+        self._server = None
+        self._thread = None
+        self._started = threading.Event()
+
+    def start(self):
+        """Start the HTTP server in a background thread"""
+        self._thread = threading.Thread(target=self._run, name="record-change-receiver", daemon=True)
+        self._thread.start()
+        self._started.wait(timeout=10)
+        logger.info(f"Record-change receiver listening on http://{self.host}:{self.port}{self.path}")
+
+    def _run(self):
+        self._loop = asyncio.new_event_loop()
+        asyncio.set_event_loop(self._loop)
+        try:
+            self._server = self._loop.run_until_complete(
+                asyncio.start_server(self._handle_connection, self.host, self.port)
+            )
+            # Pick up the actual port when an ephemeral one (0) was requested
+            self.port = self._server.sockets[0].getsockname()[1]
+        except OSError as e:
+            logger.error(f"Record-change receiver failed to start: {str(e)}")
+            self._started.set()
+            return
+        self._started.set()
+        self._loop.run_forever()
+        self._server.close()
+        self._loop.run_until_complete(self._server.wait_closed())
+        self._loop.close()
+
+    def stop(self):
+        """Stop the HTTP server"""
+        if self._loop and self._loop.is_running():
+            self._loop.call_soon_threadsafe(self._loop.stop)
+        if self._thread:
+            self._thread.join(timeout=5)
+
+    def wait_for_record_ids(self, timeout):
+        """Block up to `timeout` seconds for pushed record IDs and return the ones received"""
+        self._event.wait(timeout)
+        with self._lock:
+            record_ids = list(self._pending_ids)
+            self._pending_ids.clear()
+            self._event.clear()
+        return record_ids
+
+    def add_record_ids(self, record_ids):
+        """Queue record IDs for processing by the main loop"""
+        if not record_ids:
+            return
+        with self._lock:
+            self._pending_ids.update(record_ids)
+            self._event.set()
+
+    @staticmethod
+    def extract_record_ids(payload):
+        """Collect Teable record IDs from a notification payload of any reasonable shape"""
+        record_ids = []
+
+        def collect(value, depth=0):
+            if depth > 5:
+                return
+            if isinstance(value, str):
+                if value.startswith("rec"):
+                    record_ids.append(value)
+            elif isinstance(value, list):
+                for item in value:
+                    collect(item, depth + 1)
+            elif isinstance(value, dict):
+                for key in ("id", "recordId", "recordIds"):
+                    if key in value:
+                        collect(value[key], depth + 1)
+                for key in ("record", "records", "payload", "data", "body"):
+                    if key in value:
+                        collect(value[key], depth + 1)
+
+        collect(payload)
+        return list(dict.fromkeys(record_ids))
+
+    async def _handle_connection(self, reader, writer):
+        status, body = 500, {"error": "internal error"}
+        try:
+            status, body = await self._handle_request(reader)
+        except (asyncio.IncompleteReadError, ValueError) as e:
+            status, body = 400, {"error": f"malformed request: {str(e)}"}
+        except Exception as e:
+            logger.error(f"Record-change receiver error: {str(e)}")
+        finally:
+            reason = {202: "Accepted", 400: "Bad Request", 401: "Unauthorized", 404: "Not Found",
+                      405: "Method Not Allowed", 413: "Payload Too Large"}.get(status, "Internal Server Error")
+            response_body = json.dumps(body).encode()
+            writer.write(
+                f"HTTP/1.1 {status} {reason}\r\n"
+                f"Content-Type: application/json\r\n"
+                f"Content-Length: {len(response_body)}\r\n"
+                f"Connection: close\r\n\r\n".encode() + response_body
+            )
+            try:
+                await writer.drain()
+            finally:
+                writer.close()
+
+    async def _handle_request(self, reader):
+        request_line = (await reader.readline()).decode("latin-1").strip()
+        parts = request_line.split(" ")
+        if len(parts) != 3:
+            raise ValueError("invalid request line")
+        method, target, _ = parts
+
+        headers = {}
+        while True:
+            line = (await reader.readline()).decode("latin-1")
+            if line in ("\r\n", "\n", ""):
+                break
+            name, _, value = line.partition(":")
+            headers[name.strip().lower()] = value.strip()
+
+        if target.split("?", 1)[0] != self.path:
+            return 404, {"error": "not found"}
+        if method != "POST":
+            return 405, {"error": "method not allowed"}
+        if self.secret and headers.get("x-webhook-secret") != self.secret:
+            return 401, {"error": "unauthorized"}
+
+        content_length = int(headers.get("content-length", "0"))
+        if content_length > self.MAX_BODY_BYTES:
+            return 413, {"error": "payload too large"}
+        raw_body = await reader.readexactly(content_length) if content_length else b""
+        payload = json.loads(raw_body or b"{}")
+
+        if self.table_id and isinstance(payload, dict) and payload.get("tableId") not in (None, self.table_id):
+            logger.debug("Ignoring record-change notification for table %s", payload.get('tableId'))
+            return 202, {"accepted": 0}
+
+        record_ids = self.extract_record_ids(payload)
+        self.add_record_ids(record_ids)
+        logger.debug("Received record-change notification for %d records", len(record_ids))
+        return 202, {"accepted": len(record_ids)}
 
 def main():
     if len(sys.argv) > 1 and sys.argv[1] == '--list-groups':
@@ -666,153 +3881,209 @@ def main():
             manager.close()
         return
 
+    if len(sys.argv) > 1 and sys.argv[1] in ('--outbox-dead-letters', '--outbox-requeue'):
+        poller = TeablePoller()
+        if sys.argv[1] == '--outbox-requeue':
+            entry_ids = [int(entry_id) for entry_id in sys.argv[2:]]
+            logger.info(f"Requeued {poller.outbox.requeue_dead(entry_ids)} dead-lettered webhooks")
+        else:
+            dead_letters = poller.outbox.dead_letters()
+            logger.info(f"{len(dead_letters)} dead-lettered webhooks")
+            for entry in dead_letters:
+                logger.info(f"#{entry['id']} {entry['idempotency_key']} (record {entry['record_id']}, "
+                            f"{entry['attempts']} attempts, status {entry['last_status_code']}): {entry['last_error']}")
+        return
+
+    if len(sys.argv) > 1 and sys.argv[1] == '--membership-report':
+        # Diff the group members against Teable once, without changing anything
+        poller = TeablePoller()
+        manager = TelegramGroupManager(poller.group_router)
+        processed_storage = ProcessedIdsStorage()
+        reconciler = MembershipReconciler(
+            poller, manager, processed_storage,
+            snapshot_file=get_required_env_var("MEMBERSHIP_SNAPSHOT_FILE", default="membership_snapshot.json", required=False)
+        )
+        try:
+            if manager.connect():
+                manager.client.loop.run_until_complete(reconciler.run())
+        finally:
+            poller.state_machine.close()
+            processed_storage.close()
+            manager.close()
+        return
+
     poller = TeablePoller()
-    manager = TelegramGroupManager()
+    manager = TelegramGroupManager(poller.group_router)
     processed_storage = ProcessedIdsStorage()
+    pipeline = RecordPipeline(
+        poller, manager, processed_storage,
+        concurrent_stages=get_bool_env_var("CONCURRENT_STAGES", default=True),
+        submitted_concurrency=get_required_env_var("SUBMITTED_CONCURRENCY", default=8, required=False, convert_func=int),
+        max_approved_backlog=get_required_env_var("INVITE_LANE_MAX_BACKLOG", default=2000, required=False, convert_func=int)
+    )
+
+    # Optional scale-out: replicas sharing a lease database split the records between them
+    coordinator = None
+    replica_lease_db = get_required_env_var("REPLICA_LEASE_DB", required=False)
+    if replica_lease_db:
+        coordinator = PartitionCoordinator(
+            replica_lease_db,
+            replica_id=get_required_env_var("REPLICA_ID", required=False),
+            partitions=get_required_env_var("REPLICA_PARTITIONS", default=64, required=False, convert_func=int),
+            lease_ttl=get_required_env_var("REPLICA_LEASE_TTL_SECONDS", default=30, required=False, convert_func=float),
+            heartbeat_interval=get_required_env_var("REPLICA_HEARTBEAT_SECONDS", default=5, required=False, convert_func=float)
+        )
+        pipeline.coordinator = poller.coordinator = coordinator
+        poller.state_machine.on_close = coordinator.release
     poll_interval = int(get_required_env_var("POLL_INTERVAL_SECONDS", default="5"))
+    poll_max_interval = get_required_env_var("POLL_MAX_INTERVAL_SECONDS", default=60, required=False, convert_func=float)
+
+    # Optional periodic check of the actual group members against Teable
+    membership_interval = get_required_env_var("MEMBERSHIP_RECONCILE_INTERVAL_SECONDS", default=0, required=False, convert_func=int)
+    reconciler = MembershipReconciler(
+        poller, manager, processed_storage,
+        snapshot_file=get_required_env_var("MEMBERSHIP_SNAPSHOT_FILE", default="membership_snapshot.json", required=False),
+        apply=get_bool_env_var("MEMBERSHIP_RECONCILE_APPLY"),
+        max_corrections=get_required_env_var("MEMBERSHIP_MAX_CORRECTIONS", default=100, required=False, convert_func=int)
+    )
+
+    # Optional push-driven ingestion; polling then only runs as a slow safety net
+    receiver = None
+    if get_bool_env_var("WEBHOOK_RECEIVER_ENABLED"):
+        receiver = RecordChangeReceiver(
+            host=get_required_env_var("WEBHOOK_RECEIVER_HOST", default="127.0.0.1", required=False),
+            port=get_required_env_var("WEBHOOK_RECEIVER_PORT", default=8787, required=False, convert_func=int),
+            path=get_required_env_var("WEBHOOK_RECEIVER_PATH", default="/teable/record-change", required=False),
+            secret=get_required_env_var("WEBHOOK_RECEIVER_SECRET", required=False),
+            table_id=poller.table_id
+        )
+        poll_interval = get_required_env_var("WEBHOOK_SAFETY_POLL_INTERVAL_SECONDS", default=60, required=False, convert_func=int)
+
+    # Back off while the table is idle, return to poll_interval as soon as there is work
+    poll_scheduler = PollScheduler(
+        min_interval=poll_interval,
+        max_interval=poll_max_interval,
+        backoff=get_required_env_var("POLL_BACKOFF_FACTOR", default=2.0, required=False, convert_func=float)
+    )
+
+    # Optional Prometheus metrics endpoint
+    metrics_server = None
+    metrics_port = get_required_env_var("METRICS_PORT", required=False, convert_func=int)
+    if metrics_port:
+        metrics_server = MetricsServer(
+            metrics,
+            host=get_required_env_var("METRICS_HOST", default="127.0.0.1", required=False),
+            port=metrics_port
+        )
+        metrics.add_collector(lambda: metrics.outbox_pending.set(poller.outbox.pending_count()))
     
     logger.info(f"""
 === Direct Telegram Group Addition/Removal Service Started ===
-Polling interval: {poll_interval} seconds
+Polling interval: {poll_scheduler.min_interval}-{poll_scheduler.max_interval:g} seconds (adaptive)
 Table ID: {poller.table_id}
 Telegram Group ID: {poller.telegram_group_id}
+Target groups: {', '.join(group['name'] for group in poller.group_router.groups.values())}
+Push receiver: {'enabled' if receiver else 'disabled'}
+Metrics: {f'port {metrics_port}' if metrics_server else 'disabled'}
+Membership reconciliation: {f"every {membership_interval} seconds ({'applying' if reconciler.apply else 'report only'})" if membership_interval > 0 else 'disabled'}
+Stages: {'concurrent' if pipeline.concurrent_stages else 'sequential'}
+Replicas: {f'replica {coordinator.replica_id}, {coordinator.partitions} partitions leased through {coordinator.db_path}' if coordinator else 'single instance'}
     """)
+
+    async def wait_for_next_cycle(delay):
+        """Sleep until the next poll, handling pushed record changes in the meantime"""
+        if receiver is None:
+            await asyncio.sleep(delay)
+            return
+        deadline = time.time() + delay
+        while True:
+            remaining = deadline - time.time()
+            if remaining <= 0:
+                return
+            # Wake up at least once a second so shutdown is never delayed by the wait
+            record_ids = await asyncio.to_thread(receiver.wait_for_record_ids, min(remaining, 1.0))
+            if record_ids:
+                # Pushed changes count as activity, so the safety poll speeds up again too
+                poll_scheduler.record_cycle(len(record_ids))
+                deadline = min(deadline, time.time() + poll_scheduler.interval)
+                try:
+                    await pipeline.process_record_ids(record_ids)
+                except Exception as e:
+                    logger.error(f"Error processing pushed records: {str(e)}")
+                    logger.error(traceback.format_exc())
+
+    async def reconcile_membership_periodically():
+        while True:
+            try:
+                # With several replicas, only the holder of partition 0 checks the groups
+                if coordinator is None or coordinator.is_leader:
+                    await reconciler.run()
+            except Exception as e:
+                logger.error(f"Error in membership reconciliation: {str(e)}")
+                logger.error(traceback.format_exc())
+            await asyncio.sleep(membership_interval)
+
+    async def run_service():
+        # Warm the entity cache from the records we are about to invite or remove
+        try:
+            users = warmed = 0
+            async for views in poller.fetch_pages(("approved", "refused"), False):
+                page_users = (poller.to_approved_users(pipeline._owned(views["approved"]))
+                              + poller.to_refused_users(pipeline._owned(views["refused"])))
+                warmed += manager.warm_entity_cache(page_users)
+                users += len(page_users)
+            manager.entity_cache.save()
+            logger.info(f"Entity cache warmed from {users} records ({warmed} access hashes from the sessions)")
+        except Exception as e:
+            logger.warning(f"Could not warm entity cache: {str(e)}")
+
+        # Finish the Telegram work a crash or failed status write left half-done
+        try:
+            await pipeline.reconcile_in_flight()
+        except Exception as e:
+            logger.error(f"Could not reconcile in-flight transitions: {str(e)}")
+            logger.error(traceback.format_exc())
+
+        if membership_interval > 0:
+            asyncio.ensure_future(reconcile_membership_periodically())
+
+        while True:
+            try:
+                started_at = time.monotonic()
+                poll_scheduler.record_cycle(await pipeline.run_cycle())
+                await wait_for_next_cycle(poll_scheduler.next_delay(time.monotonic() - started_at))
+                
+            except Exception as e:
+                logger.error(f"Error in main loop: {str(e)}")
+                logger.error(traceback.format_exc())
+                await wait_for_next_cycle(poll_scheduler.interval)
     
     try:
         if not manager.connect():
             logger.error("Failed to connect to Telegram")
             return
         
-        if not os.getenv("TELEGRAM_GROUP_HASH"):
+        # The single-group setup needs TELEGRAM_GROUP_HASH; groups from TELEGRAM_GROUPS_FILE
+        # may leave out "hash" and are then only resolved through the session
+        groups_without_hash = [group["name"] for group in poller.group_router.groups.values() if not group["hash"]]
+        if groups_without_hash and not poller.group_router.groups_file:
             logger.warning("TELEGRAM_GROUP_HASH not found in .env")
             manager.get_groups()
             logger.info("Please add the access hash to your .env file and restart the script")
             return
-        
-        while True:
-            try:
-                # Get submitted records using filter
-                submitted_records = poller.get_records_with_filter("submitted")  # Get all submitted records
-                for record in submitted_records:
-                    fields = record.get("fields", {})
-                    telegram_id = fields.get("fldtDljIL5MBhcwoms4")  # This is the actual field name from Teable
-                    telegram_username = fields.get("fldt5LbTEuUWxq7iboV", "")  # This appears to be the username field from logs
-                    name = fields.get("First name", "")  # Keep this as is since we don't see it in logs
-                    record_id = record.get("id")
-                    
-                    logger.debug(f"Record {record_id} fields: {json.dumps(fields)}")
-                    logger.debug(f"Telegram ID from record: {telegram_id} (type: {type(telegram_id)})")
-                    
-                    if telegram_id:
-                        logger.info(f"Processing submitted record {record_id}")
-                        
-                        # Check for existing record with same Telegram ID
-                        existing_records = poller.get_records_with_filter("telegram")  # Get all telegram records
-                        logger.debug(f"Checking for duplicates of Telegram ID {telegram_id} among {len(existing_records)} existing records")
-                        
-                        existing_record = None
-                        for r in existing_records:
-                            existing_telegram_id = r.get("fields", {}).get("fldtDljIL5MBhcwoms4")
-                            # Convert both IDs to strings for comparison to handle potential type mismatches
-                            if str(existing_telegram_id) == str(telegram_id) and r["id"] != record_id:
-                                existing_record = r
-                                logger.debug(f"Found match: Record {r['id']} has Telegram ID {existing_telegram_id}")
-                                break
-                            else:
-                                logger.debug(f"No match: Record {r['id']} has Telegram ID {existing_telegram_id}")
-                        
-                        if existing_record:
-                            logger.info(f"Found existing record {existing_record['id']} with Telegram ID {telegram_id}")
-                            logger.info(f"Updating record {record_id} to double status")
-                            poller.update_double_status(record_id, telegram_id)
-                            continue
-                        
-                        # No duplicate found, proceed with normal flow
-                        logger.info(f"No duplicate found for Telegram ID {telegram_id}, proceeding with webhook")
-                        webhook_payload = {
-                            "telegramID": telegram_id,
-                            "telegramUsername": telegram_username,
-                            "name": name
-                        }
-                        
-                        # Try test webhook first if configured
-                        test_webhook_success = False
-                        if poller.n8n_webhook_test_received_url:
-                            logger.info(f"Attempting test webhook for record {record_id}")
-                            test_webhook_success = poller.call_webhook(
-                                poller.n8n_webhook_test_received_url, 
-                                webhook_payload, 
-                                is_test=True
-                            )
-                            if test_webhook_success:
-                                logger.info(f"Test webhook successful for record {record_id}, updating to pending")
-                                status_update_success = poller.update_status([record_id], 'pending')
-                                if not status_update_success:
-                                    logger.error(f"Failed to update record {record_id} to pending status after successful test webhook")
-                        
-                        # If test webhook not configured or failed, try main webhook
-                        if not test_webhook_success:
-                            if poller.n8n_webhook_received_url:
-                                logger.info(f"Attempting main webhook for record {record_id}")
-                                if poller.call_webhook(poller.n8n_webhook_received_url, webhook_payload):
-                                    logger.info(f"Main webhook successful for record {record_id}, updating to pending")
-                                    status_update_success = poller.update_status([record_id], 'pending')
-                                    if not status_update_success:
-                                        logger.error(f"Failed to update record {record_id} to pending status after successful main webhook")
-                                else:
-                                    logger.warning(f"Main webhook failed for record {record_id}, status will remain submitted")
-                            else:
-                                logger.warning("No webhooks configured, record will remain in submitted status")
-
-                approved_records = poller.get_approved_records(processed_storage)
-                if approved_records:
-                    logger.info(f"Processing {len(approved_records)} approved records")
-                    successful_records = manager.add_users(approved_records, processed_storage, poller)
-                    
-                    if successful_records:
-                        for record_id in successful_records:
-                            # Find the matching approved record to get its details
-                            approved_record = next((r for r in approved_records if r['record_id'] == record_id), None)
-                            if approved_record:
-                                webhook_payload = {
-                                    "telegramID": approved_record['telegram_id'],
-                                    "telegramUsername": approved_record['telegram_username'],
-                                    "recordId": record_id
-                                }
-                                
-                                webhook_success = False
-                                if poller.n8n_webhook_test_accepted_url:
-                                    webhook_success = poller.call_webhook(
-                                        poller.n8n_webhook_test_accepted_url, 
-                                        webhook_payload, 
-                                        is_test=True
-                                    )
-                                
-                                if not webhook_success:
-                                    poller.call_webhook(poller.n8n_webhook_accepted_url, webhook_payload)
-
-                        if poller.update_status(successful_records, 'telegram'):
-                            logger.info(f"Successfully processed {len(successful_records)} approved records")
-                        else:
-                            logger.error("Failed to update status for approved records")
-
-                refused_records = poller.get_refused_records(processed_storage)
-                if refused_records:
-                    logger.info(f"Processing {len(refused_records)} refused records")
-                    successful_records = manager.remove_users(refused_records, processed_storage)
-                    
-                    if successful_records:
-                        if poller.update_status(successful_records, 'removed'):
-                            logger.info(f"Successfully processed {len(successful_records)} refused records")
-                        else:
-                            logger.error("Failed to update status for refused records")
-                
-                time.sleep(poll_interval)
-                
-            except Exception as e:
-                logger.error(f"Error in main loop: {str(e)}")
-                logger.error(traceback.format_exc())
-                time.sleep(poll_interval)
+        if groups_without_hash:
+            logger.warning(f"No access hash configured for group(s) {', '.join(groups_without_hash)} in {poller.group_router.groups_file}")
+
+        if receiver:
+            receiver.start()
+        if metrics_server:
+            metrics_server.start()
+        poller.outbox.start()
+        if coordinator:
+            coordinator.start()
+
+        # Run the service on the Telegram client's event loop
+        manager.client.loop.run_until_complete(run_service())
                 
     except KeyboardInterrupt:
         logger.info("Shutting down...")
@@ -820,6 +4091,15 @@ Telegram Group ID: {poller.telegram_group_id}
         logger.error(f"Fatal error: {str(e)}")
         logger.error(traceback.format_exc())
     finally:
+        if receiver:
+            receiver.stop()
+        if metrics_server:
+            metrics_server.stop()
+        if coordinator:
+            coordinator.stop()
+        poller.outbox.stop()
+        poller.state_machine.close()
+        processed_storage.close()
         manager.close()
 
 if __name__ == "__main__":
@@ -0,0 +1,476 @@
+"""
+Offline benchmark for add_to_telegram_group.py.
+
+Runs the real TeablePoller / TelegramGroupManager / RecordPipeline against
+in-process fakes, with no network access:
+
+- FakeTeableServer: local HTTP stub for /api/table/{id}/record (filtered,
+  projected and paginated listing, single record fetch, bulk PATCH; gzip when
+  the client accepts it)
+- FakeN8nServer: local HTTP stub that accepts every webhook
+- ScriptedTelegramClient: stands in for TelegramClient and raises
+  UserPrivacyRestrictedError, PeerFloodError or FloodWaitError as scripted
+
+Usage:
+python3 benchmark.py                         # small (10) and medium (1k) scenarios
+python3 benchmark.py --scenario large        # 100k records
+python3 benchmark.py --records 5000 --duplicates 0.2 --privacy 0.1 --flood-after 500
+python3 benchmark.py --wide-fields 40          # application records with questionnaire answers
+"""
+import argparse
+import asyncio
+import gzip
+import json
+import os
+import random
+import resource
+import sys
+import tempfile
+import threading
+import time
+import tracemalloc
+from collections import Counter
+from datetime import datetime, timezone
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import urlparse, parse_qs
+
+STATUS_FIELD = "fldE151819s5A2x1fnH"
+TELEGRAM_ID_FIELD = "fldtDljIL5MBhcwoms4"
+USERNAME_FIELD = "fldt5LbTEuUWxq7iboV"
+LAST_MODIFIED_FIELD = "fldBenchLastModified"
+FIRST_NAME_FIELD = "fldBenchFirstName"
+TABLE_ID = "tblBenchmark"
+GROUP_ID = 1001
+
+SCENARIOS = {
+    "small": {"records": 10},
+    "medium": {"records": 1000},
+    "large": {"records": 100000},
+}
+
+# Share of generated records per status
+STATUS_MIX = [("submitted", 0.4), ("approved", 0.3), ("refused", 0.1), ("telegram", 0.2)]
+
+class RequestCounter:
+    """Thread-safe request counter shared by the stub servers"""
+    def __init__(self):
+        self._lock = threading.Lock()
+        self.counts = Counter()
+
+    def add(self, key, amount=1):
+        with self._lock:
+            self.counts[key] += amount
+
+class StubHandler(BaseHTTPRequestHandler):
+    # Keep-alive, like the real services, so connection pooling is measured too
+    protocol_version = "HTTP/1.1"
+    # Headers and body are written separately; without this Nagle adds ~40ms per response
+    disable_nagle_algorithm = True
+
+    def log_message(self, format, *args):
+        pass
+
+    def read_json(self):
+        length = int(self.headers.get("Content-Length") or 0)
+        return json.loads(self.rfile.read(length) or b"{}")
+
+    def send_json(self, status, payload):
+        body = json.dumps(payload).encode()
+        gzipped = "gzip" in (self.headers.get("Accept-Encoding") or "")
+        if gzipped:
+            body = gzip.compress(body, compresslevel=5)
+        self.stub.counter.add("bytes sent", len(body))
+        self.send_response(status)
+        self.send_header("Content-Type", "application/json")
+        if gzipped:
+            self.send_header("Content-Encoding", "gzip")
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+class StubServer:
+    """Runs a ThreadingHTTPServer on a free local port in a background thread"""
+    def __init__(self, handler_class):
+        self.counter = RequestCounter()
+        handler = type(handler_class.__name__, (handler_class,), {"stub": self})
+        self.httpd = ThreadingHTTPServer(("127.0.0.1", 0), handler)
+        self.httpd.daemon_threads = True
+        self.thread = threading.Thread(target=self.httpd.serve_forever, daemon=True)
+
+    @property
+    def url(self):
+        host, port = self.httpd.server_address
+        return f"http://{host}:{port}"
+
+    def start(self):
+        self.thread.start()
+        return self
+
+    def stop(self):
+        self.httpd.shutdown()
+        self.httpd.server_close()
+
+class TeableHandler(StubHandler):
+    def do_GET(self):
+        parsed = urlparse(self.path)
+        parts = parsed.path.strip("/").split("/")
+        # api/table/{table_id}/record[/{record_id}]
+        if len(parts) < 4 or parts[:2] != ["api", "table"] or parts[3] != "record":
+            self.stub.counter.add("GET other")
+            return self.send_json(404, {"message": "not found"})
+        query = parse_qs(parsed.query)
+        projection = query.get("projection") or query.get("projection[]")
+        if len(parts) == 5:
+            self.stub.counter.add("GET record")
+            record = self.stub.records_by_id.get(parts[4])
+            if record is None:
+                return self.send_json(404, {"message": "not found"})
+            return self.send_json(200, self.stub.project(record, projection))
+
+        self.stub.counter.add("GET records")
+        params = {key: values[-1] for key, values in query.items()}
+        try:
+            records = self.stub.query(params)
+        except ValueError as e:
+            return self.send_json(400, {"message": str(e)})
+        skip = int(params.get("skip", 0))
+        take = min(int(params.get("take", 100)), 1000)
+        self.send_json(200, {"records": [self.stub.project(record, projection) for record in records[skip:skip + take]]})
+
+    def do_PATCH(self):
+        self.stub.counter.add("PATCH records")
+        body = self.read_json()
+        updated = self.stub.update(body.get("records", []))
+        self.send_json(200, {"records": updated})
+
+class FakeTeableServer(StubServer):
+    """In-memory Teable table behind the record endpoints used by the service"""
+    def __init__(self, records):
+        super().__init__(TeableHandler)
+        self.records = records
+        self.records_by_id = {record["id"]: record for record in records}
+        self._lock = threading.Lock()
+
+    def query(self, params):
+        records = self.records
+        if params.get("filter"):
+            condition = json.loads(params["filter"])
+            records = [record for record in records if self._matches(record, condition)]
+        if params.get("orderBy"):
+            for order in reversed(json.loads(params["orderBy"])):
+                records = sorted(
+                    records,
+                    key=lambda record: str(record["fields"].get(order["fieldId"]) or ""),
+                    reverse=order.get("order") == "desc"
+                )
+        return records
+
+    @staticmethod
+    def project(record, projection):
+        if not projection:
+            return record
+        return {"id": record["id"], "fields": {key: value for key, value in record["fields"].items() if key in projection}}
+
+    def _matches(self, record, condition):
+        if "filterSet" in condition:
+            results = (self._matches(record, item) for item in condition["filterSet"])
+            return all(results) if condition.get("conjunction", "and") == "and" else any(results)
+        value = record["fields"].get(condition["fieldId"])
+        operator = condition.get("operator")
+        if operator == "is":
+            return value == condition.get("value")
+        if operator == "isNot":
+            return value != condition.get("value")
+        if operator == "isAnyOf":
+            return value in condition.get("value", [])
+        if operator == "isNoneOf":
+            return value not in condition.get("value", [])
+        if operator == "isEmpty":
+            return value in (None, "")
+        if operator == "isNotEmpty":
+            return value not in (None, "")
+        raise ValueError(f"Unsupported filter operator: {operator}")
+
+    def update(self, updates):
+        now = datetime.now(timezone.utc).isoformat()
+        updated = []
+        with self._lock:
+            for update in updates:
+                record = self.records_by_id.get(update.get("id"))
+                if record is None:
+                    continue
+                record["fields"].update(update.get("fields", {}))
+                record["fields"][LAST_MODIFIED_FIELD] = now
+                updated.append(record)
+        return updated
+
+class N8nHandler(StubHandler):
+    def do_POST(self):
+        self.stub.counter.add(f"POST {urlparse(self.path).path}")
+        if self.headers.get("Idempotency-Key"):
+            self.stub.deliveries.add(self.headers["Idempotency-Key"])
+        self.read_json()
+        self.send_json(200, {"ok": True})
+
+class FakeN8nServer(StubServer):
+    """n8n stub that accepts every webhook and counts the deliveries per Idempotency-Key"""
+    def __init__(self):
+        super().__init__(N8nHandler)
+        self.deliveries = RequestCounter()
+
+class FakeSession:
+    """Telethon session stand-in; nothing is cached in it"""
+    def get_input_entity(self, peer):
+        raise ValueError(f"Could not find the input entity for {peer!r}")
+
+class ScriptedTelegramClient:
+    """
+    Fake TelegramClient with scripted outcomes.
+
+    Users in `privacy_restricted` raise UserPrivacyRestrictedError when invited.
+    After `flood_after` successful invites every further invite raises
+    PeerFloodError (flood_kind="peer") or FloodWaitError (flood_kind="wait").
+    """
+    def __init__(self, usernames, privacy_restricted=(), flood_after=None, flood_kind="peer",
+                 flood_seconds=600, rpc_latency=0.0):
+        self.usernames = usernames
+        self.privacy_restricted = set(privacy_restricted)
+        self.flood_after = flood_after
+        self.flood_kind = flood_kind
+        self.flood_seconds = flood_seconds
+        self.rpc_latency = rpc_latency
+        self.session = FakeSession()
+        self.calls = Counter()
+        # InviteToChannelRequest attempts per Telegram user ID
+        self.invites = Counter()
+        self.invited = 0
+
+    async def _rpc(self, name):
+        self.calls[name] += 1
+        if self.rpc_latency:
+            await asyncio.sleep(self.rpc_latency)
+
+    async def get_entity(self, peer):
+        from telethon.tl.types import Channel
+        await self._rpc("GetEntity")
+        return Channel(id=peer, title="Benchmark group", photo=None, date=None, access_hash=42)
+
+    async def get_input_entity(self, peer):
+        from telethon.tl.types import InputPeerUser
+        if isinstance(peer, int):
+            # Not in the (empty) session cache, like a fresh login
+            raise ValueError(f"Could not find the input entity for {peer}")
+        await self._rpc("ResolveUsername")
+        user_id = self.usernames.get(str(peer).lstrip("@").lower())
+        if user_id is None:
+            raise ValueError(f'No user has "{peer}" as username')
+        return InputPeerUser(user_id, user_id * 7)
+
+    async def __call__(self, request):
+        from telethon.errors import FloodWaitError
+        from telethon.errors.rpcerrorlist import PeerFloodError, UserPrivacyRestrictedError
+        name = type(request).__name__
+        await self._rpc(name)
+        if name == "InviteToChannelRequest":
+            self.invites[request.users[0].user_id] += 1
+            if self.flood_after is not None and self.invited >= self.flood_after:
+                if self.flood_kind == "wait":
+                    raise FloodWaitError(request=request, capture=self.flood_seconds)
+                raise PeerFloodError(request=request)
+            if request.users[0].user_id in self.privacy_restricted:
+                raise UserPrivacyRestrictedError(request=request)
+            self.invited += 1
+        return None
+
+    def disconnect(self):
+        pass
+
+def generate_records(count, duplicates, privacy, no_username, seed, wide_fields=0):
+    """
+    Build a reproducible table plus the usernames and privacy-restricted users the fake client knows.
+
+    wide_fields adds that many long text fields per record, like the questionnaire
+    answers and attachment metadata of real application records.
+    """
+    rng = random.Random(seed)
+    records, usernames, privacy_restricted = [], {}, set()
+    member_ids = []
+    now = datetime.now(timezone.utc).isoformat()
+    statuses = [status for status, _ in STATUS_MIX]
+    weights = [weight for _, weight in STATUS_MIX]
+    for index in range(count):
+        status = rng.choices(statuses, weights)[0]
+        telegram_id = 100000 + index
+        if status == "submitted" and member_ids and rng.random() < duplicates:
+            telegram_id = rng.choice(member_ids)
+        username = "" if rng.random() < no_username else f"bench_user_{telegram_id}"
+        if username:
+            usernames[username] = telegram_id
+        if status == "approved" and rng.random() < privacy:
+            privacy_restricted.add(telegram_id)
+        if status == "telegram":
+            member_ids.append(telegram_id)
+        records.append({
+            "id": f"rec{index:08d}",
+            "fields": {
+                STATUS_FIELD: status,
+                TELEGRAM_ID_FIELD: str(telegram_id),
+                USERNAME_FIELD: username,
+                FIRST_NAME_FIELD: f"User {index}",
+                LAST_MODIFIED_FIELD: now,
+                **{f"fldBenchAnswer{field:03d}": f"Answer {field} of user {index}: " + "lorem ipsum dolor sit amet " * 8
+                   for field in range(wide_fields)},
+            }
+        })
+    return records, usernames, privacy_restricted
+
+def configure_environment(teable_url, n8n_url, args):
+    os.environ.update({
+        "BASE_URL": f"{teable_url}/api",
+        "TEABLE_API_TOKEN": "benchmark",
+        "TEABLE_TABLE_ID": TABLE_ID,
+        "TEABLE_FIRST_NAME_FIELD_ID": FIRST_NAME_FIELD,
+        "TELGRAM_GROUP_ID": str(GROUP_ID),
+        "TELEGRAM_GROUP_HASH": "42",
+        "TELEGRAM_API_ID": "1",
+        "TELEGRAM_API_HASH": "benchmark",
+        "TELEGRAM_PHONE": "+10000000000",
+        "N8N_WEBHOOK_RECEIVED_URL": f"{n8n_url}/webhook/app-received",
+        "N8N_WEBHOOK_ACCEPTED_URL": f"{n8n_url}/webhook/approved",
+        "N8N_WEBHOOK_INVITE_URL": f"{n8n_url}/webhook/invite",
+        # Pace Telegram calls only as much as the scenario asks for
+        "INVITE_RATE_PER_MINUTE": str(args.invite_rate),
+        "INVITE_MAX_RATE_PER_MINUTE": str(args.invite_rate),
+        "REMOVE_RATE_PER_MINUTE": str(args.invite_rate),
+        "REMOVE_MAX_RATE_PER_MINUTE": str(args.invite_rate),
+    })
+    if args.incremental:
+        os.environ["TEABLE_LAST_MODIFIED_FIELD_ID"] = LAST_MODIFIED_FIELD
+    else:
+        os.environ.pop("TEABLE_LAST_MODIFIED_FIELD_ID", None)
+
+async def run_scenario(service, name, count, args):
+    records, usernames, privacy_restricted = generate_records(
+        count, args.duplicates, args.privacy, args.no_username, args.seed, args.wide_fields
+    )
+    teable = FakeTeableServer(records).start()
+    n8n = FakeN8nServer().start()
+    workdir = tempfile.mkdtemp(prefix=f"benchmark-{name}-")
+    previous_dir = os.getcwd()
+    os.chdir(workdir)
+    configure_environment(teable.url, n8n.url, args)
+
+    client = ScriptedTelegramClient(
+        usernames, privacy_restricted,
+        flood_after=args.flood_after, flood_kind=args.flood_kind, rpc_latency=args.rpc_latency / 1000
+    )
+    original_client_class = service.TelegramClient
+    service.TelegramClient = lambda *client_args, **client_kwargs: client
+    poller = manager = processed_storage = None
+    try:
+        poller = service.TeablePoller()
+        manager = service.TelegramGroupManager(poller.group_router)
+        processed_storage = service.ProcessedIdsStorage()
+        pipeline = service.RecordPipeline(poller, manager, processed_storage)
+        poller.outbox.start()
+
+        tracemalloc.start()
+        cycle_times = []
+        for _ in range(args.cycles):
+            started_at = time.perf_counter()
+            await pipeline.run_cycle()
+            if pipeline._approved_task is not None:
+                await pipeline._approved_task
+            await poller.run_io(poller.status_writer.flush)
+            cycle_times.append(time.perf_counter() - started_at)
+        _, peak_memory = tracemalloc.get_traced_memory()
+        tracemalloc.stop()
+
+        drain_started_at = time.perf_counter()
+        while poller.outbox.pending_count() and time.perf_counter() - drain_started_at < args.drain_timeout:
+            await asyncio.sleep(0.05)
+        drain_time = time.perf_counter() - drain_started_at
+
+        return {
+            "scenario": name,
+            "records": count,
+            "cycle_seconds": [round(seconds, 3) for seconds in cycle_times],
+            "teable_requests": {key: count for key, count in teable.counter.counts.items() if key != "bytes sent"},
+            "teable_bytes": teable.counter.counts["bytes sent"],
+            "n8n_requests": {key: count for key, count in n8n.counter.counts.items() if key != "bytes sent"},
+            "telegram_rpcs": dict(client.calls),
+            "statuses": dict(Counter(record["fields"][STATUS_FIELD] for record in records)),
+            "outbox_pending": poller.outbox.pending_count(),
+            "outbox_drain_seconds": round(drain_time, 3),
+            "peak_traced_mb": round(peak_memory / 1024 / 1024, 2),
+            "max_rss_mb": round(resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024, 1),
+        }
+    finally:
+        if poller is not None:
+            poller.outbox.stop()
+            poller.state_machine.close()
+        if processed_storage is not None:
+            processed_storage.close()
+        if manager is not None:
+            manager.close()
+        service.TelegramClient = original_client_class
+        teable.stop()
+        n8n.stop()
+        os.chdir(previous_dir)
+
+def print_result(result):
+    print(f"\n=== {result['scenario']}: {result['records']} records ===")
+    print(f"Cycle times (s):      {', '.join(str(seconds) for seconds in result['cycle_seconds'])}")
+    print(f"Teable requests:      {result['teable_requests']}")
+    print(f"Teable bytes sent:    {result['teable_bytes']}")
+    print(f"n8n requests:         {result['n8n_requests']}")
+    print(f"Telegram RPCs:        {result['telegram_rpcs']}")
+    print(f"Final statuses:       {result['statuses']}")
+    print(f"Outbox:               {result['outbox_pending']} pending after {result['outbox_drain_seconds']}s drain")
+    print(f"Memory:               peak traced {result['peak_traced_mb']} MB, max RSS {result['max_rss_mb']} MB")
+
+def main():
+    parser = argparse.ArgumentParser(description="Offline benchmark with fake Teable, n8n and Telegram backends")
+    parser.add_argument("--scenario", choices=[*SCENARIOS, "all"], action="append",
+                        help="Scenario to run (repeatable; default: small and medium)")
+    parser.add_argument("--records", type=int, help="Run a custom scenario with this many records")
+    parser.add_argument("--duplicates", type=float, default=0.1, help="Share of submitted records reusing a member's Telegram ID")
+    parser.add_argument("--privacy", type=float, default=0.05, help="Share of approved users with privacy restrictions")
+    parser.add_argument("--no-username", type=float, default=0.05, help="Share of records without a username")
+    parser.add_argument("--wide-fields", type=int, default=0, help="Extra long text fields per record")
+    parser.add_argument("--flood-after", type=int, help="Raise a flood error after this many successful invites")
+    parser.add_argument("--flood-kind", choices=["peer", "wait"], default="peer")
+    parser.add_argument("--rpc-latency", type=float, default=0.0, help="Simulated Telegram RPC latency in ms")
+    parser.add_argument("--invite-rate", type=float, default=6000000.0, help="Invite/kick rate per minute")
+    parser.add_argument("--cycles", type=int, default=2, help="Poll cycles per scenario (later ones are mostly idle)")
+    parser.add_argument("--incremental", action="store_true", help="Enable incremental sync on a last-modified field")
+    parser.add_argument("--drain-timeout", type=float, default=60.0, help="Seconds to wait for the webhook outbox")
+    parser.add_argument("--seed", type=int, default=42)
+    parser.add_argument("--log-level", default="ERROR")
+    parser.add_argument("--json", action="store_true", help="Print results as JSON")
+    args = parser.parse_args()
+
+    # The service reads LOG_LEVEL when it is imported
+    os.environ["LOG_LEVEL"] = args.log_level
+    sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+    import add_to_telegram_group as service
+
+    if args.records is not None:
+        scenarios = [("custom", args.records)]
+    else:
+        names = args.scenario or ["small", "medium"]
+        if "all" in names:
+            names = list(SCENARIOS)
+        scenarios = [(name, SCENARIOS[name]["records"]) for name in names]
+
+    results = []
+    for name, count in scenarios:
+        result = asyncio.run(run_scenario(service, name, count, args))
+        results.append(result)
+        if not args.json:
+            print_result(result)
+    if args.json:
+        print(json.dumps(results, indent=2))
+
+if __name__ == "__main__":
+    main()
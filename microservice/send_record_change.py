@@ -0,0 +1,39 @@
+import requests
+from dotenv import load_dotenv
+import os
+import sys
+
+# Load environment variables
+load_dotenv()
+
+def main():
+    """Send a record-change notification to the local receiver, like Teable or an n8n relay would"""
+    if len(sys.argv) < 2:
+        print("\nUsage:")
+        print("python3 send_record_change.py <record_id> [<record_id> ...]")
+        return
+
+    host = os.getenv("WEBHOOK_RECEIVER_HOST", "127.0.0.1")
+    port = os.getenv("WEBHOOK_RECEIVER_PORT", "8787")
+    path = os.getenv("WEBHOOK_RECEIVER_PATH", "/teable/record-change")
+    secret = os.getenv("WEBHOOK_RECEIVER_SECRET")
+    url = f"http://{host}:{port}{path}"
+
+    payload = {
+        "tableId": os.getenv("TEABLE_TABLE_ID"),
+        "recordIds": sys.argv[1:]
+    }
+    headers = {"Content-Type": "application/json"}
+    if secret:
+        headers["X-Webhook-Secret"] = secret
+
+    try:
+        print(f"Sending {len(payload['recordIds'])} record IDs to {url}")
+        response = requests.post(url, json=payload, headers=headers, timeout=10)
+        print(f"Response status code: {response.status_code}")
+        print(f"Response content: {response.text}")
+    except requests.exceptions.RequestException as e:
+        print(f"Failed to send notification: {str(e)}")
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,278 @@
+"""
+Regression checks for add_to_telegram_group.py.
+
+They run the real TeablePoller / TelegramGroupManager / RecordPipeline against
+the offline fakes of benchmark.py (no network) and assert the invariants the
+service promises:
+
+- every approved user is invited at most once, even when poll cycles and
+  pushed record changes overlap a busy invite lane, and an account that can't
+  reach the group leaves its users to the others
+- replaying a record after a failed status write sends no webhook twice, and a
+  record whose invite webhook was never delivered goes back to 'approved'
+- the incremental sync high-water mark never passes a change a walk has missed,
+  and a malformed Teable page only ends the walk
+- a record partition is never leased to two replicas at once, and a partition
+  moving to another replica waits for the work claimed on it
+
+Usage:
+python3 -m unittest test_regressions      (or: python3 -m pytest test_regressions.py)
+"""
+import argparse
+import asyncio
+import itertools
+import os
+import shutil
+import sys
+import tempfile
+import unittest
+from collections import Counter
+from datetime import datetime, timedelta, timezone
+
+# The service reads LOG_LEVEL when it is imported
+os.environ.setdefault("LOG_LEVEL", "ERROR")
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+import add_to_telegram_group as service
+import benchmark
+
+class ServiceTestCase(unittest.IsolatedAsyncioTestCase):
+    """Starts the service against fake Teable, n8n and Telegram backends in a scratch directory"""
+    def start_service(self, count, privacy=0.0, no_username=0.0, seed=42, invite_rate=6000000.0, incremental=False):
+        self.records, usernames, privacy_restricted = benchmark.generate_records(count, 0.0, privacy, no_username, seed)
+        self.teable = benchmark.FakeTeableServer(self.records).start()
+        self.addCleanup(self.teable.stop)
+        self.n8n = benchmark.FakeN8nServer().start()
+        self.addCleanup(self.n8n.stop)
+
+        workdir = tempfile.mkdtemp(prefix="regression-")
+        self.addCleanup(shutil.rmtree, workdir, True)
+        self.addCleanup(os.chdir, os.getcwd())
+        os.chdir(workdir)
+        benchmark.configure_environment(
+            self.teable.url, self.n8n.url, argparse.Namespace(invite_rate=invite_rate, incremental=incremental)
+        )
+        # Only invites are paced; removals never hold up a cycle
+        os.environ["REMOVE_RATE_PER_MINUTE"] = os.environ["REMOVE_MAX_RATE_PER_MINUTE"] = "6000000"
+
+        self.client = benchmark.ScriptedTelegramClient(usernames, privacy_restricted)
+        self.addCleanup(setattr, service, "TelegramClient", service.TelegramClient)
+        service.TelegramClient = lambda *client_args, **client_kwargs: self.client
+
+        self.poller = service.TeablePoller()
+        self.manager = service.TelegramGroupManager(self.poller.group_router)
+        self.processed_storage = service.ProcessedIdsStorage()
+        self.pipeline = service.RecordPipeline(self.poller, self.manager, self.processed_storage)
+        self.addCleanup(self.manager.close)
+        self.addCleanup(self.processed_storage.close)
+        self.addCleanup(self.poller.state_machine.close)
+        self.addCleanup(self.poller.outbox.stop)
+        self.poller.outbox.start()
+
+    async def run_cycle(self):
+        """One poll cycle, waiting for the invite lane and the status writes it started"""
+        await self.pipeline.run_cycle()
+        if self.pipeline._approved_task is not None:
+            await self.pipeline._approved_task
+        await self.poller.run_io(self.poller.status_writer.flush)
+
+    async def drain_outbox(self, timeout=10.0):
+        deadline = asyncio.get_running_loop().time() + timeout
+        while self.poller.outbox.pending_count():
+            self.assertLess(asyncio.get_running_loop().time(), deadline, "webhook outbox did not drain")
+            await asyncio.sleep(0.05)
+
+    def statuses(self):
+        return Counter(record["fields"][benchmark.STATUS_FIELD] for record in self.records)
+
+class InviteOnceTest(ServiceTestCase):
+    async def test_busy_invite_lane_invites_each_user_once(self):
+        # About two seconds of invites, so later cycles and pushes run while the lane is busy
+        self.start_service(60, privacy=0.1, no_username=0.1, invite_rate=600)
+        approved_ids = [record["id"] for record in self.records if record["fields"][benchmark.STATUS_FIELD] == "approved"]
+
+        await self.pipeline.run_cycle()
+        await self.pipeline.process_record_ids(approved_ids)
+        await self.pipeline.run_cycle()
+        self.assertFalse(self.pipeline._approved_task.done(), "the invite lane finished before the overlap was exercised")
+        await self.run_cycle()
+        await self.run_cycle()
+
+        self.assertTrue(self.client.invites)
+        self.assertEqual(max(self.client.invites.values()), 1, f"users invited more than once: {self.client.invites}")
+        self.assertNotIn("approved", self.statuses())
+
+class ReplayTest(ServiceTestCase):
+    async def test_failed_status_write_is_replayed_without_duplicate_webhooks(self):
+        self.start_service(40, privacy=0.3, no_username=0.2, seed=7)
+        patch_records = self.poller.patch_records
+        self.poller.patch_records = lambda records: False
+        self.poller.status_writer.max_retries = 0
+
+        # Invites and webhooks go out, but no status is stored
+        await self.run_cycle()
+        await self.drain_outbox()
+        self.assertIn("approved", self.statuses())
+        invites = dict(self.client.invites)
+        self.assertTrue(invites)
+
+        self.poller.patch_records = patch_records
+        await self.run_cycle()
+        await self.drain_outbox()
+
+        deliveries = self.n8n.deliveries.counts
+        self.assertTrue(deliveries)
+        self.assertEqual(max(deliveries.values()), 1, f"webhooks delivered more than once: {deliveries}")
+        self.assertEqual([key for key in deliveries if "#" in key], [], "a webhook was queued again as a new generation")
+        self.assertEqual(dict(self.client.invites), invites, "the replay invited users again")
+        self.assertNotIn("approved", self.statuses())
+
+    async def test_account_that_cannot_reach_the_group_hands_its_users_over(self):
+        os.environ["TELEGRAM_SESSIONS"] = "+10000000001"
+        self.addCleanup(os.environ.pop, "TELEGRAM_SESSIONS", None)
+        # Slow enough that both accounts are handed invites
+        self.start_service(60, invite_rate=600)
+        primary, second = self.manager.pool.accounts
+        get_target_group_entity = self.manager._get_target_group_entity
+
+        async def primary_only(account, group_id, refresh=False):
+            if account is not primary:
+                raise ValueError("Cannot find any entity corresponding to the group")
+            return await get_target_group_entity(account, group_id, refresh)
+
+        self.manager._get_target_group_entity = primary_only
+        await self.run_cycle()
+        self.assertGreater(second.invite_scheduler(self.manager.group_id).next_available_in(), 0)
+        self.assertNotIn("approved", self.statuses())
+        self.assertEqual(max(self.client.invites.values()), 1)
+
+class InviteWebhookTest(ServiceTestCase):
+    async def test_undelivered_invite_webhook_sends_the_record_back_to_approved(self):
+        self.start_service(40, privacy=0.5, seed=3)
+        invite_url = os.environ["N8N_WEBHOOK_INVITE_URL"]
+        # Teable answers 501 to a POST; with one attempt the webhook is dead-lettered at once
+        os.environ["N8N_WEBHOOK_INVITE_URL"] = f"{self.teable.url}/webhook/invite"
+        self.poller.outbox.max_attempts = 1
+
+        await self.run_cycle()
+        await self.drain_outbox()
+        await self.poller.run_io(self.poller.status_writer.flush)
+        self.assertEqual(len(self.poller.outbox.dead_letters()), len(self.client.privacy_restricted))
+        self.assertNotIn("invited", self.statuses())
+        self.assertIn("approved", self.statuses())
+
+        os.environ["N8N_WEBHOOK_INVITE_URL"] = invite_url
+        await self.run_cycle()
+        await self.drain_outbox()
+        self.assertEqual(self.n8n.counter.counts["POST /webhook/invite"], len(self.client.privacy_restricted))
+        self.assertNotIn("approved", self.statuses())
+
+class IncrementalSyncTest(ServiceTestCase):
+    async def test_high_water_mark_does_not_pass_changes_behind_a_walk(self):
+        self.start_service(40, incremental=True)
+        by_status = {}
+        for record in self.records:
+            by_status.setdefault(record["fields"][benchmark.STATUS_FIELD], []).append(record)
+        # A member changed late in a long walk (or by a clock ahead of ours) must not carry the mark past
+        # the records the walk had already passed
+        by_status["telegram"][0]["fields"][benchmark.LAST_MODIFIED_FIELD] = (datetime.now(timezone.utc) + timedelta(hours=1)).isoformat()
+
+        started = datetime.now(timezone.utc)
+        await self.run_cycle()
+        mark = service.parse_timestamp(self.poller.sync_state.get("high_water_mark"))
+        self.assertLessEqual(mark, datetime.now(timezone.utc) - timedelta(seconds=self.poller.sync_overlap_seconds))
+
+        # Changed while the full walk was running, at a place it had already passed
+        changed = next(record for record in self.records if record["fields"][benchmark.STATUS_FIELD] == "pending")
+        changed["fields"][benchmark.STATUS_FIELD] = "submitted"
+        changed["fields"][benchmark.LAST_MODIFIED_FIELD] = started.isoformat()
+        await self.run_cycle()
+        self.assertIsNotNone(self.poller._cycle_since, "the second cycle was not incremental")
+        self.assertNotEqual(changed["fields"][benchmark.STATUS_FIELD], "submitted")
+
+    async def test_malformed_page_ends_the_walk_without_moving_the_mark(self):
+        self.start_service(40, incremental=True)
+        get = self.poller.session.get
+
+        def truncated_get(*args, **kwargs):
+            response = get(*args, **kwargs)
+            response._content = response.content[:len(response.content) // 2]
+            return response
+
+        self.poller.session.get = truncated_get
+        await self.run_cycle()
+        self.assertTrue(self.poller._cycle_walk_failed)
+        self.assertIsNone(self.poller.sync_state.get("high_water_mark"))
+
+        self.poller.session.get = get
+        await self.run_cycle()
+        self.assertIsNotNone(self.poller.sync_state.get("high_water_mark"))
+        self.assertNotIn("submitted", self.statuses())
+
+class PartitionLeaseTest(unittest.TestCase):
+    PARTITIONS = 16
+
+    def setUp(self):
+        workdir = tempfile.mkdtemp(prefix="regression-leases-")
+        self.addCleanup(shutil.rmtree, workdir, True)
+        self.db_path = os.path.join(workdir, "leases.db")
+        self.replicas = []
+
+    def replica(self, name):
+        coordinator = service.PartitionCoordinator(self.db_path, replica_id=name, partitions=self.PARTITIONS)
+        self.replicas.append(coordinator)
+        return coordinator
+
+    def heartbeat_all(self, rounds=3):
+        for _ in range(rounds):
+            for coordinator in self.replicas:
+                coordinator.heartbeat()
+                self.assert_exclusive()
+
+    def assert_exclusive(self):
+        for first, second in itertools.combinations(self.replicas, 2):
+            shared = (first.owned | first.draining) & (second.owned | second.draining)
+            self.assertFalse(shared, f"partitions {sorted(shared)} held by {first.replica_id} and {second.replica_id}")
+
+    @staticmethod
+    def telegram_id_in(coordinator, partition, start=100000):
+        return next(telegram_id for telegram_id in itertools.count(start) if coordinator.partition_of(coordinator.user_key(telegram_id, None)) == partition)
+
+    def test_partitions_are_exclusive_and_handed_over_after_their_claims(self):
+        first = self.replica("a")
+        self.heartbeat_all()
+        self.assertEqual(len(first.owned), self.PARTITIONS)
+        # Work in flight in every partition
+        for partition in range(self.PARTITIONS):
+            self.assertTrue(first.claim(self.telegram_id_in(first, partition), f"rec{partition}"))
+
+        self.replica("b")
+        self.replica("c")
+        self.heartbeat_all()
+        moving = set(range(self.PARTITIONS)) - first.owned
+        self.assertTrue(moving)
+        self.assertEqual(first.draining, moving)
+        for coordinator in self.replicas[1:]:
+            self.assertFalse(coordinator.owned, "a partition was handed over while work was claimed on it")
+        # A moving partition takes no new claims, but the work already claimed goes on
+        partition = min(moving)
+        self.assertFalse(first.claim(self.telegram_id_in(first, partition, start=900000), "recNew"))
+        self.assertTrue(first.claim(self.telegram_id_in(first, partition), f"rec{partition}"))
+
+        for partition in range(self.PARTITIONS):
+            first.release(f"rec{partition}")
+        self.heartbeat_all()
+        self.assertFalse(first.draining)
+        self.assertEqual(set().union(*(coordinator.owned for coordinator in self.replicas)), set(range(self.PARTITIONS)))
+        self.assertTrue(all(coordinator.owned for coordinator in self.replicas))
+
+        # A replica that stops hands its partitions over to the others at once
+        self.replicas.pop().stop()
+        self.heartbeat_all()
+        self.assertEqual(set().union(*(coordinator.owned for coordinator in self.replicas)), set(range(self.PARTITIONS)))
+
+    def tearDown(self):
+        for coordinator in self.replicas:
+            coordinator.stop()
+
+if __name__ == "__main__":
+    unittest.main()